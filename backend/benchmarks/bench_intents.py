@@ -0,0 +1,66 @@
+"""
+Micro-benchmark: IntentMatcher (regex compilada) x detecção antiga por substring.
+
+Uso (dentro de backend/):
+    python benchmarks/bench_intents.py [--n 20000]
+"""
+import argparse
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+MENSAGENS = [
+    "oi",
+    "quero pedir",
+    "tem combo?",
+    "Quais combos vocês têm?",
+    "isso é golpe? preciso pagar pix antes?",
+    "quero falar com alguém de verdade, não é robô né",
+    "o botão do site não funciona",
+    "realmente gostei do hot roll",
+    "Qual o preço do temaki duplo? Entregam no Boqueirão?",
+    "manda o link do cardápio por favor " * 5,
+]
+
+def legado_desconfianca(texto: str) -> bool:
+    texto_lower = texto.lower()
+    return any(palavra in texto_lower for palavra in server.DESCONFIANCA)
+
+def legado_pedido_humano(texto: str) -> bool:
+    texto_lower = texto.lower()
+    return any(palavra in texto_lower for palavra in server.PEDIDO_HUMANO)
+
+def legado():
+    # O fluxo antigo chamava pedido_humano duas vezes e desconfiança uma vez por mensagem
+    for msg in MENSAGENS:
+        legado_pedido_humano(msg)
+        legado_pedido_humano(msg)
+        legado_desconfianca(msg)
+
+def novo():
+    for msg in MENSAGENS:
+        server.detecta_intencoes(msg)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n", type=int, default=20000, help="repetições do conjunto de mensagens")
+    args = parser.parse_args()
+    
+    print("Diferenças de classificação (legado -> novo):")
+    for msg in MENSAGENS:
+        antigo = {i for i, f in (("desconfianca", legado_desconfianca), ("pedido_humano", legado_pedido_humano)) if f(msg)}
+        atual = server.detecta_intencoes(msg)
+        if antigo != atual:
+            print(f"  {msg[:50]!r}: {sorted(antigo)} -> {sorted(atual)}")
+    
+    total = args.n * len(MENSAGENS)
+    for nome, fn in (("legado (3 varreduras)", legado), ("IntentMatcher (1 passada)", novo)):
+        segundos = min(timeit.repeat(fn, number=args.n, repeat=3))
+        print(f"{nome:28s} {segundos * 1e6 / total:8.2f} µs/mensagem")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Micro-benchmark: memória e serialização das conversas - dicts antigos x
+Conversa/Mensagem com __slots__.
+
+Uso (dentro de backend/):
+    python benchmarks/bench_memory.py [--chats 500] [--mensagens 60]
+"""
+import argparse
+import gc
+import json
+import sys
+import timeit
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+
+TEXTOS = [
+    "oi",
+    "quero pedir",
+    "Quais combos vocês têm?",
+    "Temos o Combinado Exclusivo 80 Peças por R$ 49,90! 😊 Veja mais no site: https://sushiakicb.shop",
+    "Entregamos em toda Curitiba e região metropolitana! 🛵",
+]
+AUTORES = ["cliente", "bot"]
+
+def conversa_legada(chat_id: str, n: int) -> dict:
+    """Formato anterior: dict de 12 chaves e mensagens como dicts com ISO e id em texto"""
+    conversa = {
+        "chat_id": chat_id,
+        "mensagens": [],
+        "humano_ativo": False,
+        "modo_humanizado": False,
+        "ultimo_humano": None,
+        "mensagem_inicial_enviada": False,
+        "objecoes_tratadas": [],
+        "historico_ia": [],
+        "resumo_ia": "",
+        "nome_cliente": chat_id.split("@")[0],
+        "nao_lidas": 0,
+        "criado_em": datetime.now().isoformat()
+    }
+    for i in range(n):
+        autor = AUTORES[i % 2]
+        conversa["mensagens"].append({
+            "id": f"{server.PREFIXO_ID[autor]}_{datetime.now().timestamp()}",
+            "from": autor,
+            # Cópia: no servidor cada texto chega como uma string nova
+            "text": TEXTOS[i % len(TEXTOS)] + "",
+            "timestamp": datetime.now().isoformat()
+        })
+    return conversa
+
+def conversa_nova(chat_id: str, n: int) -> server.Conversa:
+    conversa = server.Conversa(chat_id)
+    for i in range(n):
+        conversa.mensagens.append(server.Mensagem(AUTORES[i % 2], TEXTOS[i % len(TEXTOS)] + ""))
+    return conversa
+
+def medir(fabrica, chats: int, mensagens: int) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    dados = {f"55419{i:07d}@s.whatsapp.net": fabrica(f"55419{i:07d}@s.whatsapp.net", mensagens) for i in range(chats)}
+    atual, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dados, atual
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--mensagens", type=int, default=60, help="mensagens por chat")
+    args = parser.parse_args()
+    total = args.chats * args.mensagens
+
+    legado, bytes_legado = medir(conversa_legada, args.chats, args.mensagens)
+    novo, bytes_novo = medir(conversa_nova, args.chats, args.mensagens)
+    print(f"{args.chats} chats x {args.mensagens} mensagens ({total} mensagens)")
+    print(f"{'dicts (legado)':28s} {bytes_legado / 2**20:8.2f} MiB  {bytes_legado / total:7.1f} B/mensagem")
+    print(f"{'__slots__ (Conversa)':28s} {bytes_novo / 2**20:8.2f} MiB  {bytes_novo / total:7.1f} B/mensagem")
+    print(f"economia: {100 * (1 - bytes_novo / bytes_legado):.1f}%")
+
+    # A saída da API tem de ser a mesma (ids e horários à parte, que são gerados)
+    exemplo = next(iter(novo.values()))
+    assert json.loads(exemplo.to_json()) == json.loads(json.dumps(exemplo, default=server.json_default))
+
+    conversas_legado = list(legado.values())
+    conversas_novo = list(novo.values())
+    for nome, fn in (
+        ("json.dumps (legado)", lambda: [json.dumps(c, ensure_ascii=False) for c in conversas_legado]),
+        ("Conversa.to_json", lambda: [c.to_json() for c in conversas_novo]),
+    ):
+        segundos = min(timeit.repeat(fn, number=3, repeat=3)) / 3
+        print(f"{nome:28s} {segundos * 1e6 / total:8.2f} µs/mensagem")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+"""
+Teste de carga ponta a ponta: server.py com provedores e bot WhatsApp falsos.
+
+Sobe um servidor local (aiohttp) que imita a OpenRouter (JSON e SSE), o Gemini
+via REST (generateContent / streamGenerateContent) e o /send-message do bot
+Node.js, com latência e taxa de erro configuráveis. Inicia o server.py com
+uvicorn num subprocesso apontando para esses stubs (config, banco e porta
+temporários) e dispara /api/webhook/message com N chats simultâneos enquanto
+M clientes WebSocket simulam o painel.
+
+Mede vazão, latência p50/p95/p99 do webhook e crescimento de memória (RSS)
+do backend. Com a mesma --seed a carga é a mesma; --compare falha (exit 1)
+se o resultado piorar em relação a um JSON salvo com --json.
+
+Uso (dentro de backend/):
+    python benchmarks/load_test.py --chats 50 --messages 10 --rate 0.5
+    python benchmarks/load_test.py --provider gemini --stream --ws-clients 20
+    python benchmarks/load_test.py --json base.json
+    python benchmarks/load_test.py --compare base.json --tolerance 0.2
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# ==================== STUBS ====================
+
+class LatencyModel:
+    """Sorteia latências (segundos) e erros simulados de forma reproduzível"""
+
+    def __init__(self, dist: str, mean: float, jitter: float, error_rate: float, seed: int):
+        self.dist = dist
+        self.mean = mean
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+
+    def sample(self) -> float:
+        if self.dist == "fixed" or self.mean <= 0:
+            return max(0.0, self.mean)
+        if self.dist == "lognormal":
+            # mediana = mean, dispersão relativa = jitter / mean
+            sigma = math.log1p(self.jitter / self.mean) if self.jitter > 0 else 0.0
+            return self.rng.lognormvariate(math.log(self.mean), sigma)
+        return max(0.0, self.rng.gauss(self.mean, self.jitter))
+
+    def fails(self) -> bool:
+        return self.rng.random() < self.error_rate
+
+RESPOSTA_STUB = (
+    "Olá! Temos o Combo Aki com 20 peças por R$ 49,90. "
+    "Também tem o Hot Roll e o Temaki Duplo.\n\n"
+    "Quer que eu te mande o link do cardápio para fazer o pedido? 🍣"
+)
+
+class StubServer:
+    """OpenRouter + Gemini REST + bot WhatsApp num único servidor local"""
+
+    def __init__(self, llm: LatencyModel, send_latency: LatencyModel):
+        self.llm = llm
+        self.send_latency = send_latency
+        self.llm_calls = 0
+        self.llm_errors = 0
+        self.sends = 0
+        self.app = web.Application()
+        self.app.router.add_post("/api/v1/chat/completions", self.openrouter)
+        self.app.router.add_post("/v1beta/models/{acao}", self.gemini)
+        self.app.router.add_post("/send-message", self.send_message)
+        self.runner = None
+
+    async def start(self, port: int):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def _simular_llm(self):
+        self.llm_calls += 1
+        await asyncio.sleep(self.llm.sample())
+        if self.llm.fails():
+            self.llm_errors += 1
+            return web.json_response(
+                {"error": {"message": "rate limit simulado", "code": 429}},
+                status=429, headers={"Retry-After": "1"}
+            )
+        return None
+
+    @staticmethod
+    def _pedacos(texto: str, tamanho: int = 12):
+        return [texto[i:i + tamanho] for i in range(0, len(texto), tamanho)]
+
+    async def _sse(self, request, eventos):
+        resposta = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resposta.prepare(request)
+        for evento in eventos:
+            await resposta.write(f"data: {evento}\r\n\r\n".encode())
+            await asyncio.sleep(0.005)
+        await resposta.write_eof()
+        return resposta
+
+    async def openrouter(self, request):
+        payload = await request.json()
+        erro = await self._simular_llm()
+        if erro is not None:
+            return erro
+        if not payload.get("stream"):
+            return web.json_response({
+                "id": "stub", "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": RESPOSTA_STUB}}]
+            })
+        eventos = [
+            json.dumps({"choices": [{"index": 0, "delta": {"content": pedaco}}]}, ensure_ascii=False)
+            for pedaco in self._pedacos(RESPOSTA_STUB)
+        ]
+        return await self._sse(request, eventos + ["[DONE]"])
+
+    async def gemini(self, request):
+        acao = request.match_info["acao"]
+        erro = await self._simular_llm()
+        if erro is not None:
+            return erro
+        def candidato(texto):
+            return {"candidates": [{"index": 0, "finishReason": "STOP",
+                                    "content": {"role": "model", "parts": [{"text": texto}]}}]}
+        if not acao.endswith(":streamGenerateContent"):
+            return web.json_response(candidato(RESPOSTA_STUB))
+        eventos = [json.dumps(candidato(p), ensure_ascii=False) for p in self._pedacos(RESPOSTA_STUB)]
+        if request.query.get("alt") == "sse":
+            return await self._sse(request, eventos)
+        # Transporte REST do SDK: um array JSON entregue aos poucos
+        resposta = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await resposta.prepare(request)
+        for i, evento in enumerate(eventos):
+            await resposta.write((("[" if i == 0 else ",\n") + evento).encode())
+            await asyncio.sleep(0.005)
+        await resposta.write(b"]")
+        await resposta.write_eof()
+        return resposta
+
+    async def send_message(self, request):
+        await request.json()
+        self.sends += 1
+        await asyncio.sleep(self.send_latency.sample())
+        return web.json_response({"success": True, "messageId": f"stub{self.sends}", "timestamp": int(time.time() * 1000)})
+
+    def stats(self) -> dict:
+        return {"llm_calls": self.llm_calls, "llm_errors": self.llm_errors, "whatsapp_sends": self.sends}
+
+# ==================== BACKEND ====================
+
+def porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def rss_bytes(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linha in f:
+                if linha.startswith("VmRSS:"):
+                    return int(linha.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+def iniciar_backend(args, porta: int, stub_url: str, tmp: Path) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "CONFIG_FILE": str(tmp / "config.json"),
+        "DB_FILE": str(tmp / "conversas.db"),
+        "STORAGE_BACKEND": args.storage,
+        "OPENROUTER_URL": f"{stub_url}/api/v1/chat/completions",
+        "GEMINI_API_ENDPOINT": stub_url,
+        "WHATSAPP_BOT_URL": stub_url,
+        "COALESCE_WINDOW": str(args.coalesce_window),
+        "RATE_LIMIT_FREE_RPM": str(args.rpm),
+        "RATE_LIMIT_RPM": str(args.rpm),
+        "RESPONSE_CACHE_TTL": "0" if args.no_cache else env.get("RESPONSE_CACHE_TTL", "600"),
+    })
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+         "--port", str(porta), "--log-level", "warning"],
+        cwd=str(BACKEND_DIR), env=env,
+        stdout=subprocess.DEVNULL if not args.verbose else None,
+        stderr=subprocess.DEVNULL if not args.verbose else None,
+    )
+
+async def esperar_backend(session: aiohttp.ClientSession, base: str, processo: subprocess.Popen, timeout: float = 30):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        if processo.poll() is not None:
+            raise RuntimeError(f"Backend saiu com código {processo.returncode} (rode com --verbose)")
+        try:
+            async with session.get(f"{base}/api/health") as r:
+                if r.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("Backend não respondeu em /api/health")
+
+async def configurar_backend(session: aiohttp.ClientSession, base: str, args):
+    modelo = args.model or ("deepseek/deepseek-r1:free" if args.provider == "openrouter" else "gemini-2.5-flash")
+    payload = {
+        "provider": args.provider,
+        "selected_model": modelo,
+        f"{args.provider}_api_key": "bench-key",
+        "auto_reply": True,
+        "stream_replies": args.stream,
+        "router_failover": args.failover,
+    }
+    async with session.post(f"{base}/api/config", json=payload) as r:
+        r.raise_for_status()
+
+# ==================== CARGA ====================
+
+def percentis(valores: list) -> dict:
+    if not valores:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0, "mean": 0.0}
+    ordenados = sorted(valores)
+    def p(q):
+        return round(ordenados[min(len(ordenados) - 1, int(len(ordenados) * q))] * 1000, 1)
+    return {"p50": p(0.5), "p95": p(0.95), "p99": p(0.99), "max": p(1.0),
+            "mean": round(sum(ordenados) / len(ordenados) * 1000, 1)}
+
+async def cliente_ws(session: aiohttp.ClientSession, url: str, parar: asyncio.Event, contagem: dict):
+    try:
+        async with session.ws_connect(url, heartbeat=None) as ws:
+            contagem["connected"] += 1
+            while not parar.is_set():
+                try:
+                    msg = await asyncio.wait_for(ws.receive(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    contagem["events"] += 1
+                elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                    contagem["disconnected"] += 1
+                    return
+    except aiohttp.ClientError:
+        contagem["failed"] += 1
+
+async def enviar(session, base, chat_id, texto, resultados):
+    inicio = time.monotonic()
+    try:
+        async with session.post(f"{base}/api/webhook/message", json={"chat_id": chat_id, "message": texto}) as r:
+            corpo = await r.json(content_type=None)
+            resultados["latencias"].append(time.monotonic() - inicio)
+            chave = str(r.status) if r.status != 200 else (corpo or {}).get("reason") or "replied"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        chave = type(e).__name__
+    resultados["status"][chave] = resultados["status"].get(chave, 0) + 1
+
+async def simular_chat(session, base, indice, args, rng, resultados):
+    chat_id = f"55419{indice:08d}@s.whatsapp.net"
+    tarefas = []
+    for i in range(args.messages):
+        # Chegadas de Poisson por chat (carga aberta: não espera a resposta anterior)
+        await asyncio.sleep(rng.expovariate(args.rate) if args.rate > 0 else 0)
+        texto = "tem combo?" if args.repeat_questions else f"quero saber do combo {i} para entrega no bairro {indice % 37}"
+        tarefas.append(asyncio.create_task(enviar(session, base, chat_id, texto, resultados)))
+    await asyncio.gather(*tarefas)
+
+async def amostrar_rss(pid: int, parar: asyncio.Event, memoria: dict):
+    while not parar.is_set():
+        rss = rss_bytes(pid)
+        if rss:
+            memoria["peak"] = max(memoria.get("peak") or 0, rss)
+        await asyncio.sleep(0.5)
+
+async def executar(args) -> dict:
+    rng = random.Random(args.seed)
+    stub = StubServer(
+        LatencyModel(args.llm_dist, args.llm_latency, args.llm_jitter, args.llm_error_rate, args.seed),
+        LatencyModel("normal", args.send_latency, args.send_latency / 4, 0.0, args.seed + 1),
+    )
+    stub_porta, backend_porta = porta_livre(), porta_livre()
+    await stub.start(stub_porta)
+    base = f"http://127.0.0.1:{backend_porta}"
+
+    with tempfile.TemporaryDirectory(prefix="sushi-bench-") as tmp:
+        processo = iniciar_backend(args, backend_porta, f"http://127.0.0.1:{stub_porta}", Path(tmp))
+        conector = aiohttp.TCPConnector(limit=args.connections)
+        timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+        try:
+            async with aiohttp.ClientSession(connector=conector, timeout=timeout) as session:
+                await esperar_backend(session, base, processo)
+                await configurar_backend(session, base, args)
+
+                # Aquecimento: a 1ª mensagem de cada chat recebe a mensagem inicial fixa (sem IA)
+                aquecimento = {"latencias": [], "status": {}}
+                await asyncio.gather(*(
+                    enviar(session, base, f"55419{i:08d}@s.whatsapp.net", "oi", aquecimento)
+                    for i in range(args.chats)
+                ))
+
+                parar = asyncio.Event()
+                ws_contagem = {"connected": 0, "events": 0, "disconnected": 0, "failed": 0}
+                ws_url = base.replace("http", "ws", 1) + "/api/ws"
+                ws_tasks = [asyncio.create_task(cliente_ws(session, ws_url, parar, ws_contagem))
+                            for _ in range(args.ws_clients)]
+                memoria = {"start": rss_bytes(processo.pid), "peak": None}
+                rss_task = asyncio.create_task(amostrar_rss(processo.pid, parar, memoria))
+                await asyncio.sleep(0.5)
+
+                resultados = {"latencias": [], "status": {}}
+                inicio = time.monotonic()
+                await asyncio.gather(*(
+                    simular_chat(session, base, i, args, random.Random(rng.random()), resultados)
+                    for i in range(args.chats)
+                ))
+                duracao = time.monotonic() - inicio
+
+                # Deixa o hub entregar o que ficou nas filas antes de medir
+                await asyncio.sleep(1.0)
+                memoria["end"] = rss_bytes(processo.pid)
+                parar.set()
+                await asyncio.gather(*ws_tasks, rss_task)
+
+                async with session.get(f"{base}/api/pipeline") as r:
+                    pipeline = await r.json()
+        finally:
+            processo.terminate()
+            try:
+                processo.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                processo.kill()
+            await stub.stop()
+
+    enviados = args.chats * args.messages
+    ok = len(resultados["latencias"])
+    crescimento = (memoria["end"] - memoria["start"]) if memoria.get("end") and memoria.get("start") else None
+    return {
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "compare", "verbose")},
+        "sent": enviados,
+        "completed": ok,
+        "duration_seconds": round(duracao, 3),
+        "throughput_rps": round(ok / duracao, 2) if duracao > 0 else 0.0,
+        "latency_ms": percentis(resultados["latencias"]),
+        "outcomes": resultados["status"],
+        "websocket": ws_contagem,
+        "memory": {
+            "rss_start_mb": round(memoria["start"] / 2**20, 1) if memoria.get("start") else None,
+            "rss_end_mb": round(memoria["end"] / 2**20, 1) if memoria.get("end") else None,
+            "rss_peak_mb": round(memoria["peak"] / 2**20, 1) if memoria.get("peak") else None,
+            "growth_mb": round(crescimento / 2**20, 1) if crescimento is not None else None,
+        },
+        "stubs": stub.stats(),
+        "pipeline": {k: pipeline.get(k) for k in ("processed", "rejected", "wait_ms")},
+    }
+
+# ==================== RELATÓRIO ====================
+
+def comparar(atual: dict, base: dict, tolerancia: float) -> list:
+    """Lista de regressões em relação a um resultado salvo"""
+    problemas = []
+    for p in ("p50", "p95", "p99"):
+        antes, agora = base["latency_ms"][p], atual["latency_ms"][p]
+        if antes and agora > antes * (1 + tolerancia):
+            problemas.append(f"latência {p}: {antes} ms -> {agora} ms")
+    if atual["throughput_rps"] < base["throughput_rps"] * (1 - tolerancia):
+        problemas.append(f"vazão: {base['throughput_rps']} -> {atual['throughput_rps']} req/s")
+    antes, agora = base["memory"].get("growth_mb"), atual["memory"].get("growth_mb")
+    if antes is not None and agora is not None and agora > max(antes * (1 + tolerancia), antes + 5):
+        problemas.append(f"crescimento de memória: {antes} MB -> {agora} MB")
+    if atual["completed"] < base["completed"]:
+        problemas.append(f"requisições concluídas: {base['completed']} -> {atual['completed']}")
+    return problemas
+
+def imprimir(r: dict):
+    lat = r["latency_ms"]
+    mem = r["memory"]
+    print(f"\nEnviadas: {r['sent']}  concluídas: {r['completed']}  em {r['duration_seconds']}s "
+          f"-> {r['throughput_rps']} req/s")
+    print(f"Latência webhook (ms): p50={lat['p50']} p95={lat['p95']} p99={lat['p99']} "
+          f"max={lat['max']} média={lat['mean']}")
+    print(f"Resultados: {r['outcomes']}")
+    print(f"WebSocket: {r['websocket']}")
+    print(f"Memória (MB): início={mem['rss_start_mb']} fim={mem['rss_end_mb']} "
+          f"pico={mem['rss_peak_mb']} crescimento={mem['growth_mb']}")
+    print(f"Stubs: {r['stubs']}  pipeline: {r['pipeline']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=20, help="chats simultâneos")
+    parser.add_argument("--messages", type=int, default=5, help="mensagens por chat (fora o aquecimento)")
+    parser.add_argument("--rate", type=float, default=1.0, help="mensagens/s por chat (Poisson; 0 = rajada)")
+    parser.add_argument("--ws-clients", type=int, default=5, help="clientes WebSocket do painel")
+    parser.add_argument("--provider", choices=("openrouter", "gemini"), default="openrouter")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--stream", action="store_true", help="liga stream_replies")
+    parser.add_argument("--failover", action="store_true", help="liga o failover do roteador")
+    parser.add_argument("--llm-dist", choices=("fixed", "normal", "lognormal"), default="lognormal")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="latência típica da IA (s)")
+    parser.add_argument("--llm-jitter", type=float, default=0.3, help="dispersão da latência da IA (s)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="fração de respostas 429")
+    parser.add_argument("--send-latency", type=float, default=0.05, help="latência do /send-message (s)")
+    parser.add_argument("--coalesce-window", type=float, default=0.0)
+    parser.add_argument("--rpm", type=float, default=0, help="cota por minuto no backend (0 = sem limite)")
+    parser.add_argument("--storage", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--no-cache", action="store_true", help="desliga o cache de respostas")
+    parser.add_argument("--repeat-questions", action="store_true", help="todas as mensagens iguais (exercita o cache)")
+    parser.add_argument("--connections", type=int, default=200, help="conexões HTTP do gerador de carga")
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="salva o resultado neste arquivo")
+    parser.add_argument("--compare", help="resultado base (JSON) para detectar regressões")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="piora relativa aceita no --compare")
+    parser.add_argument("--verbose", action="store_true", help="mostra a saída do backend")
+    args = parser.parse_args()
+
+    resultado = asyncio.run(executar(args))
+    imprimir(resultado)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(resultado, indent=2, ensure_ascii=False))
+        print(f"\nResultado salvo em {args.json}")
+
+    if args.compare:
+        problemas = comparar(resultado, json.loads(Path(args.compare).read_text()), args.tolerance)
+        if problemas:
+            print("\nREGRESSÕES:")
+            for problema in problemas:
+                print(f"  - {problema}")
+            sys.exit(1)
+        print("\nSem regressões em relação a", args.compare)
+
+if __name__ == "__main__":
+    main()
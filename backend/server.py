@@ -1,24 +1,51 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 import os
+import re
 import json
+import math
+import hashlib
+import heapq
+import random
+import sys
+import tempfile
+import unicodedata
+import zlib
 import asyncio
 import aiohttp
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import count, islice
+from bisect import bisect_left
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from string import Template
 
 # Carregar .env manualmente
 env_path = Path(__file__).parent / ".env"
-if env_path.exists():
+_env_file_keys = set()
+
+def load_env_file():
+    """Variáveis já definidas no ambiente têm precedência sobre o .env (exceto as que vieram dele)"""
+    if not env_path.exists():
+        return
     with open(env_path) as f:
         for line in f:
             line = line.strip()
             if line and not line.startswith('#') and '=' in line:
                 key, value = line.split('=', 1)
-                os.environ[key.strip()] = value.strip()
+                key = key.strip()
+                if key not in os.environ or key in _env_file_keys:
+                    os.environ[key] = value.strip()
+                    _env_file_keys.add(key)
+
+load_env_file()
 
 app = FastAPI(title="Sushi Aki Bot API")
 
@@ -31,95 +58,224 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ==================== MÉTRICAS ====================
+# Registro mínimo no formato de texto do Prometheus (GET /metrics). No caminho
+# quente só há soma em dict e bisect; gauges e contadores que já existem em
+# outras classes são lidos por função apenas na hora da coleta.
+METRICS_PREFIX = "sushi_"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+metrics_registry: List["Metric"] = []
+
+def _escape_label(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(nomes: tuple, valores: tuple, extra: str = "") -> str:
+    partes = [f'{nome}="{_escape_label(valor)}"' for nome, valor in zip(nomes, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+class Metric:
+    tipo = "untyped"
+    
+    def __init__(self, name: str, help: str, labelnames: tuple = (), func=None):
+        self.name = METRICS_PREFIX + name
+        self.help = help
+        self.labelnames = labelnames
+        # func() -> valor, ou {labels: valor}, calculado só na coleta
+        self.func = func
+        self.values: Dict[tuple, float] = {}
+        metrics_registry.append(self)
+    
+    def _samples(self):
+        if self.func is None:
+            return self.values.items()
+        valor = self.func()
+        return valor.items() if isinstance(valor, dict) else [((), valor)]
+    
+    def render(self) -> List[str]:
+        linhas = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.tipo}"]
+        for labels, valor in self._samples():
+            linhas.append(f"{self.name}{_format_labels(self.labelnames, labels)} {valor}")
+        return linhas
+
+class Counter(Metric):
+    tipo = "counter"
+    
+    def inc(self, *labels, valor: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + valor
+
+class Gauge(Metric):
+    tipo = "gauge"
+    
+    def set(self, *labels, valor: float):
+        self.values[labels] = valor
+
+class Histogram(Metric):
+    tipo = "histogram"
+    
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[tuple, list] = {}  # labels -> [contagens por bucket..., soma, total]
+    
+    def observe(self, valor: float, *labels):
+        serie = self.series.get(labels)
+        if serie is None:
+            serie = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        i = bisect_left(self.buckets, valor)
+        if i < len(self.buckets):
+            serie[i] += 1
+        serie[-2] += valor
+        serie[-1] += 1
+    
+    @contextmanager
+    def time(self, *labels):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - inicio, *labels)
+    
+    def render(self) -> List[str]:
+        linhas = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.tipo}"]
+        for labels, serie in self.series.items():
+            acumulado = 0
+            for limite, contagem in zip(self.buckets, serie):
+                acumulado += contagem
+                le = _format_labels(self.labelnames, labels, 'le="%s"' % limite)
+                linhas.append(f"{self.name}_bucket{le} {acumulado}")
+            le = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            linhas.append(f"{self.name}_bucket{le} {serie[-1]}")
+            linhas.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {serie[-2]}")
+            linhas.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {serie[-1]}")
+        return linhas
+
+def render_metrics() -> str:
+    linhas = []
+    for metrica in metrics_registry:
+        linhas.extend(metrica.render())
+    return "\n".join(linhas) + "\n"
+
+webhook_latency = Histogram("webhook_duration_seconds", "Tempo total de /api/webhook/message", ("outcome",))
+llm_latency = Histogram("llm_request_duration_seconds", "Duração das chamadas de IA", ("provider", "model", "outcome"))
+broadcast_latency = Histogram("broadcast_duration_seconds", "Tempo bloqueado em broadcast_message",
+                              buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+config_save_latency = Histogram("config_save_duration_seconds", "Tempo para salvar config.json",
+                                buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+errors_total = Counter("errors_total", "Erros por tipo", ("kind",))
+fallback_total = Counter("fallback_responses_total", "Respostas genéricas de fallback enviadas no lugar da IA")
+
 # ==================== MODELOS DISPONÍVEIS ====================
 AVAILABLE_MODELS = {
     "openrouter": {
         "deepseek/deepseek-r1:free": {
             "name": "DeepSeek R1 (Gratuito)",
             "description": "Modelo de raciocínio avançado, ótimo para respostas complexas",
-            "free": True
+            "free": True,
+            "context_tokens": 163840
         },
         "deepseek/deepseek-chat:free": {
             "name": "DeepSeek Chat (Gratuito)", 
             "description": "Modelo de chat rápido e eficiente",
-            "free": True
+            "free": True,
+            "context_tokens": 163840
         },
         "meta-llama/llama-3.3-70b-instruct:free": {
             "name": "Llama 3.3 70B (Gratuito)",
             "description": "Modelo grande da Meta, excelente qualidade",
-            "free": True
+            "free": True,
+            "context_tokens": 131072
         },
         "meta-llama/llama-3.1-8b-instruct:free": {
             "name": "Llama 3.1 8B (Gratuito)",
             "description": "Modelo menor mas muito rápido",
-            "free": True
+            "free": True,
+            "context_tokens": 131072
         },
         "google/gemma-2-9b-it:free": {
             "name": "Google Gemma 2 9B (Gratuito)",
             "description": "Modelo do Google, bom para português",
-            "free": True
+            "free": True,
+            "context_tokens": 8192
         },
         "qwen/qwen-2.5-72b-instruct:free": {
             "name": "Qwen 2.5 72B (Gratuito)",
             "description": "Modelo chinês muito capaz, multilíngue",
-            "free": True
+            "free": True,
+            "context_tokens": 32768
         },
         "qwen/qwen-2.5-coder-32b-instruct:free": {
             "name": "Qwen 2.5 Coder 32B (Gratuito)",
             "description": "Especializado em código e instruções",
-            "free": True
+            "free": True,
+            "context_tokens": 32768
         },
         "mistralai/mistral-small-24b-instruct-2501:free": {
             "name": "Mistral Small 24B (Gratuito)",
             "description": "Modelo europeu rápido e eficiente",
-            "free": True
+            "free": True,
+            "context_tokens": 32768
         },
         "microsoft/phi-3-mini-128k-instruct:free": {
             "name": "Microsoft Phi-3 Mini (Gratuito)",
             "description": "Modelo compacto da Microsoft",
-            "free": True
+            "free": True,
+            "context_tokens": 128000
         },
         "openchat/openchat-7b:free": {
             "name": "OpenChat 7B (Gratuito)",
             "description": "Modelo de chat open source",
-            "free": True
+            "free": True,
+            "context_tokens": 8192
         }
     },
     "gemini": {
         "gemini-2.5-flash": {
             "name": "Gemini 2.5 Flash",
             "description": "Mais recente e rápido",
-            "free": False
+            "free": False,
+            "context_tokens": 1048576
         },
         "gemini-2.5-pro": {
             "name": "Gemini 2.5 Pro",
             "description": "Mais capaz, respostas melhores",
-            "free": False
+            "free": False,
+            "context_tokens": 1048576
         },
         "gemini-2.0-flash": {
             "name": "Gemini 2.0 Flash",
             "description": "Versão estável e rápida",
-            "free": False
+            "free": False,
+            "context_tokens": 1048576
         },
         "gemini-1.5-flash": {
             "name": "Gemini 1.5 Flash",
             "description": "Versão anterior, muito estável",
-            "free": False
+            "free": False,
+            "context_tokens": 1048576
         },
         "gemini-1.5-pro": {
             "name": "Gemini 1.5 Pro",
             "description": "Versão anterior, alta qualidade",
-            "free": False
+            "free": False,
+            "context_tokens": 2097152
         }
     }
 }
 
 # ==================== CONFIGURAÇÃO ====================
-CONFIG_FILE = Path(__file__).parent / "config.json"
+# config.json é gravado de forma atômica (arquivo temporário + rename) fora do
+# event loop, com debounce para rajadas de POST /api/config. Edições externas
+# em config.json e .env são detectadas e recarregadas após validação. Toda
+# mudança incrementa config_manager.version, que caches podem usar como chave.
+CONFIG_FILE = Path(os.getenv("CONFIG_FILE", str(Path(__file__).parent / "config.json")))
+CONFIG_SAVE_DEBOUNCE = float(os.getenv("CONFIG_SAVE_DEBOUNCE", 0.5))
+CONFIG_WATCH_INTERVAL = float(os.getenv("CONFIG_WATCH_INTERVAL", 2))  # 0 = não observar
 
-def load_config():
-    """Carrega configuração do arquivo"""
-    default_config = {
+def default_config() -> dict:
+    return {
         "provider": "openrouter",
         "gemini_api_key": os.getenv("GEMINI_API_KEY", ""),
         "openrouter_api_key": os.getenv("OPENROUTER_API_KEY", ""),
@@ -129,369 +285,4495 @@ def load_config():
         "site_url": "https://sushiakicb.shop",
         "business_name": "Sushi Aki"
     }
+
+def read_config_file() -> dict:
+    """Lê config.json (levanta exceção se estiver ilegível)"""
+    with open(CONFIG_FILE) as f:
+        saved = json.load(f)
+    if not isinstance(saved, dict):
+        raise ValueError("config.json deve conter um objeto JSON")
+    return saved
+
+def load_config():
+    """Carrega configuração do arquivo"""
+    cfg = default_config()
     
     if CONFIG_FILE.exists():
         try:
-            with open(CONFIG_FILE) as f:
-                saved = json.load(f)
-                default_config.update(saved)
-        except Exception:
-            pass
+            cfg.update(read_config_file())
+        except Exception as e:
+            # Não descarta em silêncio: guarda o arquivo ruim para não ser
+            # sobrescrito pelo próximo save (e as API keys poderem ser recuperadas)
+            corrompido = CONFIG_FILE.with_name(f"{CONFIG_FILE.name}.corrupt-{int(time.time())}")
+            try:
+                os.replace(CONFIG_FILE, corrompido)
+            except OSError:
+                corrompido = None
+            print(f"⚠️ config.json inválido ({e}); usando padrões. Cópia em: {corrompido}")
     
-    return default_config
+    return cfg
+
+def validar_config(cfg: dict) -> List[str]:
+    """Lista de problemas de uma configuração (vazia se estiver ok)"""
+    erros = []
+    if cfg.get("provider") not in AVAILABLE_MODELS:
+        erros.append(f"provider inválido: {cfg.get('provider')!r}")
+    if not isinstance(cfg.get("selected_model"), str) or not cfg.get("selected_model"):
+        erros.append("selected_model deve ser um texto")
+    for campo in ("auto_reply", "router_failover", "stream_replies", "faq_fast_path"):
+        if campo in cfg and not isinstance(cfg[campo], bool):
+            erros.append(f"{campo} deve ser true/false")
+    minutos = cfg.get("human_takeover_minutes")
+    if not isinstance(minutos, int) or isinstance(minutos, bool) or minutos < 0:
+        erros.append("human_takeover_minutes deve ser um inteiro >= 0")
+    for campo in ("site_url", "business_name", "gemini_api_key", "openrouter_api_key"):
+        if not isinstance(cfg.get(campo, ""), str):
+            erros.append(f"{campo} deve ser um texto")
+    palavras = cfg.get("intent_keywords")
+    if palavras is not None and (
+        not isinstance(palavras, dict)
+        or any(not isinstance(lista, list) or not all(isinstance(p, str) and p.strip() for p in lista)
+               for lista in palavras.values())
+    ):
+        erros.append("intent_keywords deve mapear intenção -> lista de palavras não vazias")
+    modelos = cfg.get("router_models")
+    if modelos is not None and (not isinstance(modelos, list) or any(":" not in str(m) for m in modelos)):
+        erros.append("router_models deve ser uma lista no formato provider:modelo")
+    return erros
+
+def gravar_json_atomico(path: Path, dados, ensure_ascii: bool = True):
+    """Grava JSON sem nunca deixar o arquivo pela metade (bloqueante: rodar fora do event loop)"""
+    # Temporário único por gravação: duas gravações simultâneas nunca dividem o arquivo
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding="utf-8") as f:
+            json.dump(dados, f, indent=2, ensure_ascii=ensure_ascii)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
 
 def save_config(cfg):
-    """Salva configuração no arquivo"""
+    """Salva configuração no arquivo (atômico: nunca deixa config.json pela metade)"""
     try:
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(cfg, f, indent=2)
+        with config_save_latency.time():
+            gravar_json_atomico(CONFIG_FILE, cfg)
         return True
     except Exception as e:
+        errors_total.inc("config_save")
         print(f"Erro ao salvar config: {e}")
         return False
 
+def _assinatura(path: Path) -> Optional[tuple]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+class ConfigManager:
+    def __init__(self):
+        self.version = 1
+        self.saves = 0
+        self.debounced = 0
+        self.reloads = 0
+        self.reload_errors = 0
+        self.last_error: Optional[str] = None
+        self._save_task: Optional[asyncio.Task] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._watch_task: Optional[asyncio.Task] = None
+        self._config_sig = _assinatura(CONFIG_FILE)
+        self._env_sig = _assinatura(env_path)
+    
+    def schedule_save(self):
+        """Nova versão em memória; o arquivo é gravado após CONFIG_SAVE_DEBOUNCE sem mudanças"""
+        self.version += 1
+        if self._save_task is not None and not self._save_task.done():
+            self.debounced += 1
+            self._save_task.cancel()
+        self._save_task = asyncio.create_task(self._save_later())
+    
+    async def _save_later(self):
+        await asyncio.sleep(CONFIG_SAVE_DEBOUNCE)
+        # Cancelar só interrompe o debounce: a gravação já iniciada vai até o fim
+        await asyncio.shield(self._write())
+    
+    def _writing(self) -> bool:
+        return self._write_lock is not None and self._write_lock.locked()
+    
+    async def _write(self):
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        # Uma gravação por vez: a thread do executor não para com cancel()
+        async with self._write_lock:
+            snapshot = dict(config)
+            loop = asyncio.get_running_loop()
+            if await loop.run_in_executor(None, save_config, snapshot):
+                self.saves += 1
+                # A própria gravação não conta como edição externa
+                self._config_sig = _assinatura(CONFIG_FILE)
+    
+    async def flush(self):
+        """Grava já o que estiver pendente (shutdown)"""
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+            self._save_task = None
+            await self._write()
+    
+    def start(self):
+        if CONFIG_WATCH_INTERVAL > 0 and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch_loop())
+    
+    async def close(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+        await self.flush()
+    
+    async def _watch_loop(self):
+        while True:
+            await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+            try:
+                await self.check_files()
+            except Exception as e:
+                print(f"Erro ao verificar config: {e}")
+    
+    async def check_files(self) -> bool:
+        """Recarrega se config.json ou .env mudaram por fora; True se aplicou algo"""
+        env_sig = _assinatura(env_path)
+        config_sig = _assinatura(CONFIG_FILE)
+        env_mudou = env_sig != self._env_sig
+        config_mudou = config_sig != self._config_sig
+        if not env_mudou and not config_mudou:
+            return False
+        # Gravação nossa pendente: o arquivo será sobrescrito, não recarrega por cima
+        if config_mudou and (self._writing() or (self._save_task is not None and not self._save_task.done())):
+            return False
+        self._env_sig, self._config_sig = env_sig, config_sig
+        
+        if env_mudou:
+            # Só os defaults de API key usam o .env em tempo de execução; o resto exige restart
+            load_env_file()
+        return await self.reload("env" if env_mudou and not config_mudou else "config.json")
+    
+    async def reload(self, origem: str) -> bool:
+        nova = default_config()
+        try:
+            if CONFIG_FILE.exists():
+                nova.update(read_config_file())
+        except Exception as e:
+            return self._rejeitar(origem, f"arquivo ilegível: {e}")
+        erros = validar_config(nova)
+        if erros:
+            return self._rejeitar(origem, "; ".join(erros))
+        self.last_error = None
+        if nova == config:
+            return False
+        
+        palavras_antes = config.get("intent_keywords")
+        config.clear()
+        config.update(nova)
+        if config.get("intent_keywords") != palavras_antes:
+            reload_intent_matcher()
+        self.version += 1
+        self.reloads += 1
+        print(f"🔄 Configuração recarregada ({origem}), versão {self.version}")
+        await broadcast_message({"type": "config_updated", "version": self.version})
+        return True
+    
+    def _rejeitar(self, origem: str, erro: str) -> bool:
+        self.reload_errors += 1
+        self.last_error = f"{origem}: {erro}"
+        errors_total.inc("config_reload")
+        print(f"⚠️ Configuração externa ignorada ({origem}): {erro}")
+        return False
+    
+    def stats(self) -> dict:
+        return {
+            "version": self.version,
+            "file": str(CONFIG_FILE),
+            "saves": self.saves,
+            "debounced": self.debounced,
+            "save_pending": self._writing() or (self._save_task is not None and not self._save_task.done()),
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+            "last_error": self.last_error,
+            "watch_interval_seconds": CONFIG_WATCH_INTERVAL
+        }
+
 # Carregar configuração inicial
 config = load_config()
+config_manager = ConfigManager()
 
 # ==================== PROMPTS - INTELIGENTE COM CARDÁPIO REAL ====================
+# Textos em prompts/*.txt e cardápio em menu.json. Cada template é renderizado
+# uma vez por versão (config + arquivos) e fica em cache junto com seu hash,
+# que serve de chave para o cache de respostas.
+PROMPTS_DIR = Path(__file__).parent / "prompts"
+MENU_FILE = Path(__file__).parent / "menu.json"
+
+def formatar_preco(preco: float) -> str:
+    return f"R$ {preco:.2f}".replace(".", ",")
+
+def render_cardapio(menu: dict, detalhado: bool) -> str:
+    """Cardápio em texto para os prompts (com ou sem descrição dos itens)"""
+    blocos = []
+    for categoria in menu.get("categorias", []):
+        linhas = [f"{categoria['nome']}:"]
+        for item in categoria.get("itens", []):
+            linha = f"• {item['nome']} - {formatar_preco(item['preco'])}"
+            if detalhado and item.get("descricao"):
+                linha += f" ({item['descricao']})"
+            linhas.append(linha)
+        blocos.append("\n".join(linhas))
+    return "\n\n".join(blocos)
+
+class PromptTemplates:
+    def __init__(self, prompts_dir: Path, menu_file: Path):
+        self.prompts_dir = prompts_dir
+        self.menu_file = menu_file
+        self.templates: Dict[str, Template] = {}
+        self.menu: dict = {}
+        self.files_version = 0
+        self._rendered: Dict[str, tuple] = {}
+        self._render_key: Optional[tuple] = None
+        self._save_lock: Optional[asyncio.Lock] = None
+        self.renders = 0
+        self.load()
+    
+    def load(self):
+        """(Re)lê templates e cardápio do disco"""
+        self.templates = {
+            path.stem: Template(path.read_text(encoding="utf-8").rstrip("\n"))
+            for path in sorted(self.prompts_dir.glob("*.txt"))
+        }
+        with open(self.menu_file, encoding="utf-8") as f:
+            self.menu = json.load(f)
+        self.files_version += 1
+    
+    async def save_menu(self, menu: dict):
+        """Grava o menu.json fora do event loop, uma gravação por vez"""
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, gravar_json_atomico, self.menu_file, menu, False)
+            self.menu = menu
+            self.files_version += 1
+    
+    def _ensure_rendered(self):
+        business_name = config.get("business_name", "Sushi Aki")
+        site_url = config.get("site_url", "https://sushiakicb.shop")
+        key = (self.files_version, business_name, site_url)
+        if key == self._render_key:
+            return
+        
+        valores = {
+            "business_name": business_name,
+            "site_url": site_url,
+            "cardapio": render_cardapio(self.menu, detalhado=True),
+            "cardapio_resumido": render_cardapio(self.menu, detalhado=False)
+        }
+        rendered = {}
+        for nome, template in self.templates.items():
+            texto = template.safe_substitute(valores)
+            rendered[nome] = (texto, hashlib.sha256(texto.encode("utf-8")).hexdigest()[:16])
+        self._rendered = rendered
+        self._render_key = key
+        self.renders += 1
+    
+    def get(self, nome: str) -> tuple:
+        """(texto, hash) do template renderizado com a config atual"""
+        self._ensure_rendered()
+        return self._rendered[nome]
+    
+    def text(self, nome: str) -> str:
+        return self.get(nome)[0]
+    
+    def stats(self) -> dict:
+        self._ensure_rendered()
+        return {
+            "files_version": self.files_version,
+            "renders": self.renders,
+            "templates": {nome: h for nome, (_, h) in self._rendered.items()}
+        }
+
+prompt_templates = PromptTemplates(PROMPTS_DIR, MENU_FILE)
 
 def get_system_prompt():
     """Prompt principal do bot - vendedor inteligente com cardápio real"""
-    return f"""Você é um atendente virtual do {config.get('business_name', 'Sushi Aki')}, restaurante de sushi em Curitiba.
+    return prompt_templates.text("sistema")
+
+def get_human_mode_prompt():
+    """Prompt para modo humanizado - atendente Carol com cardápio real"""
+    return prompt_templates.text("humanizado")
+
+def get_mensagem_inicial():
+    return prompt_templates.text("mensagem_inicial")
+
+def get_resposta_desconfianca():
+    return prompt_templates.text("desconfianca")
+
+# Palavras que indicam desconfiança
+DESCONFIANCA = ["golpe", "confiável", "fake", "pix antes", "site seguro", "fraude", "verdade", "mentira", "enganar", "roubo", "falso", "scam"]
+
+# Palavras que indicam pedido de atendente humano
+PEDIDO_HUMANO = ["atendente", "humano", "pessoa", "real", "alguém", "funcionário", "gerente", "falar com alguém", "não é robô", "bot", "robozinho", "máquina", "quero falar"]
+
+# ==================== CLIENTE HTTP (POOL DE CONEXÕES) ====================
+# Uma única ClientSession durante toda a vida do app: reaproveita conexões
+# TCP/TLS com openrouter.ai e com o bot Node.js em vez de abrir uma por chamada.
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", 100))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 20))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", 60))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", 300))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+OPENROUTER_TIMEOUT = float(os.getenv("OPENROUTER_TIMEOUT", 30))
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+WHATSAPP_BOT_TIMEOUT = float(os.getenv("WHATSAPP_BOT_TIMEOUT", 10))
 
-🎯 SEU OBJETIVO: Ajudar o cliente e direcioná-lo para fazer pedido no site {config.get('site_url', 'https://sushiakicb.shop')}
+http_session: Optional[aiohttp.ClientSession] = None
 
-📋 REGRAS FUNDAMENTAIS (NUNCA QUEBRE):
+def get_http_session() -> aiohttp.ClientSession:
+    """Retorna a sessão HTTP compartilhada (cria se ainda não existir)"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL
+        )
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=OPENROUTER_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return http_session
 
-1. ❌ NUNCA INVENTE:
-   - Nomes de pratos que NÃO estão na lista abaixo
-   - Preços diferentes dos listados
-   - Promoções que não existem
-   - Informações sobre status de pedidos específicos
+async def close_http_session():
+    """Fecha a sessão HTTP compartilhada (shutdown)"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
 
-2. ✅ SEMPRE FAÇA:
-   - Use APENAS os produtos listados abaixo
-   - Se perguntarem algo que não sabe, direcione ao site
-   - Se não entender a mensagem, peça para explicar
-   - Seja educado e prestativo
+def get_http_pool_stats() -> dict:
+    """Conexões em uso, ociosas e na fila do pool HTTP, no total e por host"""
+    stats = {
+        "open": http_session is not None and not http_session.closed,
+        "limit": HTTP_POOL_LIMIT,
+        "limit_per_host": HTTP_POOL_LIMIT_PER_HOST,
+        "in_use": 0,
+        "idle": 0,
+        "queued": 0,
+        "hosts": {}
+    }
+    if not stats["open"]:
+        return stats
 
-3. 🧠 SEJA INTELIGENTE:
-   - Se o cliente escrever errado, NÃO transforme em produto
-   - Pergunte: "Desculpa, não entendi. Pode explicar melhor?"
-   - Analise se a mensagem faz sentido antes de responder
+    connector = http_session.connector
+    # O aiohttp não expõe esses contadores publicamente; lemos os atributos internos com fallback
+    acquired_per_host = getattr(connector, "_acquired_per_host", {})
+    idle_conns = getattr(connector, "_conns", {})
+    waiters = getattr(connector, "_waiters", {})
 
-🍣 CARDÁPIO REAL (APENAS estes produtos existem):
+    stats["in_use"] = len(getattr(connector, "_acquired", ()))
+    for key in set(acquired_per_host) | set(idle_conns) | set(waiters):
+        host = f"{key.host}:{key.port}"
+        host_stats = stats["hosts"].setdefault(host, {"in_use": 0, "idle": 0, "queued": 0})
+        host_stats["in_use"] += len(acquired_per_host.get(key, ()))
+        host_stats["idle"] += len(idle_conns.get(key, ()))
+        host_stats["queued"] += len(waiters.get(key, ()))
+    stats["idle"] = sum(h["idle"] for h in stats["hosts"].values())
+    stats["queued"] = sum(h["queued"] for h in stats["hosts"].values())
+    return stats
 
-DESTAQUES / EXCLUSIVOS DO APP:
-• Combinado Exclusivo 80 Peças - R$ 49,90 (escolha seus 80 sushis favoritos)
-• Temaki Duplo (2 Unidades) - R$ 24,90 (1 Temaki Salmão Grelhado + 1 Temaki Salmão Skin)
-• Hot Roll Lovers (16 Peças) - R$ 19,90 (16 peças de Hot Roll crocante)
+# ==================== CLIENTES DE IA ====================
 
-📍 INFORMAÇÕES DO NEGÓCIO:
-- Nome: {config.get('business_name', 'Sushi Aki')}
-- Site: {config.get('site_url', 'https://sushiakicb.shop')}
-- Localização: Curitiba (delivery)
-- Entrega: Toda Curitiba e região metropolitana
-- Pagamento: Pix, Visa, Mastercard (pelo site)
-- WhatsApp: (41) 98444-0032
-- Empresa: Parigot Comercio de Alimentos Ltda - CNPJ 47.801.438/0001-32
+class ProviderError(ValueError):
+    """Erro HTTP de um provedor de IA (status e Retry-After quando houver)"""
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
 
-💬 ESTILO DE COMUNICAÇÃO:
-- Respostas curtas (2-3 linhas)
-- Tom simpático e educado
-- Use 1-2 emojis por mensagem
-- Seja direto e útil
+def _openrouter_request(messages: list, model: str, stream: bool = False) -> tuple:
+    """Headers e payload de uma chamada à OpenRouter"""
+    api_key = config.get("openrouter_api_key", "")
+    if not api_key:
+        raise ValueError("API Key da OpenRouter não configurada")
+    
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": config.get("site_url", "https://sushiakicb.shop"),
+        "X-Title": config.get("business_name", "Sushi Aki Bot")
+    }
+    
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": 500,
+        "temperature": 0.8
+    }
+    if stream:
+        payload["stream"] = True
+    return headers, payload
 
-📝 EXEMPLOS CORRETOS:
+async def _openrouter_error(response) -> ProviderError:
+    error_text = await response.text()
+    retry_after = response.headers.get("Retry-After")
+    return ProviderError(
+        f"Erro OpenRouter ({response.status}): {error_text}",
+        status=response.status,
+        retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None
+    )
 
-Cliente: "Quais combos vocês têm?"
-→ "Temos o Combinado Exclusivo 80 Peças por R$ 49,90, Temaki Duplo por R$ 24,90 e Hot Roll Lovers por R$ 19,90! 😊 Veja mais no site: {config.get('site_url')}"
+async def call_openrouter(messages: list, model: str) -> str:
+    """Chama a API da OpenRouter"""
+    headers, payload = _openrouter_request(messages, model)
+    
+    session = get_http_session()
+    async with session.post(
+        OPENROUTER_URL,
+        headers=headers,
+        json=payload,
+        timeout=aiohttp.ClientTimeout(total=OPENROUTER_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    ) as response:
+        if response.status != 200:
+            raise await _openrouter_error(response)
+        
+        data = await response.json()
+        return data["choices"][0]["message"]["content"]
 
-Cliente: "Tem promoção?"
-→ "Temos preços especiais no app! O Combinado 80 Peças sai por R$ 49,90! 🎉 Confere: {config.get('site_url')}"
+async def stream_openrouter(messages: list, model: str):
+    """Chama a OpenRouter em modo SSE, gerando os pedaços de texto conforme chegam"""
+    headers, payload = _openrouter_request(messages, model, stream=True)
+    
+    session = get_http_session()
+    async with session.post(
+        OPENROUTER_URL,
+        headers=headers,
+        json=payload,
+        timeout=aiohttp.ClientTimeout(total=OPENROUTER_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    ) as response:
+        if response.status != 200:
+            raise await _openrouter_error(response)
+        
+        # Linhas "data: {...}"; comentários (": OPENROUTER PROCESSING") são keep-alive
+        async for linha in response.content:
+            linha = linha.strip()
+            if not linha.startswith(b"data:"):
+                continue
+            dados = linha[5:].strip()
+            if dados == b"[DONE]":
+                break
+            evento = json.loads(dados)
+            if "error" in evento:
+                erro = evento["error"]
+                raise ProviderError(f"Erro OpenRouter (stream): {erro.get('message', erro)}", status=erro.get("code"))
+            escolhas = evento.get("choices") or [{}]
+            texto = (escolhas[0].get("delta") or {}).get("content")
+            if texto:
+                yield texto
 
-Cliente: "mentiwa" ou "asdjasd" (mensagem sem sentido)
-→ "Desculpa, não entendi. Pode explicar melhor o que você precisa? 😊"
+# Gemini: o SDK é síncrono, então as chamadas rodam num pool de threads limitado
+# (nunca no event loop) e os GenerativeModel configurados ficam em cache.
+GEMINI_MAX_WORKERS = int(os.getenv("GEMINI_MAX_WORKERS", 8))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", 30))
+GEMINI_MODEL_CACHE_SIZE = int(os.getenv("GEMINI_MODEL_CACHE_SIZE", 32))
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "")
 
-Cliente: "Vocês têm combo de 100 peças?"
-→ "Nosso maior combo é o de 80 peças por R$ 49,90! Confere todas as opções no site: {config.get('site_url')} 🍣"
+gemini_executor = ThreadPoolExecutor(max_workers=GEMINI_MAX_WORKERS, thread_name_prefix="gemini")
+_gemini_models: "OrderedDict[tuple, Any]" = OrderedDict()
+_gemini_configured_key: Optional[str] = None
+_gemini_lock = threading.Lock()
 
-⚠️ IMPORTANTE: Se não souber ou não tiver certeza, direcione para o site!"""
+def get_gemini_model(api_key: str, model: str, system_prompt: str):
+    """Retorna um GenerativeModel em cache por (api_key, model, system_prompt)"""
+    import google.generativeai as genai
+    global _gemini_configured_key
+    
+    cache_key = (api_key, model, system_prompt)
+    with _gemini_lock:
+        cached = _gemini_models.get(cache_key)
+        if cached is not None:
+            _gemini_models.move_to_end(cache_key)
+            return cached
+        
+        # genai.configure é global: trocar a key invalida os modelos já criados
+        if _gemini_configured_key != api_key:
+            if GEMINI_API_ENDPOINT:
+                # Endpoint alternativo (ex.: stub local dos benchmarks) só funciona via REST
+                genai.configure(api_key=api_key, transport="rest",
+                                client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+            else:
+                genai.configure(api_key=api_key)
+            _gemini_configured_key = api_key
+            _gemini_models.clear()
+        
+        gemini_model = genai.GenerativeModel(
+            model_name=model,
+            system_instruction=system_prompt
+        )
+        _gemini_models[cache_key] = gemini_model
+        while len(_gemini_models) > GEMINI_MODEL_CACHE_SIZE:
+            _gemini_models.popitem(last=False)
+        return gemini_model
 
-def get_human_mode_prompt():
-    """Prompt para modo humanizado - atendente Carol com cardápio real"""
-    return f"""Você é a Carol, atendente do {config.get('business_name', 'Sushi Aki')}.
+def _gemini_chat(api_key: str, messages: list, model: str, system_prompt: str):
+    gemini_model = get_gemini_model(api_key, model, system_prompt)
+    
+    # Converter mensagens para formato Gemini (a mensagem de sistema vai em system_instruction)
+    history = []
+    for msg in messages[:-1]:
+        if msg["role"] == "system":
+            continue
+        role = "user" if msg["role"] == "user" else "model"
+        history.append({"role": role, "parts": [msg["content"]]})
+    
+    return gemini_model.start_chat(history=history)
+
+def _call_gemini_sync(api_key: str, messages: list, model: str, system_prompt: str) -> str:
+    """Chamada bloqueante ao Gemini (roda no gemini_executor)"""
+    chat = _gemini_chat(api_key, messages, model, system_prompt)
+    response = chat.send_message(messages[-1]["content"], request_options={"timeout": GEMINI_TIMEOUT})
+    return response.text
 
-👤 SUA IDENTIDADE:
-- Nome: Carol
-- Cargo: Atendente de suporte ao cliente
-- Personalidade: Educada, simpática, prestativa e profissional
+def _stream_gemini_sync(api_key: str, messages: list, model: str, system_prompt: str,
+                        emit, parar: threading.Event):
+    """Streaming bloqueante do Gemini: cada pedaço vai para emit(); None marca o fim"""
+    try:
+        chat = _gemini_chat(api_key, messages, model, system_prompt)
+        response = chat.send_message(
+            messages[-1]["content"], stream=True, request_options={"timeout": GEMINI_TIMEOUT}
+        )
+        for chunk in response:
+            if parar.is_set():
+                break
+            if chunk.text:
+                emit(chunk.text)
+        emit(None)
+    except Exception as e:
+        emit(e)
 
-📋 REGRAS FUNDAMENTAIS (NUNCA QUEBRE):
+async def call_gemini(messages: list, model: str, system_prompt: str) -> str:
+    """Chama a API do Google Gemini sem bloquear o event loop"""
+    api_key = config.get("gemini_api_key", "")
+    if not api_key:
+        raise ValueError("API Key do Gemini não configurada")
+    
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        gemini_executor, _call_gemini_sync, api_key, messages, model, system_prompt
+    )
 
-1. ❌ NUNCA INVENTE:
-   - Nomes de pratos que NÃO estão na lista abaixo
-   - Preços diferentes dos listados
-   - Status de pedidos específicos (você não tem acesso ao sistema)
-   - Promoções que não existem
+async def stream_gemini(messages: list, model: str, system_prompt: str):
+    """Streaming do Gemini: a thread do executor repassa os pedaços ao event loop por uma fila"""
+    api_key = config.get("gemini_api_key", "")
+    if not api_key:
+        raise ValueError("API Key do Gemini não configurada")
+    
+    loop = asyncio.get_running_loop()
+    fila: asyncio.Queue = asyncio.Queue()
+    parar = threading.Event()
+    
+    def emit(item):
+        loop.call_soon_threadsafe(fila.put_nowait, item)
+    
+    future = loop.run_in_executor(
+        gemini_executor, _stream_gemini_sync, api_key, messages, model, system_prompt, emit, parar
+    )
+    try:
+        while True:
+            item = await fila.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        await future
+    finally:
+        # Consumidor desistiu (timeout/failover): a thread para no próximo pedaço
+        parar.set()
 
-2. ✅ SEMPRE FAÇA:
-   - Use APENAS os produtos listados abaixo
-   - Se não souber, diga "vou verificar" ou direcione ao site
-   - Se não entender a mensagem, peça para explicar
-   - Seja educada e prestativa
+# Provedores locais de teste (ENABLE_STUB_PROVIDERS=1): respondem sem rede,
+# com latência e taxa de erro configuráveis, para testar o roteador offline.
+STUB_MODELS = {
+    "stub-rapido": {"latency": 0.2, "jitter": 0.05, "error_rate": 0.0},
+    "stub-lento": {"latency": 5.0, "jitter": 1.0, "error_rate": 0.0},
+    "stub-instavel": {"latency": 0.5, "jitter": 0.2, "error_rate": 0.3}
+}
 
-3. 🧠 SEJA INTELIGENTE:
-   - Se o cliente escrever errado, NÃO transforme em produto
-   - Pergunte: "Desculpa, não entendi. Pode explicar melhor?"
+if os.getenv("ENABLE_STUB_PROVIDERS") == "1":
+    AVAILABLE_MODELS["stub"] = {
+        nome: {
+            "name": f"Stub {nome.split('-', 1)[1].capitalize()}",
+            "description": f"Provedor local de teste (~{perfil['latency']}s, {int(perfil['error_rate'] * 100)}% erros)",
+            "free": True,
+            "context_tokens": 8192,
+            "rpm": 0
+        }
+        for nome, perfil in STUB_MODELS.items()
+    }
 
-🍣 CARDÁPIO REAL (APENAS estes produtos existem):
+async def call_stub(messages: list, model: str) -> str:
+    """Provedor falso local (sem rede)"""
+    perfil = STUB_MODELS.get(model)
+    if perfil is None:
+        raise ValueError(f"Modelo stub desconhecido: {model}")
+    await asyncio.sleep(max(0.0, random.gauss(perfil["latency"], perfil["jitter"])))
+    if random.random() < perfil["error_rate"]:
+        raise ProviderError(f"Erro stub ({model}): rate limit simulado", status=429)
+    return f"[{model}] Resposta de teste para: {messages[-1]['content'][:80]}"
 
-DESTAQUES / EXCLUSIVOS DO APP:
-• Combinado Exclusivo 80 Peças - R$ 49,90
-• Temaki Duplo (2 Unidades) - R$ 24,90
-• Hot Roll Lovers (16 Peças) - R$ 19,90
+async def stream_stub(messages: list, model: str):
+    """Versão em streaming do provedor falso: a latência vira tempo até o primeiro pedaço"""
+    resposta = await call_stub(messages, model)
+    for palavra in re.findall(r"\S+\s*", f"{resposta}. Segunda frase do stub.\n\nÚltimo parágrafo."):
+        await asyncio.sleep(0.01)
+        yield palavra
 
-📍 INFORMAÇÕES DO NEGÓCIO:
-- Site para pedidos: {config.get('site_url', 'https://sushiakicb.shop')}
-- Entrega: Toda Curitiba e região
-- Pagamento: Pix, Visa, Mastercard (pelo site)
-- Tempo médio de entrega: 40-60 minutos
-- WhatsApp: (41) 98444-0032
+# ==================== AGENDADOR DE CHAMADAS DE IA ====================
+# Token bucket por (provedor, API key, modelo) para respeitar a cota por minuto
+# dos modelos gratuitos. Quem espera entra numa fila com prioridade (clientes
+# antes de tarefas de fundo como /api/test-ai) e com prazo: pedido que passou do
+# prazo na fila é descartado em vez de ser respondido minutos depois.
+RATE_LIMIT_FREE_RPM = float(os.getenv("RATE_LIMIT_FREE_RPM", 20))
+RATE_LIMIT_RPM = float(os.getenv("RATE_LIMIT_RPM", 60))  # 0 = sem limite
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", 5))
 
-💬 COMO SE COMUNICAR:
-- Respostas curtas e objetivas (2-4 linhas)
-- Use "tá?" e "ok?" naturalmente
-- Máximo 1-2 emojis por mensagem
-- Tom amigável mas profissional
+PRIORIDADE_CLIENTE = 0
+PRIORIDADE_FUNDO = 1
+LLM_QUEUE_MAX_WAIT = {
+    PRIORIDADE_CLIENTE: float(os.getenv("LLM_QUEUE_MAX_WAIT", 30)),
+    PRIORIDADE_FUNDO: float(os.getenv("LLM_QUEUE_MAX_WAIT_BACKGROUND", 10))
+}
+NOMES_PRIORIDADE = {PRIORIDADE_CLIENTE: "cliente", PRIORIDADE_FUNDO: "fundo"}
 
-📝 EXEMPLOS DE RESPOSTAS:
+class QueueDeadlineExceeded(Exception):
+    """Pedido de IA passou do prazo esperando cota do provedor"""
 
-Cliente pede atendente:
-→ "Oii, tudo bem? Meu nome é Carol e vou te atender hoje 😊 Como posso te ajudar?"
+class TokenBucket:
+    def __init__(self, rpm: float, burst: int):
+        self.rpm = rpm
+        self.rate = rpm / 60.0
+        self.capacity = max(1, min(burst, int(rpm) or 1))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        agora = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (agora - self.updated) * self.rate)
+        self.updated = agora
+    
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+    
+    def wait_time(self) -> float:
+        """Segundos até haver um token"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def drain(self, seconds: float = 0.0):
+        """Provedor respondeu 429: zera a cota (e fica devendo seconds de recarga)"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
 
-Pedido não chegou:
-→ "Me manda o número do seu pedido por favor, que vou verificar pra você"
+class LLMScheduler:
+    def __init__(self):
+        self._buckets: Dict[tuple, Optional[TokenBucket]] = {}
+        self._filas: Dict[tuple, list] = {}
+        self._despachantes: Dict[tuple, asyncio.Task] = {}
+        self._seq = count()
+        self.granted = {p: 0 for p in NOMES_PRIORIDADE}
+        self.dropped = {p: 0 for p in NOMES_PRIORIDADE}
+        self._waits = {p: deque(maxlen=500) for p in NOMES_PRIORIDADE}
+    
+    def _chave(self, provider: str, model: str) -> tuple:
+        api_key = config.get(f"{provider}_api_key", "")
+        return (provider, hashlib.sha1(api_key.encode()).hexdigest()[:8], model)
+    
+    def _bucket(self, chave: tuple) -> Optional[TokenBucket]:
+        if chave not in self._buckets:
+            provider, _, model = chave
+            meta = AVAILABLE_MODELS.get(provider, {}).get(model, {})
+            rpm = meta.get("rpm", RATE_LIMIT_FREE_RPM if meta.get("free") else RATE_LIMIT_RPM)
+            self._buckets[chave] = TokenBucket(rpm, RATE_LIMIT_BURST) if rpm > 0 else None
+        return self._buckets[chave]
+    
+    def estimated_wait(self, provider: str, model: str) -> float:
+        """Espera aproximada por cota (usada pelo roteador para preferir modelos livres)"""
+        chave = self._chave(provider, model)
+        bucket = self._bucket(chave)
+        if bucket is None:
+            return 0.0
+        return bucket.wait_time() + len(self._filas.get(chave, ())) / bucket.rate
+    
+    def backoff(self, provider: str, model: str, retry_after: Optional[float] = None):
+        bucket = self._bucket(self._chave(provider, model))
+        if bucket is not None:
+            bucket.drain(retry_after or 0.0)
+    
+    async def acquire(self, provider: str, model: str, prioridade: int = PRIORIDADE_CLIENTE):
+        """Espera a vez e a cota; levanta QueueDeadlineExceeded se passar do prazo da faixa"""
+        chave = self._chave(provider, model)
+        bucket = self._bucket(chave)
+        fila = self._filas.setdefault(chave, [])
+        
+        if bucket is None or (not fila and bucket.try_take()):
+            self.granted[prioridade] += 1
+            self._waits[prioridade].append(0.0)
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(fila, (prioridade, next(self._seq), future))
+        if chave not in self._despachantes:
+            self._despachantes[chave] = asyncio.create_task(self._despachar(chave))
+        
+        inicio = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=LLM_QUEUE_MAX_WAIT[prioridade])
+        except asyncio.TimeoutError:
+            self.dropped[prioridade] += 1
+            raise QueueDeadlineExceeded(
+                f"Sem cota para {chave[0]}/{chave[2]} em {LLM_QUEUE_MAX_WAIT[prioridade]:.0f}s"
+            )
+        self.granted[prioridade] += 1
+        self._waits[prioridade].append(time.monotonic() - inicio)
+    
+    async def _despachar(self, chave: tuple):
+        """Entrega os tokens do bucket aos pedidos da fila, por prioridade e ordem de chegada"""
+        fila = self._filas[chave]
+        bucket = self._buckets[chave]
+        try:
+            while fila:
+                if fila[0][2].done():
+                    # Expirou ou foi cancelado enquanto esperava
+                    heapq.heappop(fila)
+                    continue
+                espera = bucket.wait_time()
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                    continue
+                bucket.try_take()
+                heapq.heappop(fila)[2].set_result(None)
+        finally:
+            del self._despachantes[chave]
+    
+    def stats(self) -> dict:
+        def percentis(valores):
+            ordenados = sorted(valores)
+            if not ordenados:
+                return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+            def p(q):
+                return round(ordenados[min(len(ordenados) - 1, int(len(ordenados) * q))] * 1000, 1)
+            return {"p50": p(0.5), "p95": p(0.95), "max": p(1.0)}
+        
+        return {
+            "lanes": {
+                nome: {
+                    "granted": self.granted[p],
+                    "dropped": self.dropped[p],
+                    "max_wait_seconds": LLM_QUEUE_MAX_WAIT[p],
+                    "wait_ms": percentis(self._waits[p])
+                }
+                for p, nome in NOMES_PRIORIDADE.items()
+            },
+            "buckets": [
+                {
+                    "provider": provider,
+                    "model": model,
+                    "rpm": bucket.rpm if bucket else None,
+                    "tokens": round(bucket.tokens, 2) if bucket else None,
+                    "queued": sum(1 for item in self._filas.get((provider, key, model), ()) if not item[2].done())
+                }
+                for (provider, key, model), bucket in self._buckets.items()
+            ]
+        }
 
-Pergunta sobre cardápio:
-→ "Nossos destaques são o Combinado 80 Peças por R$ 49,90 e o Temaki Duplo por R$ 24,90! Tem mais opções no site: {config.get('site_url')} 😊"
+llm_scheduler = LLMScheduler()
 
-Pergunta sobre promoção:
-→ "Temos preços especiais no app! O Combinado 80 Peças sai por R$ 49,90! Confere no site 😊"
+# ==================== ROTEADOR DE PROVEDORES ====================
+# Mede latência (p50/p95) e taxa de erro por provedor/modelo, escolhe o mais
+# rápido saudável, faz failover em erro/timeout com circuit breaker e, se
+# configurado, dispara uma requisição "hedge" quando a primeira demora demais.
+ROUTER_MAX_ATTEMPTS = int(os.getenv("ROUTER_MAX_ATTEMPTS", 3))
+ROUTER_ATTEMPT_TIMEOUT = float(os.getenv("ROUTER_ATTEMPT_TIMEOUT", OPENROUTER_TIMEOUT))
+ROUTER_HEDGE_AFTER = float(os.getenv("ROUTER_HEDGE_AFTER", 0))  # segundos; 0 = desligado
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", 5))
+ROUTER_BREAKER_THRESHOLD = int(os.getenv("ROUTER_BREAKER_THRESHOLD", 3))
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", 60))
 
-Mensagem confusa/sem sentido (ex: "mentiwa", "asdjasd"):
-→ "Desculpa, não entendi direito. Pode me explicar melhor o que você precisa?"
+def provider_has_key(provider: str) -> bool:
+    if provider == "stub":
+        return True
+    return bool(config.get(f"{provider}_api_key"))
 
-Cliente pergunta sobre produto que não existe:
-→ "Não tenho certeza sobre esse produto. Dá uma olhada no cardápio completo no site: {config.get('site_url')} 😊"
+async def call_provider(provider: str, messages: list, model: str, system_prompt: str) -> str:
+    if provider == "openrouter":
+        return await call_openrouter(messages, model)
+    if provider == "gemini":
+        return await call_gemini(messages, model, system_prompt)
+    if provider == "stub":
+        return await call_stub(messages, model)
+    raise ValueError(f"Provedor desconhecido: {provider}")
 
-Agradecimento:
-→ "Por nada! Qualquer coisa me chama aqui 😊"
+def stream_provider(provider: str, messages: list, model: str, system_prompt: str):
+    if provider == "openrouter":
+        return stream_openrouter(messages, model)
+    if provider == "gemini":
+        return stream_gemini(messages, model, system_prompt)
+    if provider == "stub":
+        return stream_stub(messages, model)
+    raise ValueError(f"Provedor desconhecido: {provider}")
 
-⚠️ IMPORTANTE:
-- É MELHOR perguntar do que inventar
-- NUNCA crie nomes de produtos que não estão na lista
-- Se não souber, direcione para o site
-- Mantenha sempre o nome "Carol\""""
+class ModelHealth:
+    """Latência, erros e circuit breaker de um provedor/modelo"""
+    
+    def __init__(self):
+        self.latencies = deque(maxlen=100)
+        self.outcomes = deque(maxlen=50)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        self.last_error: Optional[str] = None
+    
+    def state(self) -> str:
+        if not self.open_until:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half_open"
+    
+    def allows(self) -> bool:
+        estado = self.state()
+        if estado == "half_open":
+            return not self.trial_in_flight
+        return estado == "closed"
+    
+    def begin(self):
+        if self.state() == "half_open":
+            self.trial_in_flight = True
+    
+    def release(self, elapsed: float):
+        # Tentativa cancelada (perdeu para o hedge): o tempo decorrido é um
+        # limite inferior da latência e já serve para rebaixar o modelo lento
+        self.latencies.append(elapsed)
+        self.trial_in_flight = False
+    
+    def success(self, latency: float):
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+    
+    def failure(self, error: Exception):
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        self.last_error = str(error)[:200]
+        status = getattr(error, "status", None)
+        retry_after = getattr(error, "retry_after", None) or 0
+        # 429 abre na hora; demais erros abrem após N falhas seguidas (ou falha no teste half-open)
+        if status == 429 or self.trial_in_flight or self.consecutive_failures >= ROUTER_BREAKER_THRESHOLD:
+            self.open_until = time.monotonic() + max(ROUTER_BREAKER_COOLDOWN, retry_after)
+        self.trial_in_flight = False
+    
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordenadas = sorted(self.latencies)
+        return ordenadas[min(len(ordenadas) - 1, int(len(ordenadas) * p))]
+    
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+    
+    def stats(self) -> dict:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "state": self.state(),
+            "samples": len(self.latencies),
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "error_rate": round(self.error_rate(), 3),
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error
+        }
 
-def get_mensagem_inicial():
-    return f"""Oi! 😊 Bem-vindo ao {config.get('business_name', 'Sushi Aki')}!
+class ProviderRouter:
+    def __init__(self):
+        self.health: Dict[tuple, ModelHealth] = {}
+        self.requests = 0
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+    
+    def _health(self, candidato: tuple) -> ModelHealth:
+        if candidato not in self.health:
+            self.health[candidato] = ModelHealth()
+        return self.health[candidato]
+    
+    def candidates(self) -> List[tuple]:
+        """Modelo configurado + reservas: os gratuitos com key, ou só os de router_models.
+        
+        Modelo pago nunca entra como reserva sem estar em router_models.
+        """
+        provider = config.get("provider", "openrouter")
+        primario = (provider, config.get("selected_model", "deepseek/deepseek-r1:free"))
+        lista = [primario]
+        if not config.get("router_failover", True):
+            return lista
+        permitidos = config.get("router_models")
+        for prov, modelos in AVAILABLE_MODELS.items():
+            if not provider_has_key(prov):
+                continue
+            for model, info in modelos.items():
+                candidato = (prov, model)
+                if candidato == primario:
+                    continue
+                if permitidos is not None:
+                    if f"{prov}:{model}" not in permitidos:
+                        continue
+                elif not info.get("free"):
+                    continue
+                lista.append(candidato)
+        return lista
+    
+    def rank(self, candidatos: List[tuple]) -> List[tuple]:
+        """O configurado primeiro enquanto saudável; as reservas do mais rápido (p50 ajustado por erro) ao mais lento"""
+        primario = candidatos[0]
+        def pontuacao(candidato):
+            saude = self._health(candidato)
+            if len(saude.latencies) >= ROUTER_MIN_SAMPLES:
+                latencia = saude.percentile(0.5) / max(0.05, 1 - saude.error_rate())
+            else:
+                # Sem histórico: vai depois das reservas já medidas
+                latencia = ROUTER_ATTEMPT_TIMEOUT
+            # Modelo sem cota no momento perde posição para os que podem responder já
+            return latencia + llm_scheduler.estimated_wait(*candidato)
+        reservas = sorted((c for c in candidatos[1:] if self._health(c).allows()), key=pontuacao)
+        # Breaker do configurado aberto: só as reservas; todos abertos: tenta o configurado mesmo assim
+        if self._health(primario).allows():
+            return [primario] + reservas
+        return reservas or [primario]
+    
+    async def _attempt(self, candidato: tuple, messages: list, system_prompt: str) -> tuple:
+        provider, model = candidato
+        saude = self._health(candidato)
+        await llm_scheduler.acquire(provider, model)
+        async with message_pipeline.llm_slot():
+            saude.begin()
+            inicio = time.monotonic()
+            try:
+                resposta = await asyncio.wait_for(
+                    call_provider(provider, messages, model, system_prompt),
+                    timeout=ROUTER_ATTEMPT_TIMEOUT
+                )
+            except asyncio.CancelledError:
+                saude.release(time.monotonic() - inicio)
+                raise
+            except Exception as e:
+                saude.failure(e)
+                llm_latency.observe(time.monotonic() - inicio, provider, model, "error")
+                if getattr(e, "status", None) == 429:
+                    llm_scheduler.backoff(provider, model, getattr(e, "retry_after", None))
+                print(f"Falha em {provider}/{model}: {e}")
+                raise
+            saude.success(time.monotonic() - inicio)
+            llm_latency.observe(time.monotonic() - inicio, provider, model, "ok")
+            return resposta, provider, model
+    
+    async def complete(self, messages: list, system_prompt: str) -> tuple:
+        """Retorna (resposta, provider, model) do primeiro candidato que responder"""
+        self.requests += 1
+        fila = self.rank(self.candidates())[:ROUTER_MAX_ATTEMPTS]
+        pendentes: Dict[asyncio.Task, tuple] = {}
+        hedge_task: Optional[asyncio.Task] = None
+        ultimo_erro: Optional[Exception] = None
+        
+        try:
+            while fila or pendentes:
+                if not pendentes:
+                    if ultimo_erro is not None:
+                        self.failovers += 1
+                    candidato = fila.pop(0)
+                    pendentes[asyncio.create_task(self._attempt(candidato, messages, system_prompt))] = candidato
+                
+                espera = None
+                if ROUTER_HEDGE_AFTER > 0 and hedge_task is None and fila:
+                    espera = ROUTER_HEDGE_AFTER
+                feitas, _ = await asyncio.wait(pendentes, timeout=espera, return_when=asyncio.FIRST_COMPLETED)
+                
+                if not feitas:
+                    # Primeira tentativa lenta: dispara a próxima em paralelo
+                    self.hedges += 1
+                    candidato = fila.pop(0)
+                    hedge_task = asyncio.create_task(self._attempt(candidato, messages, system_prompt))
+                    pendentes[hedge_task] = candidato
+                    continue
+                
+                for task in feitas:
+                    pendentes.pop(task)
+                    if task.exception() is None:
+                        if task is hedge_task:
+                            self.hedge_wins += 1
+                        return task.result()
+                    ultimo_erro = task.exception()
+        finally:
+            for task in pendentes:
+                task.cancel()
+        
+        raise ultimo_erro or RuntimeError("Nenhum provedor disponível")
+    
+    async def stream(self, messages: list, system_prompt: str, origem: Optional[dict] = None):
+        """Gera os pedaços do primeiro candidato que começar a responder.
+        
+        O failover só acontece até o primeiro pedaço: depois disso o texto já
+        pode ter sido entregue ao cliente e um erro é repassado ao chamador.
+        origem, se passado, recebe o modelo antes do primeiro pedaço sair.
+        """
+        self.requests += 1
+        fila = self.rank(self.candidates())[:ROUTER_MAX_ATTEMPTS]
+        ultimo_erro: Optional[Exception] = None
+        
+        for candidato in fila:
+            if ultimo_erro is not None:
+                self.failovers += 1
+            provider, model = candidato
+            saude = self._health(candidato)
+            try:
+                await llm_scheduler.acquire(provider, model)
+            except QueueDeadlineExceeded as e:
+                ultimo_erro = e
+                continue
+            async with message_pipeline.llm_slot():
+                saude.begin()
+                inicio = time.monotonic()
+                gerador = stream_provider(provider, messages, model, system_prompt)
+                entregou = False
+                try:
+                    primeiro = await asyncio.wait_for(gerador.__anext__(), timeout=ROUTER_ATTEMPT_TIMEOUT)
+                    entregou = True
+                    if origem is not None:
+                        origem.update(fonte="ia", modelo=f"{provider}/{model}")
+                    yield primeiro
+                    async for pedaco in gerador:
+                        yield pedaco
+                except StopAsyncIteration:
+                    ultimo_erro = ValueError(f"Resposta vazia de {provider}/{model}")
+                    saude.failure(ultimo_erro)
+                    llm_latency.observe(time.monotonic() - inicio, provider, model, "error")
+                    continue
+                except (asyncio.CancelledError, GeneratorExit):
+                    saude.release(time.monotonic() - inicio)
+                    raise
+                except Exception as e:
+                    saude.failure(e)
+                    llm_latency.observe(time.monotonic() - inicio, provider, model, "error")
+                    if getattr(e, "status", None) == 429:
+                        llm_scheduler.backoff(provider, model, getattr(e, "retry_after", None))
+                    print(f"Falha em {provider}/{model}: {e}")
+                    if entregou:
+                        raise
+                    ultimo_erro = e
+                    continue
+                finally:
+                    await gerador.aclose()
+                saude.success(time.monotonic() - inicio)
+                llm_latency.observe(time.monotonic() - inicio, provider, model, "ok")
+                return
+        
+        raise ultimo_erro or RuntimeError("Nenhum provedor disponível")
+    
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_after_seconds": ROUTER_HEDGE_AFTER,
+            "candidates": [
+                {"provider": p, "model": m, **self._health((p, m)).stats()}
+                for p, m in self.candidates()
+            ]
+        }
 
-Quer ver nosso cardápio? Acessa aqui:
-👉 {config.get('site_url', 'https://sushiakicb.shop')}
+provider_router = ProviderRouter()
 
-Pagamos Pix e cartão | Entrega em Curitiba
+# ==================== JANELA DE CONTEXTO ====================
+# O histórico enviado à IA cabe num orçamento de tokens por modelo (estimado
+# localmente, sem tokenizer externo): turnos recentes vão inteiros, os antigos
+# viram um resumo curto e raciocínio (<think>...</think>) nunca é guardado.
+CONTEXT_MAX_PROMPT_TOKENS = int(os.getenv("CONTEXT_MAX_PROMPT_TOKENS", 3000))
+CONTEXT_REPLY_TOKENS = 500  # max_tokens pedido nas respostas
+CONTEXT_DEFAULT_MODEL_TOKENS = 8192
+CONTEXT_TURN_MAX_TOKENS = int(os.getenv("CONTEXT_TURN_MAX_TOKENS", 400))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", 200))
+CONTEXT_HISTORY_TURNS = 20
+CONTEXT_MESSAGE_OVERHEAD = 4  # papel + separadores de cada mensagem
 
-Posso te ajudar com algo? 🍣"""
+# Aproximação de BPE: pedaços de até 4 letras, grupos de até 3 dígitos e cada
+# símbolo/emoji contam como um token (erra pouco para português)
+_TOKEN_RE = re.compile(r"[^\W\d_]{1,4}|\d{1,3}|[^\w\s]|_")
+_RACIOCINIO = re.compile(r"<think>.*?(?:</think>|$)", re.S)
 
-def get_resposta_desconfianca():
-    return f"""Entendo sua preocupação! 😊
+def estimar_tokens(texto: str) -> int:
+    return len(_TOKEN_RE.findall(texto))
 
-Somos o {config.get('business_name', 'Sushi Aki')}, com 4 lojas físicas em Curitiba. Pode conferir!
+def truncar_tokens(texto: str, max_tokens: int) -> str:
+    """Corta o texto no max_tokens-ésimo token estimado"""
+    for i, token in enumerate(_TOKEN_RE.finditer(texto)):
+        if i == max_tokens:
+            return texto[:token.start()].rstrip() + "…"
+    return texto
 
-Nosso site oficial para pedidos:
-👉 {config.get('site_url', 'https://sushiakicb.shop')}
+def remover_raciocinio(texto: str) -> str:
+    """Remove blocos <think>...</think> (ou só o fim deles, quando o provedor corta a abertura)"""
+    if "<think>" in texto:
+        texto = _RACIOCINIO.sub("", texto)
+    if "</think>" in texto:
+        texto = texto.rsplit("</think>", 1)[1]
+    return texto.strip()
 
-Pagamento seguro por Pix ou cartão 🍣"""
+class FiltroRaciocinio:
+    """remover_raciocinio para texto em streaming (tags podem vir partidas entre pedaços)"""
+    
+    ABRE, FECHA = "<think>", "</think>"
+    
+    def __init__(self):
+        self.pendente = ""
+        self.dentro = False
+    
+    def feed(self, texto: str) -> str:
+        self.pendente += texto
+        saida = []
+        while True:
+            if self.dentro:
+                fim = self.pendente.find(self.FECHA)
+                if fim < 0:
+                    self.pendente = self.pendente[-(len(self.FECHA) - 1):]
+                    break
+                self.pendente = self.pendente[fim + len(self.FECHA):].lstrip()
+                self.dentro = False
+            else:
+                inicio = self.pendente.find(self.ABRE)
+                if inicio < 0:
+                    # Segura um possível começo de tag no fim do pedaço
+                    corte = self.pendente.rfind("<")
+                    if corte < 0 or not self.ABRE.startswith(self.pendente[corte:]):
+                        corte = len(self.pendente)
+                    saida.append(self.pendente[:corte])
+                    self.pendente = self.pendente[corte:]
+                    break
+                saida.append(self.pendente[:inicio])
+                self.pendente = self.pendente[inicio + len(self.ABRE):]
+                self.dentro = True
+        return "".join(saida)
+    
+    def flush(self) -> str:
+        texto = "" if self.dentro else self.pendente
+        self.pendente = ""
+        return texto
 
-# Palavras que indicam desconfiança
-DESCONFIANCA = ["golpe", "confiável", "fake", "pix antes", "site seguro", "fraude", "verdade", "mentira", "enganar", "roubo", "falso", "scam"]
+def orcamento_contexto() -> int:
+    """Tokens de prompt permitidos para o modelo configurado"""
+    provider = config.get("provider", "openrouter")
+    model = config.get("selected_model", "deepseek/deepseek-r1:free")
+    janela = AVAILABLE_MODELS.get(provider, {}).get(model, {}).get("context_tokens", CONTEXT_DEFAULT_MODEL_TOKENS)
+    return max(256, min(CONTEXT_MAX_PROMPT_TOKENS, janela - CONTEXT_REPLY_TOKENS))
 
-# Palavras que indicam pedido de atendente humano
-PEDIDO_HUMANO = ["atendente", "humano", "pessoa", "real", "alguém", "funcionário", "gerente", "falar com alguém", "não é robô", "bot", "robozinho", "máquina", "quero falar"]
+def resumir_turno(turno: dict) -> str:
+    """Primeira frase de um turno antigo, para o resumo da conversa"""
+    texto = " ".join(turno["content"].split())
+    frase = re.split(r"(?<=[.!?…])\s", texto, 1)[0]
+    if len(frase) > 100:
+        frase = frase[:100].rsplit(" ", 1)[0] + "…"
+    quem = "Cliente" if turno["role"] == "user" else "Atendente"
+    return f"{quem}: {frase}"
 
-# ==================== CLIENTES DE IA ====================
+def registrar_turno(conversa: dict, mensagem: str, resposta: str):
+    """Guarda pergunta/resposta em historico_ia já limpas e limitadas; o excesso vai para resumo_ia"""
+    for role, texto in (("user", mensagem), ("assistant", remover_raciocinio(resposta))):
+        texto = truncar_tokens(texto, CONTEXT_TURN_MAX_TOKENS)
+        conversa["historico_ia"].append({"role": role, "content": texto, "tokens": estimar_tokens(texto)})
+    
+    excedente = len(conversa["historico_ia"]) - CONTEXT_HISTORY_TURNS
+    if excedente > 0:
+        antigos = conversa["historico_ia"][:excedente]
+        conversa["historico_ia"] = conversa["historico_ia"][excedente:]
+        conversa["resumo_ia"] = estender_resumo(conversa.get("resumo_ia", ""), antigos)
 
-async def call_openrouter(messages: list, model: str) -> str:
-    """Chama a API da OpenRouter"""
-    api_key = config.get("openrouter_api_key", "")
-    if not api_key:
-        raise ValueError("API Key da OpenRouter não configurada")
+def estender_resumo(resumo: str, turnos: list) -> str:
+    """Resumo incremental: acrescenta os turnos e mantém as linhas mais recentes que cabem"""
+    linhas = [l for l in resumo.split("\n") if l]
+    linhas.extend(resumir_turno(t) for t in turnos)
+    while len(linhas) > 1 and estimar_tokens("\n".join(linhas)) > CONTEXT_SUMMARY_TOKENS:
+        linhas.pop(0)
+    return "\n".join(linhas)
+
+def _turnos_que_cabem(historico: list, disponivel: int) -> tuple:
+    incluidos = []
+    usados = 0
+    for turno in reversed(historico):
+        custo = (turno.get("tokens") or estimar_tokens(turno["content"])) + CONTEXT_MESSAGE_OVERHEAD
+        if usados + custo > disponivel:
+            break
+        usados += custo
+        incluidos.append(turno)
+    # Começa sempre num turno do cliente (é nele que o resumo é anexado)
+    if incluidos and incluidos[-1]["role"] != "user":
+        turno = incluidos.pop()
+        usados -= (turno.get("tokens") or estimar_tokens(turno["content"])) + CONTEXT_MESSAGE_OVERHEAD
+    incluidos.reverse()
+    return incluidos, usados
+
+def montar_contexto(system_prompt: str, resumo: str, historico: list, mensagem: str) -> tuple:
+    """Mensagens para a IA dentro do orçamento de tokens + uso estimado"""
+    orcamento = orcamento_contexto()
+    usados = estimar_tokens(system_prompt) + estimar_tokens(mensagem) + 2 * CONTEXT_MESSAGE_OVERHEAD
+    
+    incluidos, custo_historico = _turnos_que_cabem(historico, orcamento - usados)
+    if resumo or len(incluidos) < len(historico):
+        # Reserva espaço para o resumo; turnos que não couberem entram nele
+        reserva = CONTEXT_SUMMARY_TOKENS + CONTEXT_MESSAGE_OVERHEAD
+        incluidos, custo_historico = _turnos_que_cabem(historico, orcamento - usados - reserva)
+        omitidos = historico[:len(historico) - len(incluidos)]
+        if omitidos:
+            resumo = estender_resumo(resumo, omitidos)
+    resumo_tokens = estimar_tokens(resumo) + CONTEXT_MESSAGE_OVERHEAD if resumo else 0
+    usados += custo_historico + resumo_tokens
+    
+    messages = [{"role": "system", "content": system_prompt}]
+    for turno in incluidos:
+        role = "user" if turno["role"] == "user" else "assistant"
+        messages.append({"role": role, "content": turno["content"]})
+    messages.append({"role": "user", "content": mensagem})
+    
+    # O resumo vai junto da mensagem mais antiga enviada (funciona igual em
+    # todos os provedores, inclusive no Gemini, que só aceita um system prompt)
+    if resumo:
+        messages[1] = {
+            "role": messages[1]["role"],
+            "content": f"[Resumo do início da conversa]\n{resumo}\n\n{messages[1]['content']}"
+        }
+    
+    uso = {
+        "prompt_tokens": usados,
+        "budget": orcamento,
+        "history_turns": len(incluidos),
+        "omitted_turns": len(historico) - len(incluidos),
+        "summary_tokens": resumo_tokens
+    }
+    context_usage.record(uso)
+    return messages, uso
+
+class ContextUsage:
+    def __init__(self):
+        self.requests = 0
+        self.over_budget = 0
+        self.omitted_turns = 0
+        self.recent = deque(maxlen=200)
+    
+    def record(self, uso: dict):
+        self.requests += 1
+        self.omitted_turns += uso["omitted_turns"]
+        if uso["prompt_tokens"] > uso["budget"]:
+            self.over_budget += 1
+        self.recent.append(uso)
+    
+    def stats(self) -> dict:
+        tokens = sorted(u["prompt_tokens"] for u in self.recent)
+        return {
+            "requests": self.requests,
+            "budget": orcamento_contexto(),
+            "over_budget": self.over_budget,
+            "omitted_turns": self.omitted_turns,
+            "prompt_tokens": {
+                "avg": round(sum(tokens) / len(tokens), 1) if tokens else 0.0,
+                "p95": tokens[min(len(tokens) - 1, int(len(tokens) * 0.95))] if tokens else 0,
+                "max": tokens[-1] if tokens else 0
+            },
+            "last": self.recent[-1] if self.recent else None
+        }
+
+context_usage = ContextUsage()
+
+# ==================== CACHE DE RESPOSTAS ====================
+# Perguntas repetidas dos anúncios ("quais combos", "tem promoção") sem contexto
+# de conversa reaproveitam a resposta anterior em vez de chamar a IA de novo.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 500))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", 200))
+
+_NAO_PALAVRA = re.compile(r"[^\w\s]")
+
+def dobrar_acentos(texto: str) -> str:
+    """Minúsculas e sem acentos ("Não é robô" -> "nao e robo"); descarta emojis"""
+    if texto.isascii():
+        return texto.lower()
+    return unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode("ascii")
+
+def normalizar_texto(texto: str) -> str:
+    """Sem acentos, sem pontuação e com espaços colapsados"""
+    return " ".join(_NAO_PALAVRA.sub(" ", dobrar_acentos(texto)).split())
+
+class ResponseCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.config_version = None
+    
+    def make_key(self, mensagem: str, modo_humano: bool, prompt_hash: str, provider: str, model: str) -> Optional[tuple]:
+        """Chave do cache, ou None se a mensagem não deve ser cacheada"""
+        # Qualquer mudança de config (painel ou arquivo) invalida as respostas guardadas
+        if self.config_version != config_manager.version:
+            self.clear()
+            self.config_version = config_manager.version
+        if self.ttl <= 0 or len(mensagem) > RESPONSE_CACHE_MAX_CHARS:
+            return None
+        normalizada = normalizar_texto(mensagem)
+        if not normalizada:
+            return None
+        # provider e model ficam no fim: quem grava confere se foi esse modelo que respondeu
+        return (normalizada, modo_humano, prompt_hash, provider, model)
+    
+    def get(self, key: tuple) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+    
+    def set(self, key: tuple, resposta: str):
+        self._entries[key] = (resposta, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def clear(self):
+        if self._entries:
+            self.invalidations += 1
+        self._entries.clear()
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+def preparar_chamada_ia(mensagem: str, historico: list, modo_humano: bool, resumo: str = "") -> tuple:
+    """Monta (messages, system_prompt, cache_key) para uma chamada de IA"""
+    provider = config.get("provider", "openrouter")
+    model = config.get("selected_model", "deepseek/deepseek-r1:free")
+    
+    # Escolher prompt baseado no modo (já renderizado e com hash em cache)
+    system_prompt, prompt_hash = prompt_templates.get("humanizado" if modo_humano else "sistema")
+    
+    # Construir mensagens dentro do orçamento de tokens do modelo
+    messages, _ = montar_contexto(system_prompt, resumo, historico, mensagem)
+    
+    # Só mensagens sem contexto de conversa podem vir do cache
+    cache_key = None
+    if not historico and not resumo:
+        cache_key = response_cache.make_key(mensagem, modo_humano, prompt_hash, provider, model)
+    return messages, system_prompt, cache_key
+
+def resposta_fallback() -> str:
+    fallback_total.inc()
+    return f"Desculpe, tive um probleminha técnico 😅 Mas você pode fazer seu pedido direto no site: {config.get('site_url', 'https://sushiakicb.shop')} 🍣"
+
+async def generate_ai_response(mensagem: str, historico: list, modo_humano: bool = False, resumo: str = "",
+                               origem: Optional[dict] = None) -> str:
+    """Gera resposta usando o provedor configurado (origem, se passado, recebe de onde ela veio)"""
+    if origem is None:
+        origem = {}
+    messages, system_prompt, cache_key = preparar_chamada_ia(mensagem, historico, modo_humano, resumo)
+    
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            origem["fonte"] = "cache"
+            return cached
+    
+    try:
+        resposta, provider, model = await provider_router.complete(messages, system_prompt)
+    except Exception as e:
+        errors_total.inc("ai")
+        print(f"Erro na IA: {e}")
+        origem["fonte"] = "fallback"
+        return resposta_fallback()
+    
+    origem.update(fonte="ia", modelo=f"{provider}/{model}")
+    resposta = remover_raciocinio(resposta)
+    if not resposta:
+        # Só raciocínio, sem resposta: o pedido de desculpas não vai para o cache
+        origem["fonte"] = "fallback"
+        return resposta_fallback()
+    
+    # A chave é do modelo configurado: resposta de failover/hedge não entra no cache
+    if cache_key is not None and cache_key[3:] == (provider, model):
+        response_cache.set(cache_key, resposta)
+    return resposta
+
+# ==================== PERGUNTAS FREQUENTES ====================
+# Perguntas sobre cardápio, preço, entrega e pagamento já têm resposta fixa.
+# faq.json traz exemplos e respostas (templates com ${site_url} etc.), e cada
+# item de menu.json vira uma entrada de preço. A mensagem é comparada aos
+# exemplos por TF-IDF (cosseno). Só responde sem IA quando o melhor resultado
+# passa do limiar e fica à frente do segundo por uma margem; senão segue para a IA.
+FAQ_FILE = Path(__file__).parent / "faq.json"
+FAQ_FAST_PATH_DEFAULT = os.getenv("FAQ_FAST_PATH", "true").lower() in ("1", "true", "yes")
+# Mensagens mais longas costumam misturar assuntos: ficam com a IA
+FAQ_MAX_TOKENS = int(os.getenv("FAQ_MAX_TOKENS", 12))
+
+FAQ_STOPWORDS = {
+    "o", "a", "os", "as", "de", "do", "da", "dos", "das", "e", "em", "no", "na", "nos", "nas",
+    "um", "uma", "que", "com", "por", "para", "pra", "pro", "me", "eu", "voce", "voces", "vc",
+    "vcs", "oi", "ola", "bom", "boa", "dia", "tarde", "noite", "favor", "ai", "la", "ta"
+}
+
+def faq_tokens(texto: str) -> List[str]:
+    """Palavras normalizadas, sem stopwords e sem o plural em -s"""
+    tokens = []
+    for palavra in normalizar_texto(texto).split():
+        if palavra in FAQ_STOPWORDS:
+            continue
+        if len(palavra) > 3 and palavra.endswith("s"):
+            palavra = palavra[:-1]
+        tokens.append(palavra)
+    return tokens
+
+class FaqIndex:
+    def __init__(self, faq_file: Path, templates: PromptTemplates):
+        self.faq_file = faq_file
+        self.templates = templates
+        self.dados: dict = {}
+        self.files_version = 0
+        self._index_key: Optional[tuple] = None
+        self._exemplos: List[tuple] = []      # (entrada, {token: peso}, norma)
+        self._respostas: Dict[str, str] = {}
+        self._idf: Dict[str, float] = {}
+        self._idf_desconhecido = 1.0
+        self.consultas = 0
+        self.respondidas = 0
+        self.por_id: Dict[str, int] = {}
+        self._tempos = deque(maxlen=1000)
+        self.load()
+    
+    def load(self):
+        with open(self.faq_file, encoding="utf-8") as f:
+            self.dados = json.load(f)
+        self.files_version += 1
+    
+    def _entradas(self, valores: dict) -> List[tuple]:
+        """(id, exemplos, resposta) das perguntas fixas e de cada item do cardápio"""
+        entradas = [
+            (p["id"], p["exemplos"], Template(p["resposta"]).safe_substitute(valores))
+            for p in self.dados.get("perguntas", [])
+        ]
+        modelo = self.dados.get("itens_cardapio")
+        if modelo:
+            for categoria in self.templates.menu.get("categorias", []):
+                for item in categoria.get("itens", []):
+                    campos = {
+                        **valores,
+                        "nome": item["nome"],
+                        "preco": formatar_preco(item["preco"]),
+                        "descricao": f" ({item['descricao']})" if item.get("descricao") else ""
+                    }
+                    entradas.append((
+                        f"item:{item['nome']}",
+                        [Template(e).safe_substitute(campos) for e in modelo["exemplos"]],
+                        Template(modelo["resposta"]).safe_substitute(campos)
+                    ))
+        return entradas
+    
+    def _ensure_index(self):
+        business_name = config.get("business_name", "Sushi Aki")
+        site_url = config.get("site_url", "https://sushiakicb.shop")
+        key = (self.files_version, self.templates.files_version, business_name, site_url)
+        if key == self._index_key:
+            return
+        
+        valores = {
+            "business_name": business_name,
+            "site_url": site_url,
+            "cardapio_resumido": render_cardapio(self.templates.menu, detalhado=False)
+        }
+        entradas = self._entradas(valores)
+        documentos = [(eid, faq_tokens(exemplo)) for eid, exemplos, _ in entradas for exemplo in exemplos]
+        df: Dict[str, int] = {}
+        for _, tokens in documentos:
+            for token in set(tokens):
+                df[token] = df.get(token, 0) + 1
+        total = len(documentos)
+        self._idf = {token: math.log((total + 1) / (n + 1)) + 1 for token, n in df.items()}
+        # Palavra que não aparece em nenhum exemplo pesa o máximo: puxa a confiança para baixo
+        self._idf_desconhecido = math.log(total + 1) + 1
+        self._exemplos = []
+        for eid, tokens in documentos:
+            vetor = self._vetor(tokens)
+            if vetor:
+                self._exemplos.append((eid, vetor, math.sqrt(sum(p * p for p in vetor.values()))))
+        self._respostas = {eid: resposta for eid, _, resposta in entradas}
+        self._index_key = key
+    
+    def _vetor(self, tokens: List[str]) -> Dict[str, float]:
+        vetor: Dict[str, float] = {}
+        for token in tokens:
+            vetor[token] = vetor.get(token, 0.0) + self._idf.get(token, self._idf_desconhecido)
+        return vetor
+    
+    def match(self, texto: str) -> Optional[tuple]:
+        """(id, resposta, confiança) da melhor entrada, ou None se não houver confiança"""
+        tokens = faq_tokens(texto)
+        if not tokens or len(tokens) > FAQ_MAX_TOKENS:
+            return None
+        self._ensure_index()
+        consulta = self._vetor(tokens)
+        norma = math.sqrt(sum(p * p for p in consulta.values()))
+        melhores: Dict[str, float] = {}
+        for eid, vetor, norma_exemplo in self._exemplos:
+            produto = sum(peso * vetor.get(token, 0.0) for token, peso in consulta.items())
+            if produto:
+                score = produto / (norma * norma_exemplo)
+                if score > melhores.get(eid, 0.0):
+                    melhores[eid] = score
+        if not melhores:
+            return None
+        ranking = sorted(melhores.items(), key=lambda kv: kv[1], reverse=True)
+        eid, score = ranking[0]
+        segundo = ranking[1][1] if len(ranking) > 1 else 0.0
+        if score < self.dados.get("limiar", 0.6) or score - segundo < self.dados.get("margem", 0.1):
+            return None
+        return eid, self._respostas[eid], round(score, 3)
+    
+    def responder(self, texto: str) -> Optional[str]:
+        """Resposta pronta para a mensagem, ou None para seguir para a IA"""
+        inicio = time.perf_counter()
+        self.consultas += 1
+        encontrado = self.match(texto)
+        self._tempos.append(time.perf_counter() - inicio)
+        if encontrado is None:
+            return None
+        eid, resposta, _ = encontrado
+        self.respondidas += 1
+        self.por_id[eid] = self.por_id.get(eid, 0) + 1
+        return resposta
+    
+    def stats(self) -> dict:
+        tempos = sorted(self._tempos)
+        self._ensure_index()
+        return {
+            "entries": len(self._respostas),
+            "examples": len(self._exemplos),
+            "threshold": self.dados.get("limiar", 0.6),
+            "margin": self.dados.get("margem", 0.1),
+            "checked": self.consultas,
+            "answered_locally": self.respondidas,
+            "local_share": round(self.respondidas / self.consultas, 3) if self.consultas else 0.0,
+            "match_ms_p95": round(tempos[int(len(tempos) * 0.95)] * 1000, 3) if tempos else 0.0,
+            "by_entry": dict(sorted(self.por_id.items(), key=lambda kv: kv[1], reverse=True))
+        }
+
+faq_index = FaqIndex(FAQ_FILE, prompt_templates)
+
+def recarregar_prompts():
+    """Relê prompts/*.txt, menu.json e faq.json; as respostas em cache ficam velhas"""
+    prompt_templates.load()
+    faq_index.load()
+    response_cache.clear()
+
+# ==================== STREAMING DE RESPOSTAS ====================
+# Em vez de esperar a resposta inteira, o texto é cortado em blocos (primeiro
+# numa frase, depois em parágrafos) e cada bloco vai para o WhatsApp assim que
+# fica pronto: o cliente vê a primeira mensagem enquanto o resto ainda é gerado.
+STREAM_FIRST_CHUNK_CHARS = int(os.getenv("STREAM_FIRST_CHUNK_CHARS", 40))
+STREAM_MAX_CHUNK_CHARS = int(os.getenv("STREAM_MAX_CHUNK_CHARS", 600))
+STREAM_REPLIES_DEFAULT = os.getenv("STREAM_REPLIES", "0") == "1"
+
+_FIM_PARAGRAFO = re.compile(r"\n\s*\n")
+_FIM_FRASE = re.compile(r"(?<=[.!?…])\s+")
+
+class ChunkSplitter:
+    """Corta texto em streaming em blocos para envio.
+    
+    O primeiro bloco sai na primeira frase completa com pelo menos
+    STREAM_FIRST_CHUNK_CHARS caracteres; os seguintes saem a cada parágrafo
+    (ou na última frase antes de STREAM_MAX_CHUNK_CHARS, para não segurar
+    demais um parágrafo longo).
+    """
+    
+    def __init__(self, first_chars: int = STREAM_FIRST_CHUNK_CHARS, max_chars: int = STREAM_MAX_CHUNK_CHARS):
+        self.first_chars = first_chars
+        self.max_chars = max_chars
+        self.buffer = ""
+        self.emitidos = 0
+    
+    def _corte(self) -> Optional[tuple]:
+        paragrafo = _FIM_PARAGRAFO.search(self.buffer)
+        if paragrafo:
+            return paragrafo.start(), paragrafo.end()
+        if self.emitidos == 0:
+            for frase in _FIM_FRASE.finditer(self.buffer):
+                if frase.start() >= self.first_chars:
+                    return frase.start(), frase.end()
+        elif len(self.buffer) >= self.max_chars:
+            ultima = None
+            for frase in _FIM_FRASE.finditer(self.buffer):
+                ultima = frase
+            if ultima:
+                return ultima.start(), ultima.end()
+        return None
+    
+    def feed(self, texto: str) -> List[str]:
+        self.buffer += texto
+        blocos = []
+        while True:
+            corte = self._corte()
+            if corte is None:
+                break
+            bloco = self.buffer[:corte[0]].strip()
+            self.buffer = self.buffer[corte[1]:]
+            if bloco:
+                blocos.append(bloco)
+                self.emitidos += 1
+        return blocos
+    
+    def flush(self) -> List[str]:
+        bloco = self.buffer.strip()
+        self.buffer = ""
+        if not bloco:
+            return []
+        self.emitidos += 1
+        return [bloco]
+
+def dividir_resposta(texto: str) -> List[str]:
+    """Blocos de uma resposta já completa (cache/fallback), com os mesmos cortes do streaming"""
+    splitter = ChunkSplitter()
+    return splitter.feed(texto) + splitter.flush()
+
+async def generate_ai_response_stream(mensagem: str, historico: list, modo_humano: bool = False, resumo: str = "",
+                                      origem: Optional[dict] = None):
+    """Como generate_ai_response, mas gera os blocos da resposta conforme ficam prontos"""
+    if origem is None:
+        origem = {}
+    messages, system_prompt, cache_key = preparar_chamada_ia(mensagem, historico, modo_humano, resumo)
+    
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            origem["fonte"] = "cache"
+            for bloco in dividir_resposta(cached):
+                yield bloco
+            return
+    
+    splitter = ChunkSplitter()
+    filtro = FiltroRaciocinio()
+    partes = []
+    try:
+        async for pedaco in provider_router.stream(messages, system_prompt, origem):
+            pedaco = filtro.feed(pedaco)
+            partes.append(pedaco)
+            for bloco in splitter.feed(pedaco):
+                yield bloco
+        partes.append(filtro.flush())
+        for bloco in splitter.feed(partes[-1]):
+            yield bloco
+    except Exception as e:
+        errors_total.inc("ai")
+        print(f"Erro na IA (stream): {e}")
+        if not splitter.emitidos and not splitter.buffer.strip():
+            origem["fonte"] = "fallback"
+            for bloco in dividir_resposta(resposta_fallback()):
+                yield bloco
+            return
+        # Caiu no meio: entrega o que já chegou, sem guardar no cache
+        for bloco in splitter.flush():
+            yield bloco
+        return
+    
+    blocos = splitter.flush()
+    if not splitter.emitidos:
+        # Só veio raciocínio, sem resposta
+        origem["fonte"] = "fallback"
+        blocos = dividir_resposta(resposta_fallback())
+    for bloco in blocos:
+        yield bloco
+    if cache_key is not None and splitter.emitidos and origem.get("modelo") == f"{cache_key[3]}/{cache_key[4]}":
+        response_cache.set(cache_key, "".join(partes))
+
+# ==================== MODELO DE DADOS ====================
+# Conversas e mensagens são objetos com __slots__, não dicts. A mensagem guarda
+# o horário como inteiro (µs desde a época), o autor como string internada e um
+# id inteiro monotônico; o ISO e o "recv_<id>" só são montados na saída. Para o
+# resto do código elas continuam se comportando como dicts (msg["text"],
+# conversa.get(...)), e to_json() gera o mesmo JSON da API sem o json.dumps genérico.
+PREFIXO_ID = {"cliente": "recv", "bot": "sent", "humano": "manual"}
+CAMPOS_ENTREGA = ("status", "whatsapp_id", "outbox_id")
+
+# Começa no relógio atual: ids continuam únicos depois de um reinício
+_ids_mensagem = count(time.time_ns() // 1000)
+_encode_str = json.encoder.encode_basestring
+_AUTOR_JSON = {autor: _encode_str(autor) for autor in PREFIXO_ID}
+# Pedaços fixos do JSON de uma mensagem comum, por autor: '{"id":"recv_' e '","from":"cliente","text":'
+_CABECALHO_JSON = {autor: (f'{{"id":"{prefixo}_', f'","from":{_AUTOR_JSON[autor]},"text":') for autor, prefixo in PREFIXO_ID.items()}
+
+def ts_agora() -> int:
+    return time.time_ns() // 1000
+
+_iso_segundos: Dict[int, str] = {}
+
+def _iso_base(segundos: int) -> str:
+    # Mensagens próximas caem no mesmo segundo: a parte cara sai do cache
+    if len(_iso_segundos) >= 4096:
+        _iso_segundos.clear()
+    base = _iso_segundos[segundos] = datetime.fromtimestamp(segundos).isoformat()
+    return base
+
+def ts_para_iso(ts: int) -> str:
+    """Mesmo formato de datetime.now().isoformat() (horário local)"""
+    segundos = ts // 1_000_000
+    base = _iso_segundos.get(segundos) or _iso_base(segundos)
+    # Os 6 últimos dígitos já são os µs com zeros à esquerda (mais barato que divmod + :06d)
+    micros = str(ts)[-6:]
+    return base if micros == "000000" else f"{base}.{micros}"
+
+def iso_para_ts(iso: str) -> int:
+    dt = datetime.fromisoformat(iso)
+    return int(dt.replace(microsecond=0).timestamp()) * 1_000_000 + dt.microsecond
+
+def _valor_json(valor) -> str:
+    return json.dumps(valor, ensure_ascii=False, separators=(",", ":"), default=json_default)
+
+def json_default(obj):
+    """default= do json.dumps para mensagens e conversas"""
+    if isinstance(obj, (Mensagem, Conversa)):
+        return obj.to_dict()
+    raise TypeError(f"{type(obj).__name__} não é serializável em JSON")
+
+class Mensagem:
+    __slots__ = ("id", "autor", "texto", "ts", "status", "whatsapp_id", "outbox_id", "extras")
+    
+    def __init__(self, autor: str, texto: str, ts: Optional[int] = None, id=None):
+        self.id = next(_ids_mensagem) if id is None else id
+        self.autor = sys.intern(autor)
+        self.texto = texto
+        self.ts = ts_agora() if ts is None else ts
+        self.status = None
+        self.whatsapp_id = None
+        self.outbox_id = None
+        self.extras: Optional[dict] = None
+    
+    @classmethod
+    def from_dict(cls, dados) -> "Mensagem":
+        """Converte o formato antigo/persistido ({"id", "from", "text", "timestamp", ...})"""
+        if isinstance(dados, Mensagem):
+            return dados
+        timestamp = dados.get("timestamp")
+        msg = cls(dados.get("from", ""), dados.get("text", ""), iso_para_ts(timestamp) if timestamp else None, dados.get("id"))
+        for chave, valor in dados.items():
+            if chave not in ("id", "from", "text", "timestamp") and valor is not None:
+                msg[chave] = valor
+        return msg
+    
+    @property
+    def id_str(self) -> str:
+        if isinstance(self.id, str):
+            return self.id
+        return f"{PREFIXO_ID.get(self.autor, 'msg')}_{self.id}"
+    
+    # ---- interface de dict ----
+    
+    def __getitem__(self, chave: str):
+        if chave == "id":
+            return self.id_str
+        if chave == "from":
+            return self.autor
+        if chave == "text":
+            return self.texto
+        if chave == "timestamp":
+            return ts_para_iso(self.ts)
+        if chave in CAMPOS_ENTREGA:
+            valor = getattr(self, chave)
+            if valor is not None:
+                return valor
+        elif self.extras and chave in self.extras:
+            return self.extras[chave]
+        raise KeyError(chave)
+    
+    def __setitem__(self, chave: str, valor):
+        if chave == "id":
+            self.id = valor
+        elif chave == "from":
+            self.autor = sys.intern(valor)
+        elif chave == "text":
+            self.texto = valor
+        elif chave == "timestamp":
+            self.ts = iso_para_ts(valor)
+        elif chave in CAMPOS_ENTREGA:
+            setattr(self, chave, valor)
+        else:
+            if self.extras is None:
+                self.extras = {}
+            self.extras[chave] = valor
+    
+    def get(self, chave: str, padrao=None):
+        try:
+            return self[chave]
+        except KeyError:
+            return padrao
+    
+    def __contains__(self, chave: str) -> bool:
+        return self.get(chave) is not None
+    
+    def keys(self):
+        chaves = ["id", "from", "text", "timestamp"]
+        chaves += [c for c in CAMPOS_ENTREGA if getattr(self, c) is not None]
+        if self.extras:
+            chaves += list(self.extras)
+        return chaves
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self) -> int:
+        return len(self.keys())
+    
+    def items(self):
+        return [(chave, self[chave]) for chave in self.keys()]
+    
+    def to_dict(self) -> dict:
+        return dict(self.items())
+    
+    def to_json(self) -> str:
+        return _mensagens_json((self,))
+    
+    def _json_completo(self) -> str:
+        """Qualquer mensagem: id em texto, autor fora do padrão, entrega e extras"""
+        autor = self.autor
+        id_json = _encode_str(self.id) if isinstance(self.id, str) else f'"{PREFIXO_ID.get(autor, "msg")}_{self.id}"'
+        autor_json = _AUTOR_JSON.get(autor) or _encode_str(autor)
+        base = f'{{"id":{id_json},"from":{autor_json},"text":{_encode_str(self.texto)},"timestamp":"{ts_para_iso(self.ts)}"'
+
+        if self.status is None and self.whatsapp_id is None and self.outbox_id is None and not self.extras:
+            return base + "}"
+        partes = [base]
+        for campo in CAMPOS_ENTREGA:
+            valor = getattr(self, campo)
+            if valor is not None:
+                partes += [',"', campo, '":', _valor_json(valor)]
+        if self.extras:
+            for chave, valor in self.extras.items():
+                partes += [",", _encode_str(chave), ":", _valor_json(valor)]
+        partes.append("}")
+        return "".join(partes)
+
+def _mensagens_json(mensagens) -> str:
+    """JSON das mensagens separado por vírgula.
+    
+    Caso comum (id inteiro, autor conhecido, sem entrega/extras) numa f-string
+    só, com o horário montado aqui mesmo; o resto vai por _json_completo().
+    """
+    partes = []
+    adicionar = partes.append
+    cabecalhos = _CABECALHO_JSON
+    iso_cache = _iso_segundos
+    encode = _encode_str
+    for m in mensagens:
+        cabecalho = cabecalhos.get(m.autor) if type(m.id) is int else None
+        if (cabecalho is None or m.status is not None or m.whatsapp_id is not None
+                or m.outbox_id is not None or m.extras):
+            adicionar(m._json_completo())
+            continue
+        ts = m.ts
+        base = iso_cache.get(ts // 1_000_000) or _iso_base(ts // 1_000_000)
+        micros = str(ts)[-6:]
+        if micros != "000000":
+            base = f"{base}.{micros}"
+        adicionar(f'{cabecalho[0]}{m.id}{cabecalho[1]}{encode(m.texto)},"timestamp":"{base}"}}')
+    return ",".join(partes)
+
+class Conversa:
+    __slots__ = (
+        "chat_id", "mensagens", "humano_ativo", "modo_humanizado", "ultimo_humano",
+        "mensagem_inicial_enviada", "objecoes_tratadas", "historico_ia", "resumo_ia",
+        "nome_cliente", "nao_lidas", "criado_em", "extras", "funil"
+    )
+    # extras: campos desconhecidos (saem na API); funil: estado interno do
+    # analytics, fora de items()/to_json() e gravado numa coluna própria
+    CAMPOS = __slots__[:-2]
+    _CAMPOS = frozenset(CAMPOS)
+    
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.mensagens: List[Mensagem] = []
+        self.humano_ativo = False
+        self.modo_humanizado = False  # Modo 100% humanizado
+        self.ultimo_humano = None
+        self.mensagem_inicial_enviada = False
+        self.objecoes_tratadas: List[str] = []
+        self.historico_ia: List[dict] = []
+        self.resumo_ia = ""
+        self.nome_cliente = chat_id.split("@")[0] if "@" in chat_id else chat_id
+        self.nao_lidas = 0
+        self.criado_em = datetime.now().isoformat()
+        self.extras: Optional[dict] = None
+        self.funil: Optional[dict] = None
+    
+    # ---- interface de dict ----
+    
+    def __getitem__(self, chave: str):
+        if chave in self._CAMPOS:
+            return getattr(self, chave)
+        if self.extras and chave in self.extras:
+            return self.extras[chave]
+        raise KeyError(chave)
+    
+    def __setitem__(self, chave: str, valor):
+        if chave == "mensagens":
+            valor = [Mensagem.from_dict(m) for m in valor]
+        elif chave == "funil":
+            self.funil = valor
+            return
+        if chave in self._CAMPOS:
+            setattr(self, chave, valor)
+        else:
+            if self.extras is None:
+                self.extras = {}
+            self.extras[chave] = valor
+    
+    def get(self, chave: str, padrao=None):
+        try:
+            return self[chave]
+        except KeyError:
+            return padrao
+    
+    def __contains__(self, chave: str) -> bool:
+        return chave in self._CAMPOS or bool(self.extras and chave in self.extras)
+    
+    def update(self, dados: dict):
+        for chave, valor in dados.items():
+            self[chave] = valor
+    
+    def keys(self):
+        return list(self.CAMPOS) + (list(self.extras) if self.extras else [])
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self) -> int:
+        return len(self.keys())
+    
+    def items(self):
+        return [(chave, self[chave]) for chave in self.keys()]
+    
+    def to_dict(self) -> dict:
+        return dict(self.items())
+    
+    def to_json(self) -> str:
+        # O estado vai num json.dumps só (encoder em C); as mensagens, num laço sem chamada por mensagem
+        estado = _valor_json({chave: valor for chave, valor in self.items() if chave != "mensagens"})
+        return f'{{"mensagens":[{_mensagens_json(self.mensagens)}],{estado[1:]}'
+
+
+# ==================== ESTADO GLOBAL ====================
+conversas: Dict[str, Conversa] = {}
+whatsapp_status = {
+    "connected": False,
+    "qr_code": None,
+    "phone_number": None,
+    "status_text": "Desconectado"
+}
+
+# ==================== PIPELINE DE MENSAGENS ====================
+# Mensagens do mesmo chat são processadas em ordem (lock por chat_id); chats
+# diferentes rodam em paralelo, com um teto global de chamadas de IA simultâneas.
+MAX_LLM_CONCURRENCY = int(os.getenv("MAX_LLM_CONCURRENCY", 16))
+MAX_PENDING_MESSAGES = int(os.getenv("MAX_PENDING_MESSAGES", 500))
+
+class PipelineFull(Exception):
+    """Fila de mensagens cheia (backpressure)"""
+
+class MessagePipeline:
+    def __init__(self, max_llm_concurrency: int, max_pending: int):
+        self.max_llm_concurrency = max_llm_concurrency
+        self.max_pending = max_pending
+        self._chat_locks: Dict[str, asyncio.Lock] = {}
+        self._chat_waiting: Dict[str, int] = {}
+        self._chat_last_wait: Dict[str, float] = {}
+        self._llm_semaphore = asyncio.Semaphore(max_llm_concurrency)
+        self._recent_waits = deque(maxlen=1000)
+        self.pending = 0
+        self.llm_waiting = 0
+        self.llm_in_flight = 0
+        self.processed = 0
+        self.rejected = 0
+    
+    def admit(self):
+        """Reserva um lugar na fila antes de qualquer efeito colateral; PipelineFull se cheia.
+        
+        O lugar vale desde já (inclusive na janela de agrupamento) e é
+        devolvido com release().
+        """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PipelineFull()
+        self.pending += 1
+    
+    def release(self):
+        self.pending -= 1
+    
+    @asynccontextmanager
+    async def chat_slot(self, chat_id: str, admitted: bool = False):
+        """Garante processamento em ordem para um chat_id.
+        
+        admitted=True: quem chama já passou por admit(), já registrou a
+        mensagem e devolve o lugar com release(); recusar agora faria o
+        reenvio do bot duplicá-la.
+        """
+        if not admitted:
+            self.admit()
+        
+        self._chat_waiting[chat_id] = self._chat_waiting.get(chat_id, 0) + 1
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        inicio = time.monotonic()
+        adquirido = False
+        try:
+            async with lock:
+                adquirido = True
+                self._chat_waiting[chat_id] -= 1
+                espera = time.monotonic() - inicio
+                self._chat_last_wait[chat_id] = espera
+                self._recent_waits.append(espera)
+                yield
+                self.processed += 1
+        finally:
+            if not admitted:
+                self.release()
+            if not adquirido:
+                self._chat_waiting[chat_id] -= 1
+            # Ninguém esperando nem segurando o lock: libera a entrada do chat
+            if self._chat_waiting[chat_id] <= 0 and not lock.locked():
+                del self._chat_waiting[chat_id]
+                self._chat_locks.pop(chat_id, None)
+                self._chat_last_wait.pop(chat_id, None)
+    
+    def is_busy(self, chat_id: str) -> bool:
+        """Há mensagem desse chat em processamento ou na fila?"""
+        return chat_id in self._chat_locks
+    
+    @asynccontextmanager
+    async def llm_slot(self):
+        """Limita o número de chamadas de IA em andamento"""
+        self.llm_waiting += 1
+        try:
+            await self._llm_semaphore.acquire()
+        finally:
+            self.llm_waiting -= 1
+        self.llm_in_flight += 1
+        try:
+            yield
+        finally:
+            self.llm_in_flight -= 1
+            self._llm_semaphore.release()
+    
+    def stats(self) -> dict:
+        waits = sorted(self._recent_waits)
+        def percentil(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1) if waits else 0.0
+        return {
+            "queue_depth": self.pending,
+            "max_pending": self.max_pending,
+            "llm_in_flight": self.llm_in_flight,
+            "llm_waiting": self.llm_waiting,
+            "max_llm_concurrency": self.max_llm_concurrency,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "wait_ms": {"p50": percentil(0.5), "p95": percentil(0.95), "max": percentil(1.0)},
+            "chats": {
+                chat_id: {
+                    "waiting": self._chat_waiting.get(chat_id, 0),
+                    "last_wait_ms": round(self._chat_last_wait.get(chat_id, 0.0) * 1000, 1)
+                }
+                for chat_id in self._chat_locks
+            }
+        }
+
+message_pipeline = MessagePipeline(MAX_LLM_CONCURRENCY, MAX_PENDING_MESSAGES)
+
+# Rajadas ("oi", "quero pedir", "tem combo?") viram uma única chamada de IA:
+# cada mensagem espera COALESCE_WINDOW segundos; se outra do mesmo chat chegar
+# nesse meio tempo, a anterior sai sem resposta e a última responde por todas.
+# Orçamento do webhook /api/webhook/message: até COALESCE_MAX_WAIT de agrupamento
+# + LLM_QUEUE_MAX_WAIT na fila de cota + ROUTER_MAX_ATTEMPTS x ROUTER_ATTEMPT_TIMEOUT
+# (padrões: 6 + 30 + 3 x 30 = 126s). O timeout do bot.js (MESSAGE_WEBHOOK_TIMEOUT_MS,
+# 150s) tem de ficar acima disso, senão a resposta é registrada e nunca enviada.
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", 1.5))  # 0 = desligado
+COALESCE_MAX_WAIT = float(os.getenv("COALESCE_MAX_WAIT", 6))
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", 8))
+
+class MessageCoalescer:
+    def __init__(self, window: float, max_wait: float, max_messages: int):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self._lotes: Dict[str, dict] = {}
+        self.received = 0
+        self.batches = 0
+        self.coalesced = 0
+        self.largest_batch = 0
+    
+    async def submit(self, chat_id: str, mensagem: str, ordem: Optional[tuple] = None) -> Optional[str]:
+        """Texto combinado do lote se esta mensagem fechou o lote; None se foi absorvida.
+        
+        ordem: posição da mensagem no WhatsApp; o bot envia em paralelo e a
+        chegada pode vir trocada, então o texto é montado por ela.
+        """
+        self.received += 1
+        if self.window <= 0:
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, 1)
+            return mensagem
+        
+        agora = time.monotonic()
+        lote = self._lotes.get(chat_id)
+        if lote is None:
+            lote = {"textos": [], "inicio": agora, "versao": 0}
+            self._lotes[chat_id] = lote
+        lote["textos"].append((ordem, mensagem))
+        lote["versao"] += 1
+        minha_versao = lote["versao"]
+        
+        # A janela reinicia a cada mensagem, mas o lote nunca espera mais que max_wait
+        espera = min(self.window, lote["inicio"] + self.max_wait - agora)
+        if len(lote["textos"]) < self.max_messages and espera > 0:
+            await asyncio.sleep(espera)
+        
+        if lote["versao"] != minha_versao:
+            self.coalesced += 1
+            return None
+        
+        if self._lotes.get(chat_id) is lote:
+            del self._lotes[chat_id]
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(lote["textos"]))
+        textos = lote["textos"]
+        if all(ordem is not None for ordem, _ in textos):
+            textos = sorted(textos, key=lambda item: item[0])
+        return "\n".join(texto for _, texto in textos)
+    
+    def has_pending(self, chat_id: str) -> bool:
+        return chat_id in self._lotes
+    
+    def stats(self) -> dict:
+        return {
+            "window_seconds": self.window,
+            "max_wait_seconds": self.max_wait,
+            "max_messages": self.max_messages,
+            "received": self.received,
+            "batches": self.batches,
+            "llm_calls_saved": self.coalesced,
+            "avg_batch_size": round(self.received / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "open_batches": len(self._lotes)
+        }
+
+message_coalescer = MessageCoalescer(COALESCE_WINDOW, COALESCE_MAX_WAIT, COALESCE_MAX_MESSAGES)
+
+# ==================== PERSISTÊNCIA ====================
+# Write-behind: o webhook só marca o que mudou; uma task grava tudo em lote a
+# cada STORAGE_FLUSH_INTERVAL segundos numa única transação, fora do event loop.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+DB_FILE = Path(os.getenv("DB_FILE", str(Path(__file__).parent / "conversas.db")))
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", 1.0))
+STORAGE_PRELOAD_HOURS = float(os.getenv("STORAGE_PRELOAD_HOURS", 24))
+STORAGE_MESSAGES_LOAD_LIMIT = int(os.getenv("STORAGE_MESSAGES_LOAD_LIMIT", os.getenv("MAX_MESSAGES_IN_MEMORY", 200)))
+
+class ConversationStore:
+    """Persistência de conversas - implementação em memória (não grava nada)"""
+    persistent = False
+    
+    async def start(self):
+        pass
+    
+    async def close(self):
+        pass
+    
+    async def flush(self):
+        pass
+    
+    def has_conversa(self, chat_id: str) -> bool:
+        return False
+    
+    async def load_conversa(self, chat_id: str) -> Optional[Dict]:
+        return None
+    
+    async def load_recent(self, since: float, limit: int) -> List[Dict]:
+        return []
+    
+    async def load_messages(self, chat_id: str, before: Optional[str], limit: int) -> List[dict]:
+        return []
+    
+    def mark_dirty(self, chat_id: str):
+        pass
+    
+    def is_dirty(self, chat_id: str) -> bool:
+        return False
+    
+    def add_message(self, chat_id: str, msg: dict):
+        pass
+    
+    def update_message_status(self, chat_id: str, message_id: str, status: str, whatsapp_id: Optional[str]):
+        pass
+    
+    def delete_conversa(self, chat_id: str):
+        pass
+    
+    def clear(self):
+        pass
+    
+    def note_remote(self, chat_id: Optional[str], exists: bool = True):
+        pass
+    
+    async def export_chunks(self, chat_ids: Optional[List[str]], desde: str, ate: str, tamanho: int):
+        """Registros (tipo, chat_id, timestamp, dados em JSON) em blocos de até `tamanho`"""
+        bloco = []
+        for chat_id in sorted(chat_ids or conversas):
+            conversa = conversas.get(chat_id)
+            if conversa is None:
+                continue
+            mensagens = [m for m in conversa["mensagens"] if desde <= m["timestamp"] < ate]
+            if (desde or ate != FIM_EXPORT) and not mensagens:
+                continue
+            estado = {k: v for k, v in conversa.items() if k != "mensagens"}
+            bloco.append(("conversa", chat_id, ultima_atividade(conversa), json.dumps(estado, ensure_ascii=False)))
+            bloco.extend(("mensagem", chat_id, m["timestamp"], m.to_json()) for m in mensagens)
+            if len(bloco) >= tamanho:
+                yield bloco
+                bloco = []
+        if bloco:
+            yield bloco
+    
+    async def import_batch(self, novos: List[str], estados: List[tuple], mensagens: List[tuple], mesclar: bool):
+        """Aplica um lote importado; sem banco, direto nas conversas em memória"""
+        for chat_id, estado, _ in estados:
+            if mesclar and chat_id in conversas:
+                continue
+            conversa = nova_conversa(chat_id)
+            conversa.update(estado)
+            conversas[chat_id] = conversa
+        alteradas = set()
+        for chat_id, msg in mensagens:
+            conversa = conversas.get(chat_id)
+            if conversa is None:
+                continue
+            if mesclar and any(m.ts == msg.ts for m in conversa["mensagens"]):
+                continue
+            conversa["mensagens"].append(msg)
+            alteradas.add(chat_id)
+        for chat_id in alteradas:
+            conversas[chat_id]["mensagens"].sort(key=lambda m: m.ts)
+            memory_manager.trim_messages(conversas[chat_id])
+    
+    def stats(self) -> dict:
+        return {"backend": "memory"}
+
+class SQLiteStore(ConversationStore):
+    """Persistência em SQLite (WAL) com gravação em lote"""
+    persistent = True
+    
+    def __init__(self, path: Path, flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        # Conexão única usada sempre pela mesma thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._db = None
+        self._known_ids: set = set()
+        self._dirty: set = set()
+        self._pending_messages: List[tuple] = []
+        self._pending_status: List[tuple] = []
+        self._deleted: set = set()
+        self._clear_all = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_ms = 0.0
+    
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    def _open(self) -> set:
+        import sqlite3
+        self._db = sqlite3.connect(str(self.path))
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS conversas (
+                chat_id TEXT PRIMARY KEY,
+                estado TEXT NOT NULL,
+                atualizado_em REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_conversas_atualizado ON conversas (atualizado_em);
+            CREATE TABLE IF NOT EXISTS mensagens (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                dados TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_mensagens_chat_ts ON mensagens (chat_id, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_mensagens_ts ON mensagens (timestamp);
+        """)
+        # Bancos anteriores ao analytics: estado do funil numa coluna à parte
+        colunas = {row[1] for row in self._db.execute("PRAGMA table_info(conversas)")}
+        if "funil" not in colunas:
+            self._db.execute("ALTER TABLE conversas ADD COLUMN funil TEXT")
+        return {row[0] for row in self._db.execute("SELECT chat_id FROM conversas")}
+    
+    async def start(self):
+        self._known_ids = await self._run(self._open)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+    
+    async def close(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        if self._db is not None:
+            await self.flush()
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
+    
+    def has_conversa(self, chat_id: str) -> bool:
+        return chat_id in self._known_ids
+    
+    def _read_conversa(self, chat_id: str) -> Optional[Dict]:
+        row = self._db.execute("SELECT estado, funil FROM conversas WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        conversa = json.loads(row[0])
+        if row[1]:
+            conversa["funil"] = json.loads(row[1])
+        conversa["mensagens"] = self._read_messages(chat_id, None, STORAGE_MESSAGES_LOAD_LIMIT)
+        return conversa
+    
+    def _read_recent_ids(self, since: float, limit: int) -> List[str]:
+        rows = self._db.execute(
+            "SELECT chat_id FROM conversas WHERE atualizado_em >= ? ORDER BY atualizado_em DESC LIMIT ?",
+            (since, limit)
+        ).fetchall()
+        return [r[0] for r in rows]
+    
+    def _read_messages(self, chat_id: str, before: Optional[str], limit: int) -> List[dict]:
+        if before is None:
+            rows = self._db.execute(
+                "SELECT dados FROM mensagens WHERE chat_id = ? ORDER BY timestamp DESC, seq DESC LIMIT ?",
+                (chat_id, limit)
+            ).fetchall()
+        else:
+            rows = self._db.execute(
+                "SELECT dados FROM mensagens WHERE chat_id = ? AND timestamp < ? ORDER BY timestamp DESC, seq DESC LIMIT ?",
+                (chat_id, before, limit)
+            ).fetchall()
+        return [json.loads(r[0]) for r in reversed(rows)]
+    
+    async def load_messages(self, chat_id: str, before: Optional[str], limit: int) -> List[dict]:
+        if self._db is None or chat_id not in self._known_ids:
+            return []
+        return await self._run(self._read_messages, chat_id, before, limit)
+    
+    async def load_conversa(self, chat_id: str) -> Optional[Dict]:
+        if self._db is None or chat_id not in self._known_ids:
+            return None
+        return await self._run(self._read_conversa, chat_id)
+    
+    async def load_recent(self, since: float, limit: int) -> List[Dict]:
+        if self._db is None:
+            return []
+        resultado = []
+        for chat_id in await self._run(self._read_recent_ids, since, limit):
+            conversa = await self._run(self._read_conversa, chat_id)
+            if conversa is not None:
+                resultado.append(conversa)
+        return resultado
+    
+    def mark_dirty(self, chat_id: str):
+        self._dirty.add(chat_id)
+        self._known_ids.add(chat_id)
+    
+    def is_dirty(self, chat_id: str) -> bool:
+        return chat_id in self._dirty
+    
+    def add_message(self, chat_id: str, msg: dict):
+        dados = msg.to_json() if isinstance(msg, Mensagem) else json.dumps(msg, ensure_ascii=False)
+        self._pending_messages.append((chat_id, msg.get("timestamp", ""), dados))
+        self.mark_dirty(chat_id)
+    
+    def update_message_status(self, chat_id: str, message_id: str, status: str, whatsapp_id: Optional[str]):
+        """Estado final de entrega; aplicado no flush depois dos INSERTs do mesmo lote"""
+        self._pending_status.append((status, whatsapp_id, chat_id, message_id))
+    
+    def delete_conversa(self, chat_id: str):
+        self._dirty.discard(chat_id)
+        self._known_ids.discard(chat_id)
+        self._pending_messages = [m for m in self._pending_messages if m[0] != chat_id]
+        self._deleted.add(chat_id)
+    
+    def clear(self):
+        self._dirty.clear()
+        self._known_ids.clear()
+        self._pending_messages = []
+        self._pending_status = []
+        self._deleted.clear()
+        self._clear_all = True
+    
+    def note_remote(self, chat_id: Optional[str], exists: bool = True):
+        """Outro worker criou ou apagou conversa(s) no mesmo banco (chat_id None = todas)"""
+        if exists:
+            self._known_ids.add(chat_id)
+        elif chat_id is None:
+            self._known_ids.clear()
+            self._dirty.clear()
+            self._pending_messages = []
+        else:
+            self._known_ids.discard(chat_id)
+            self._dirty.discard(chat_id)
+            self._pending_messages = [m for m in self._pending_messages if m[0] != chat_id]
+    
+    def _export_conversas(self, depois: str, chat_ids: Optional[List[str]], desde: str, ate: str, limite: int) -> list:
+        sql = "SELECT chat_id, estado, atualizado_em FROM conversas WHERE chat_id > ?"
+        params: list = [depois]
+        if chat_ids:
+            sql += f" AND chat_id IN ({','.join('?' * len(chat_ids))})"
+            params += chat_ids
+        if desde or ate != FIM_EXPORT:
+            sql += (" AND EXISTS (SELECT 1 FROM mensagens m WHERE m.chat_id = conversas.chat_id"
+                    " AND m.timestamp >= ? AND m.timestamp < ?)")
+            params += [desde, ate]
+        return self._db.execute(sql + " ORDER BY chat_id LIMIT ?", (*params, limite)).fetchall()
+    
+    def _export_mensagens(self, chat_id: str, depois: tuple, ate: str, limite: int) -> list:
+        # Paginação por (timestamp, seq): cada página é uma consulta curta no índice, sem cursor aberto
+        return self._db.execute(
+            "SELECT timestamp, seq, dados FROM mensagens WHERE chat_id = ? AND (timestamp, seq) > (?, ?) "
+            "AND timestamp < ? ORDER BY timestamp, seq LIMIT ?",
+            (chat_id, *depois, ate, limite)
+        ).fetchall()
+    
+    async def export_chunks(self, chat_ids: Optional[List[str]], desde: str, ate: str, tamanho: int):
+        if self._db is None:
+            return
+        bloco = []
+        depois = ""
+        while True:
+            linhas = await self._run(self._export_conversas, depois, chat_ids, desde, ate, tamanho)
+            for chat_id, estado, atualizado_em in linhas:
+                bloco.append(("conversa", chat_id, datetime.fromtimestamp(atualizado_em).isoformat(), estado))
+                cursor = (desde, 0)
+                while True:
+                    pagina = await self._run(self._export_mensagens, chat_id, cursor, ate, tamanho)
+                    bloco.extend(("mensagem", chat_id, ts, dados) for ts, _, dados in pagina)
+                    if len(bloco) >= tamanho:
+                        yield bloco
+                        bloco = []
+                    if len(pagina) < tamanho:
+                        break
+                    cursor = pagina[-1][:2]
+            if len(linhas) < tamanho:
+                break
+            depois = linhas[-1][0]
+        if bloco:
+            yield bloco
+    
+    def _import_batch(self, novos: list, estados: list, mensagens: list, mesclar: bool):
+        with self._db:
+            if novos and not mesclar:
+                self._db.executemany("DELETE FROM mensagens WHERE chat_id = ?", [(c,) for c in novos])
+            if estados:
+                # Ao mesclar, o estado mais recente (atualizado_em) vence
+                self._db.executemany(
+                    "INSERT INTO conversas (chat_id, estado, atualizado_em) VALUES (?, ?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET estado = excluded.estado, atualizado_em = excluded.atualizado_em"
+                    + (" WHERE excluded.atualizado_em > conversas.atualizado_em" if mesclar else ""),
+                    estados
+                )
+            if mensagens and mesclar:
+                # Mesma conversa e mesmo horário (µs) = mensagem já existente
+                self._db.executemany(
+                    "INSERT INTO mensagens (chat_id, timestamp, dados) SELECT ?1, ?2, ?3 "
+                    "WHERE NOT EXISTS (SELECT 1 FROM mensagens WHERE chat_id = ?1 AND timestamp = ?2)",
+                    mensagens
+                )
+            elif mensagens:
+                self._db.executemany(
+                    "INSERT INTO mensagens (chat_id, timestamp, dados) VALUES (?, ?, ?)",
+                    mensagens
+                )
+    
+    async def import_batch(self, novos: List[str], estados: List[tuple], mensagens: List[tuple], mesclar: bool):
+        if self._db is None:
+            return
+        linhas_estado = [(c, json.dumps(e, ensure_ascii=False), t) for c, e, t in estados]
+        linhas_mensagem = [(c, m["timestamp"], m.to_json()) for c, m in mensagens]
+        await self._run(self._import_batch, novos, linhas_estado, linhas_mensagem, mesclar)
+        importados = {chat_id for chat_id, _, _ in estados}
+        for chat_id in importados:
+            # O que estava em memória fica velho: não pode sobrescrever o importado no próximo flush
+            self._known_ids.add(chat_id)
+            self._dirty.discard(chat_id)
+        self._pending_messages = [m for m in self._pending_messages if m[0] not in importados]
+        self.rows_written += len(linhas_estado) + len(linhas_mensagem)
+    
+    def _write_batch(self, clear_all: bool, deleted: list, estados: list, mensagens: list, status: list):
+        # Codifica aqui, na thread do banco: o json.dumps de cada estado não pesa no event loop
+        estados = [
+            (chat_id, json.dumps(estado, ensure_ascii=False), json.dumps(funil) if funil else None, agora)
+            for chat_id, estado, funil, agora in estados
+        ]
+        with self._db:
+            if clear_all:
+                self._db.execute("DELETE FROM mensagens")
+                self._db.execute("DELETE FROM conversas")
+            if deleted:
+                self._db.executemany("DELETE FROM mensagens WHERE chat_id = ?", [(c,) for c in deleted])
+                self._db.executemany("DELETE FROM conversas WHERE chat_id = ?", [(c,) for c in deleted])
+            if estados:
+                self._db.executemany(
+                    "INSERT INTO conversas (chat_id, estado, funil, atualizado_em) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET estado = excluded.estado, funil = excluded.funil, "
+                    "atualizado_em = excluded.atualizado_em",
+                    estados
+                )
+            if mensagens:
+                self._db.executemany(
+                    "INSERT INTO mensagens (chat_id, timestamp, dados) VALUES (?, ?, ?)",
+                    mensagens
+                )
+            if status:
+                self._db.executemany(
+                    "UPDATE mensagens SET dados = json_set(dados, '$.status', ?, '$.whatsapp_id', ?) "
+                    "WHERE chat_id = ? AND json_extract(dados, '$.id') = ?",
+                    status
+                )
+    
+    async def flush(self):
+        """Grava em uma transação tudo que mudou desde o último flush"""
+        if self._db is None:
+            return
+        if not (self._clear_all or self._deleted or self._dirty or self._pending_messages or self._pending_status):
+            return
+        
+        clear_all, self._clear_all = self._clear_all, False
+        deleted, self._deleted = list(self._deleted), set()
+        dirty, self._dirty = self._dirty, set()
+        mensagens, self._pending_messages = self._pending_messages, []
+        status, self._pending_status = self._pending_status, []
+        
+        agora = time.time()
+        estados = []
+        for chat_id in dirty:
+            conversa = conversas.get(chat_id)
+            if conversa is None:
+                continue
+            # Cópia rasa das listas/dicts: o event loop pode mexer na conversa durante a gravação
+            estado = {
+                k: list(v) if isinstance(v, list) else dict(v) if isinstance(v, dict) else v
+                for k, v in conversa.items() if k != "mensagens"
+            }
+            funil = conversa.funil and {**conversa.funil, "etapas": list(conversa.funil["etapas"])}
+            estados.append((chat_id, estado, funil, agora))
+        
+        inicio = time.monotonic()
+        try:
+            await self._run(self._write_batch, clear_all, deleted, estados, mensagens, status)
+        except Exception as e:
+            print(f"Erro ao gravar conversas: {e}")
+            # Devolve tudo para a próxima tentativa (inclusive exclusões e o clear)
+            self._pending_messages = mensagens + self._pending_messages
+            self._pending_status = status + self._pending_status
+            self._dirty |= dirty
+            self._deleted |= set(deleted)
+            self._clear_all = self._clear_all or clear_all
+            return
+        self.flushes += 1
+        self.rows_written += len(estados) + len(mensagens) + len(status)
+        self.last_flush_ms = round((time.monotonic() - inicio) * 1000, 2)
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Erro no flush de conversas: {e}")
+    
+    def stats(self) -> dict:
+        return {
+            "backend": "sqlite",
+            "file": str(self.path),
+            "known_conversas": len(self._known_ids),
+            "pending_conversas": len(self._dirty),
+            "pending_messages": len(self._pending_messages),
+            "pending_status_updates": len(self._pending_status),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "last_flush_ms": self.last_flush_ms
+        }
+
+def create_store() -> ConversationStore:
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStore(DB_FILE, STORAGE_FLUSH_INTERVAL)
+    return ConversationStore()
+
+conversation_store = create_store()
+
+async def preload_recent_conversas():
+    """Carrega em segundo plano as conversas ativas nas últimas STORAGE_PRELOAD_HOURS"""
+    since = time.time() - STORAGE_PRELOAD_HOURS * 3600
+    for salva in await conversation_store.load_recent(since, MAX_CONVERSAS_IN_MEMORY):
+        if len(conversas) >= MAX_CONVERSAS_IN_MEMORY:
+            break
+        if salva["chat_id"] not in conversas:
+            conversa = nova_conversa(salva["chat_id"])
+            conversa.update(salva)
+            conversas[salva["chat_id"]] = conversa
+            snapshots.invalidate(salva["chat_id"])
+
+# ==================== EXPORTAÇÃO / IMPORTAÇÃO ====================
+# Conversas saem do banco em blocos (paginação por chave, sem carregar tudo) e
+# viram JSONL (gzip opcional) ou Parquet, escritos aos poucos na resposta. Cada
+# registro é (tipo, chat_id, timestamp, dados): primeiro a conversa, depois as
+# mensagens dela em ordem. A importação lê o mesmo formato em streaming e grava
+# em lotes; também serve para restaurar um backup na subida (IMPORT_ON_STARTUP).
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 1000))
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", 2000))
+IMPORT_ON_STARTUP = os.getenv("IMPORT_ON_STARTUP", "")
+EXPORT_FORMATO = "sushiaki-conversas"
+EXPORT_VERSAO = 1
+COLUNAS_EXPORT = ("tipo", "chat_id", "timestamp", "dados")
+# Maior que qualquer timestamp ISO: "até" sem limite
+FIM_EXPORT = "\uffff"
+
+def _importar_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("formato parquet requer o pacote pyarrow (pip install 'pyarrow>=14')")
+    return pyarrow, pyarrow.parquet
+
+def parquet_disponivel() -> bool:
+    try:
+        _importar_pyarrow()
+    except RuntimeError:
+        return False
+    return True
+
+def normalizar_periodo(desde: Optional[str], ate: Optional[str]) -> tuple:
+    """Limites ISO no mesmo formato gravado nas mensagens (comparáveis como texto)"""
+    return (
+        ts_para_iso(iso_para_ts(desde)) if desde else "",
+        ts_para_iso(iso_para_ts(ate)) if ate else FIM_EXPORT
+    )
+
+class JsonlExportWriter:
+    def __init__(self, compactar: bool, filtros: dict):
+        self._zip = zlib.compressobj(6, zlib.DEFLATED, 31) if compactar else None
+        self.extensao = "jsonl.gz" if compactar else "jsonl"
+        self.media_type = "application/gzip" if compactar else "application/x-ndjson"
+        self._cabecalho = json.dumps({
+            "tipo": "cabecalho",
+            "formato": EXPORT_FORMATO,
+            "versao": EXPORT_VERSAO,
+            "gerado_em": datetime.now().isoformat(),
+            "filtros": filtros
+        }, ensure_ascii=False) + "\n"
+    
+    def _saida(self, texto: str) -> bytes:
+        dados = texto.encode("utf-8", "surrogatepass")
+        return self._zip.compress(dados) if self._zip else dados
+    
+    def escrever(self, bloco: List[tuple]) -> bytes:
+        # dados já vem em JSON do banco: entra na linha sem decodificar de novo
+        texto = "".join(
+            f'{{"tipo":"{tipo}","chat_id":{_encode_str(chat_id)},"timestamp":{_encode_str(ts)},"dados":{dados}}}\n'
+            for tipo, chat_id, ts, dados in bloco
+        )
+        if self._cabecalho:
+            texto, self._cabecalho = self._cabecalho + texto, None
+        return self._saida(texto)
+    
+    def fechar(self) -> bytes:
+        final = self._saida(self._cabecalho or "")
+        return (final + self._zip.flush()) if self._zip else final
+
+class _SaidaEmPartes:
+    """Arquivo só de escrita que guarda os bytes até serem drenados (Parquet em streaming)"""
+    closed = False
+    
+    def __init__(self):
+        self._partes: List[bytes] = []
+        self._posicao = 0
+    
+    def write(self, dados) -> int:
+        dados = bytes(dados)
+        self._partes.append(dados)
+        self._posicao += len(dados)
+        return len(dados)
+    
+    def tell(self) -> int:
+        return self._posicao
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+    
+    def drenar(self) -> bytes:
+        dados, self._partes = b"".join(self._partes), []
+        return dados
+
+class ParquetExportWriter:
+    extensao = "parquet"
+    media_type = "application/vnd.apache.parquet"
+    
+    def __init__(self, filtros: dict):
+        self._pa, pq = _importar_pyarrow()
+        self._schema = self._pa.schema(
+            [(coluna, self._pa.string()) for coluna in COLUNAS_EXPORT],
+            metadata={
+                "formato": EXPORT_FORMATO,
+                "versao": str(EXPORT_VERSAO),
+                "filtros": json.dumps(filtros, ensure_ascii=False)
+            }
+        )
+        self._saida = _SaidaEmPartes()
+        # Cada bloco vira um row group; o rodapé só sai no fechar()
+        self._writer = pq.ParquetWriter(self._pa.PythonFile(self._saida, mode="w"), self._schema)
+    
+    def escrever(self, bloco: List[tuple]) -> bytes:
+        colunas = [self._pa.array(valores, type=self._pa.string()) for valores in zip(*bloco)]
+        self._writer.write_table(self._pa.Table.from_arrays(colunas, schema=self._schema))
+        return self._saida.drenar()
+    
+    def fechar(self) -> bytes:
+        self._writer.close()
+        return self._saida.drenar()
+
+def criar_export_writer(formato: str, filtros: dict):
+    if formato in ("jsonl.gz", "gz"):
+        return JsonlExportWriter(True, filtros)
+    if formato == "jsonl":
+        return JsonlExportWriter(False, filtros)
+    if formato == "parquet":
+        return ParquetExportWriter(filtros)
+    raise ValueError(f"formato desconhecido: {formato} (use jsonl.gz, jsonl ou parquet)")
+
+async def exportar_conversas(writer, chat_ids: Optional[List[str]], desde: str, ate: str):
+    """Bytes do arquivo exportado, bloco a bloco (memória limitada a EXPORT_CHUNK_ROWS registros)"""
+    # O que ainda está só na memória entra no banco antes da leitura
+    await conversation_store.flush()
+    async for bloco in conversation_store.export_chunks(chat_ids, desde, ate, EXPORT_CHUNK_ROWS):
+        dados = writer.escrever(bloco)
+        if dados:
+            yield dados
+    dados = writer.fechar()
+    if dados:
+        yield dados
+
+def _registro_jsonl(linha: bytes) -> Optional[tuple]:
+    linha = linha.strip()
+    if not linha:
+        return None
+    try:
+        registro = json.loads(linha)
+        tipo = registro.get("tipo")
+    except (ValueError, AttributeError):
+        return ("invalido", None, None, None)
+    if tipo == "cabecalho":
+        if registro.get("formato") != EXPORT_FORMATO:
+            raise ValueError("arquivo não é uma exportação de conversas")
+        return None
+    return (tipo, registro.get("chat_id"), registro.get("timestamp"), registro.get("dados"))
+
+async def ler_jsonl(partes):
+    """Registros de um JSONL (gzip detectado pelo cabeçalho) que chega em pedaços de bytes"""
+    descompactar = None
+    inicio = True
+    resto = b""
+    async for parte in partes:
+        if inicio:
+            resto += parte
+            if len(resto) < 2:
+                continue
+            parte, resto, inicio = resto, b"", False
+            if parte[:2] == b"\x1f\x8b":
+                descompactar = zlib.decompressobj(47)
+        if descompactar is not None:
+            parte = descompactar.decompress(parte)
+        *linhas, resto = (resto + parte).split(b"\n")
+        for linha in linhas:
+            registro = _registro_jsonl(linha)
+            if registro is not None:
+                yield registro
+    if descompactar is not None:
+        resto += descompactar.flush()
+    for linha in resto.split(b"\n"):
+        registro = _registro_jsonl(linha)
+        if registro is not None:
+            yield registro
+
+async def ler_parquet(arquivo):
+    """Registros de um Parquet exportado (precisa de arquivo com seek)"""
+    _, pq = _importar_pyarrow()
+    parquet = pq.ParquetFile(arquivo)
+    metadados = parquet.schema_arrow.metadata or {}
+    if metadados.get(b"formato") != EXPORT_FORMATO.encode():
+        raise ValueError("arquivo não é uma exportação de conversas")
+    lotes = parquet.iter_batches(batch_size=IMPORT_BATCH_ROWS, columns=list(COLUNAS_EXPORT))
+    loop = asyncio.get_running_loop()
+    while True:
+        lote = await loop.run_in_executor(None, next, lotes, None)
+        if lote is None:
+            break
+        colunas = lote.to_pydict()
+        for registro in zip(*(colunas[c] for c in COLUNAS_EXPORT)):
+            yield registro
+
+class ConversationImporter:
+    """Aplica registros exportados no store, em lotes de IMPORT_BATCH_ROWS.
+    
+    Sem mesclar, cada conversa do arquivo substitui a do banco (estado e
+    histórico); mesclando, entram só mensagens que faltam e o estado mais novo.
+    """
+    def __init__(self, mesclar: bool = False, tamanho: int = IMPORT_BATCH_ROWS):
+        self.mesclar = mesclar
+        self.tamanho = tamanho
+        self.vistos: set = set()
+        self._novos: List[str] = []
+        self._estados: List[tuple] = []
+        self._mensagens: List[tuple] = []
+        self.conversas = 0
+        self.mensagens = 0
+        self.ignoradas = 0
+        self._inicio = time.monotonic()
+    
+    async def add(self, tipo: str, chat_id: Optional[str], timestamp: Optional[str], dados):
+        try:
+            if isinstance(dados, str):
+                dados = json.loads(dados)
+            if tipo == "conversa" and chat_id:
+                if chat_id not in self.vistos:
+                    self.vistos.add(chat_id)
+                    self._novos.append(chat_id)
+                estado = {k: v for k, v in dados.items() if k != "mensagens"}
+                estado["chat_id"] = chat_id
+                atualizado_em = iso_para_ts(timestamp) / 1_000_000 if timestamp else time.time()
+                self._estados.append((chat_id, estado, atualizado_em))
+            elif tipo == "mensagem" and chat_id in self.vistos:
+                self._mensagens.append((chat_id, Mensagem.from_dict(dados)))
+            else:
+                self.ignoradas += 1
+                return
+        except (ValueError, TypeError, AttributeError):
+            self.ignoradas += 1
+            return
+        if len(self._estados) + len(self._mensagens) >= self.tamanho:
+            await self.flush()
+    
+    async def add_all(self, registros):
+        async for registro in registros:
+            await self.add(*registro)
+        await self.flush()
+    
+    async def flush(self):
+        if not (self._estados or self._mensagens):
+            return
+        novos, estados, mensagens = self._novos, self._estados, self._mensagens
+        self._novos, self._estados, self._mensagens = [], [], []
+        await conversation_store.import_batch(novos, estados, mensagens, self.mesclar)
+        self.conversas += len(estados)
+        self.mensagens += len(mensagens)
+        for chat_id in {c for c, _, _ in estados} | {c for c, _ in mensagens}:
+            if conversation_store.persistent:
+                # Volta do banco já com o importado quando alguém pedir
+                conversas.pop(chat_id, None)
+                memory_manager.forget(chat_id)
+            snapshots.invalidate(chat_id)
+    
+    def stats(self) -> dict:
+        return {
+            "conversas": self.conversas,
+            "mensagens": self.mensagens,
+            "ignoradas": self.ignoradas,
+            "mesclar": self.mesclar,
+            "segundos": round(time.monotonic() - self._inicio, 3)
+        }
+
+def conversas_importadas(chat_ids: List[str]) -> int:
+    """Avisa painel e outros workers; o painel recarrega a lista inteira (como num clear)"""
+    seq = change_log.record("clear")
+    ws_hub.publish({"type": "conversas_imported", "chat_ids": chat_ids, "seq": seq})
+    if conversation_store.persistent:
+        asyncio.create_task(preload_recent_conversas())
+    return seq
+
+async def importar_na_subida(arquivo: Path):
+    """Restaura um backup na subida, só se o banco ainda estiver vazio"""
+    if not arquivo.exists():
+        print(f"⚠️ IMPORT_ON_STARTUP: {arquivo} não existe")
+        return
+    if conversation_store.persistent and conversation_store.stats().get("known_conversas"):
+        return
+    importador = ConversationImporter()
+    try:
+        if formato_pelo_nome(arquivo.name) == "parquet":
+            await importador.add_all(ler_parquet(str(arquivo)))
+        else:
+            await importador.add_all(ler_jsonl(_ler_arquivo(arquivo)))
+    except (ValueError, RuntimeError) as e:
+        print(f"⚠️ IMPORT_ON_STARTUP: {e}")
+        return
+    change_log.record("clear")
+    print(f"📦 Importado de {arquivo}: {importador.stats()}")
+
+async def _ler_arquivo(arquivo: Path, tamanho: int = 1 << 16):
+    with open(arquivo, "rb") as f:
+        while True:
+            parte = await asyncio.to_thread(f.read, tamanho)
+            if not parte:
+                break
+            yield parte
+
+def formato_pelo_nome(nome: str) -> str:
+    if nome.endswith(".parquet"):
+        return "parquet"
+    return "jsonl.gz" if nome.endswith(".gz") else "jsonl"
+
+def cli_conversas(argv: List[str]) -> int:
+    """python server.py export|import - trabalha direto no DB_FILE"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="server.py",
+        description="Exporta/importa conversas do banco (DB_FILE). Com o servidor no ar, "
+                    "prefira POST /api/import: ele também atualiza a memória dos workers."
+    )
+    comandos = parser.add_subparsers(dest="comando", required=True)
+    exportar = comandos.add_parser("export", help="grava conversas num arquivo")
+    exportar.add_argument("saida", help="arquivo de saída (.jsonl, .jsonl.gz ou .parquet; - = stdout)")
+    exportar.add_argument("--formato", choices=["jsonl.gz", "jsonl", "parquet"], help="padrão: pela extensão")
+    exportar.add_argument("--chat", action="append", dest="chat_ids", help="só este chat_id (pode repetir)")
+    exportar.add_argument("--desde", help="mensagens a partir desta data/hora ISO")
+    exportar.add_argument("--ate", help="mensagens antes desta data/hora ISO")
+    importar = comandos.add_parser("import", help="carrega um arquivo exportado")
+    importar.add_argument("arquivo")
+    importar.add_argument("--mesclar", action="store_true", help="acrescenta só o que falta em vez de substituir")
+    importar.add_argument("--limpar", action="store_true", help="apaga todas as conversas antes")
+    args = parser.parse_args(argv)
+    return asyncio.run(_cli_conversas(args))
+
+async def _cli_conversas(args) -> int:
+    await conversation_store.start()
+    try:
+        if args.comando == "export":
+            formato = args.formato or formato_pelo_nome(args.saida)
+            filtros = {"chat_ids": args.chat_ids, "desde": args.desde, "ate": args.ate}
+            writer = criar_export_writer(formato, filtros)
+            periodo = normalizar_periodo(args.desde, args.ate)
+            saida = sys.stdout.buffer if args.saida == "-" else open(args.saida, "wb")
+            try:
+                async for dados in exportar_conversas(writer, args.chat_ids, *periodo):
+                    saida.write(dados)
+            finally:
+                if saida is not sys.stdout.buffer:
+                    saida.close()
+        else:
+            if args.limpar:
+                conversation_store.clear()
+                await conversation_store.flush()
+            importador = ConversationImporter(mesclar=args.mesclar)
+            arquivo = Path(args.arquivo)
+            if formato_pelo_nome(arquivo.name) == "parquet":
+                await importador.add_all(ler_parquet(str(arquivo)))
+            else:
+                await importador.add_all(ler_jsonl(_ler_arquivo(arquivo)))
+            print(json.dumps(importador.stats(), ensure_ascii=False))
+    except (ValueError, RuntimeError, OSError) as e:
+        print(f"erro: {e}", file=sys.stderr)
+        return 1
+    finally:
+        await conversation_store.close()
+    return 0
+
+# ==================== GERENCIAMENTO DE MEMÓRIA ====================
+# Limita conversas e mensagens em RAM. Conversas ociosas menos usadas saem da
+# memória (ficam só no banco) e voltam sozinhas via obter_conversa().
+MAX_CONVERSAS_IN_MEMORY = int(os.getenv("MAX_CONVERSAS_IN_MEMORY", 1000))
+MAX_MESSAGES_IN_MEMORY = int(os.getenv("MAX_MESSAGES_IN_MEMORY", 200))
+EVICT_IDLE_MINUTES = float(os.getenv("EVICT_IDLE_MINUTES", 30))
+MEMORY_CHECK_INTERVAL = float(os.getenv("MEMORY_CHECK_INTERVAL", 30))
+
+class MemoryManager:
+    def __init__(self, max_conversas: int, max_messages: int, idle_minutes: float):
+        self.max_conversas = max_conversas
+        self.max_messages = max_messages
+        self.idle_seconds = idle_minutes * 60
+        self._last_access: Dict[str, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.evicted = 0
+        self.reloaded = 0
+        self.trimmed_messages = 0
+    
+    def touch(self, chat_id: str):
+        self._last_access[chat_id] = time.monotonic()
+        if len(conversas) > self.max_conversas:
+            self._wakeup.set()
+    
+    def forget(self, chat_id: Optional[str] = None):
+        if chat_id is None:
+            self._last_access.clear()
+        else:
+            self._last_access.pop(chat_id, None)
+    
+    def trim_messages(self, conversa: Dict):
+        excesso = len(conversa["mensagens"]) - self.max_messages
+        if excesso > 0:
+            del conversa["mensagens"][:excesso]
+            self.trimmed_messages += excesso
+    
+    def _evictable(self, chat_id: str, agora: float, exigir_ocioso: bool) -> bool:
+        conversa = conversas.get(chat_id)
+        if conversa is None or conversa.get("humano_ativo"):
+            return False
+        if message_pipeline.is_busy(chat_id) or message_coalescer.has_pending(chat_id):
+            return False
+        if exigir_ocioso and agora - self._last_access.get(chat_id, 0) < self.idle_seconds:
+            return False
+        return True
+    
+    async def evict(self):
+        """Tira da memória as conversas ociosas menos usadas"""
+        if not conversation_store.persistent:
+            return
+        agora = time.monotonic()
+        por_acesso = sorted(conversas, key=lambda c: self._last_access.get(c, 0))
+        excesso = len(conversas) - self.max_conversas
+        candidatos = []
+        for chat_id in por_acesso:
+            # Acima do limite: despeja as LRU mesmo sem o tempo mínimo de ociosidade
+            acima_do_limite = len(candidatos) < excesso
+            if self._evictable(chat_id, agora, exigir_ocioso=not acima_do_limite):
+                candidatos.append(chat_id)
+        if not candidatos:
+            return
+        
+        # Garante que tudo está no disco antes de soltar da memória
+        await conversation_store.flush()
+        for chat_id in candidatos:
+            if conversation_store.is_dirty(chat_id) or not self._evictable(chat_id, agora, exigir_ocioso=False):
+                continue
+            conversas.pop(chat_id, None)
+            snapshots.invalidate(chat_id)
+            self._last_access.pop(chat_id, None)
+            self.evicted += 1
+    
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=MEMORY_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.evict()
+            except Exception as e:
+                print(f"Erro ao liberar memória: {e}")
+    
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+    
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+    
+    def stats(self) -> dict:
+        total_mensagens = 0
+        total_bytes = 0
+        for conversa in conversas.values():
+            total_mensagens += len(conversa["mensagens"])
+            total_bytes += sum(len(m.get("text") or "") for m in conversa["mensagens"])
+            total_bytes += sum(len(h["content"]) for h in conversa["historico_ia"])
+        return {
+            "conversas_in_memory": len(conversas),
+            "max_conversas": self.max_conversas,
+            "messages_in_memory": total_mensagens,
+            "max_messages_per_conversa": self.max_messages,
+            "text_bytes": total_bytes,
+            "rss_bytes": get_rss_bytes(),
+            "evicted": self.evicted,
+            "reloaded": self.reloaded,
+            "trimmed_messages": self.trimmed_messages,
+            "eviction_enabled": conversation_store.persistent
+        }
+
+def get_rss_bytes() -> Optional[int]:
+    """Memória residente do processo (Linux via /proc, senão pico via resource)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return None
+
+memory_manager = MemoryManager(MAX_CONVERSAS_IN_MEMORY, MAX_MESSAGES_IN_MEMORY, EVICT_IDLE_MINUTES)
+
+# ==================== SINCRONIZAÇÃO INCREMENTAL ====================
+# Toda mudança em conversa ganha um número de sequência. O painel guarda o
+# último seq que viu e pede só o que mudou depois dele (/api/sync).
+CHANGELOG_SIZE = int(os.getenv("CHANGELOG_SIZE", 5000))
+SYNC_MAX_EVENTS = int(os.getenv("SYNC_MAX_EVENTS", 500))
+
+class ChangeLog:
+    def __init__(self, maxlen: int):
+        # Muda a cada reinício: cursores antigos forçam o painel a recarregar tudo
+        self.epoch = f"{int(time.time() * 1000):x}"
+        self.seq = 0
+        self._events = deque(maxlen=maxlen)
+    
+    def record(self, tipo: str, chat_id: Optional[str] = None, message: Optional[dict] = None) -> int:
+        self.seq += 1
+        self._events.append((self.seq, tipo, chat_id, message))
+        return self.seq
+    
+    def since(self, seq: int, limit: int) -> Optional[List[tuple]]:
+        """Eventos com seq > seq, ou None se o cursor não puder ser atendido (reset)"""
+        if seq > self.seq:
+            return None
+        if not self._events or seq == self.seq:
+            return []
+        primeiro = self._events[0][0]
+        if seq < primeiro - 1:
+            return None
+        eventos = list(islice(self._events, seq - primeiro + 1, seq - primeiro + 1 + limit))
+        if any(tipo == "clear" for _, tipo, _, _ in eventos):
+            return None
+        return eventos
+
+change_log = ChangeLog(CHANGELOG_SIZE)
+
+def resumo_conversa(conversa: Dict) -> dict:
+    """Resumo leve de uma conversa para a lista do painel"""
+    mensagens = conversa["mensagens"]
+    return {
+        "chat_id": conversa["chat_id"],
+        "nome_cliente": conversa["nome_cliente"],
+        "humano_ativo": conversa["humano_ativo"],
+        "modo_humanizado": conversa["modo_humanizado"],
+        "mensagem_inicial_enviada": conversa["mensagem_inicial_enviada"],
+        "ultimo_humano": conversa["ultimo_humano"],
+        "criado_em": conversa["criado_em"],
+        "nao_lidas": conversa.get("nao_lidas", 0),
+        "ultima_mensagem": mensagens[-1] if mensagens else None
+    }
+
+def ultima_atividade(conversa: Dict) -> str:
+    mensagens = conversa["mensagens"]
+    return mensagens[-1]["timestamp"] if mensagens else conversa["criado_em"]
+
+# ==================== SNAPSHOTS DE LEITURA ====================
+# As rotas de leitura do painel devolvem JSON já codificado (bytes) com ETag.
+# Toda mutação de conversa passa por conversa_alterada/registrar_mensagem,
+# que invalidam só aquele chat. A próxima leitura recodifica o chat de uma vez,
+# sem await no meio, então nunca vê uma alteração pela metade. A lista inteira
+# é a concatenação dos bytes já prontos. Com o ETag igual, a resposta é 304.
+
+def _json_bytes(obj) -> bytes:
+    if isinstance(obj, (Conversa, Mensagem)):
+        return obj.to_json().encode("utf-8")
+    return _valor_json(obj).encode("utf-8")
+
+class ConversationSnapshots:
+    def __init__(self):
+        self.versao = 0
+        self.status_rev = 0
+        self._completa: Dict[str, bytes] = {}
+        self._resumo: Dict[str, bytes] = {}
+        self._versao_chat: Dict[str, int] = {}
+        self._lista: Optional[tuple] = None     # (chave, corpo, etag)
+        self._resumos: Optional[tuple] = None   # (versao, "[...]")
+        self._status: Optional[tuple] = None    # (chave, corpo, etag)
+        self.encodes = 0
+        self.hits = 0
+        self.not_modified = 0
+    
+    def invalidate(self, chat_id: str):
+        self.versao += 1
+        self._completa.pop(chat_id, None)
+        self._resumo.pop(chat_id, None)
+        if chat_id in conversas:
+            self._versao_chat[chat_id] = self.versao
+        else:
+            self._versao_chat.pop(chat_id, None)
+    
+    def invalidate_all(self):
+        self.versao += 1
+        self._completa.clear()
+        self._resumo.clear()
+        self._versao_chat = {chat_id: self.versao for chat_id in conversas}
+    
+    def status_changed(self):
+        self.status_rev += 1
+    
+    def _cached(self, cache: Dict[str, bytes], chat_id: str, montar) -> bytes:
+        corpo = cache.get(chat_id)
+        if corpo is None:
+            corpo = cache[chat_id] = _json_bytes(montar(conversas[chat_id]))
+            self.encodes += 1
+            self._versao_chat.setdefault(chat_id, self.versao)
+        else:
+            self.hits += 1
+        return corpo
+    
+    def completa(self, chat_id: str) -> bytes:
+        return self._cached(self._completa, chat_id, lambda c: c)
+    
+    def resumo(self, chat_id: str) -> bytes:
+        return self._cached(self._resumo, chat_id, resumo_conversa)
+    
+    def etag_chat(self, chat_id: str) -> str:
+        return f'"{change_log.epoch}-c{self._versao_chat.get(chat_id, 0)}"'
+    
+    def lista(self) -> tuple:
+        """(corpo, etag) de /api/conversas"""
+        chave = (self.versao, change_log.seq)
+        if self._lista is None or self._lista[0] != chave:
+            corpo = (
+                b'{"conversas":[' + b",".join(self._completa.get(c) or self.completa(c) for c in list(conversas)) + b"]," +
+                _json_bytes({"epoch": change_log.epoch, "seq": change_log.seq})[1:]
+            )
+            self._lista = (chave, corpo, f'"{change_log.epoch}-l{self.versao}-{change_log.seq}"')
+        return self._lista[1], self._lista[2]
+    
+    def resumos_json(self) -> str:
+        """Array JSON com o resumo de todas as conversas em memória (init do WebSocket)"""
+        if self._resumos is None or self._resumos[0] != self.versao:
+            corpo = b"[" + b",".join(self._resumo.get(c) or self.resumo(c) for c in list(conversas)) + b"]"
+            self._resumos = (self.versao, corpo.decode("utf-8"))
+        return self._resumos[1]
+    
+    def status(self, montar) -> tuple:
+        """(corpo, etag) de /api/status; montar() só roda quando algo mudou"""
+        chave = (self.status_rev, config_manager.version, len(conversas))
+        if self._status is None or self._status[0] != chave:
+            self._status = (chave, _json_bytes(montar()), f'"{change_log.epoch}-s{self.status_rev}-{config_manager.version}-{len(conversas)}"')
+        return self._status[1], self._status[2]
+    
+    def respond(self, request: Request, corpo: bytes, etag: str) -> Response:
+        """200 com os bytes prontos, ou 304 se o cliente já tem essa versão"""
+        pedido = request.headers.get("if-none-match")
+        if pedido and (pedido.strip() == "*" or etag in (t.strip().removeprefix("W/") for t in pedido.split(","))):
+            self.not_modified += 1
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        return Response(content=corpo, media_type="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
+    
+    def stats(self) -> dict:
+        return {
+            "version": self.versao,
+            "cached_full": len(self._completa),
+            "cached_summaries": len(self._resumo),
+            "encodes": self.encodes,
+            "hits": self.hits,
+            "not_modified": self.not_modified
+        }
+
+snapshots = ConversationSnapshots()
+
+# ==================== WEBSOCKET HUB ====================
+# Cada evento é serializado uma única vez e colocado na fila de cada cliente;
+# uma task por cliente envia. Cliente lento com fila cheia é desconectado
+# (ao reconectar ele recebe o init e segue pelo /api/sync).
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 256))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 5))
+
+STATUS_EVENTS = {"status_update", "config_updated", "prompts_updated"}
+
+class WSClient:
+    def __init__(self, websocket: WebSocket, queue_size: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # "*" = tudo; "status" = status/config; "conversas" = todos os chats; "chat:<id>" = um chat
+        self.topics = {"*"}
+        self.task: Optional[asyncio.Task] = None
+        self.sent = 0
+    
+    def wants(self, message: dict) -> bool:
+        if "*" in self.topics:
+            return True
+        chat_id = message.get("chat_id")
+        if chat_id:
+            return "conversas" in self.topics or f"chat:{chat_id}" in self.topics
+        return "status" in self.topics or message.get("type") not in STATUS_EVENTS
+
+class BroadcastHub:
+    def __init__(self, queue_size: int, send_timeout: float):
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.clients: Dict[WebSocket, WSClient] = {}
+        self.published = 0
+        self.slow_disconnects = 0
+        # Repassa os eventos aos outros workers (definido pelo estado compartilhado)
+        self.relay = None
+    
+    def connect(self, websocket: WebSocket, first_message) -> WSClient:
+        """first_message: dict ou JSON já codificado (str)"""
+        client = WSClient(websocket, self.queue_size)
+        if not isinstance(first_message, str):
+            first_message = json.dumps(first_message, ensure_ascii=False, default=json_default)
+        client.queue.put_nowait(first_message)
+        self.clients[websocket] = client
+        client.task = asyncio.create_task(self._sender(client))
+        return client
+    
+    def disconnect(self, client: WSClient):
+        if self.clients.pop(client.websocket, None) is None:
+            return
+        if client.task and client.task is not asyncio.current_task():
+            client.task.cancel()
+    
+    def send(self, client: WSClient, message: dict):
+        """Enfileira uma mensagem só para este cliente"""
+        self._enqueue(client, json.dumps(message, ensure_ascii=False, default=json_default))
+    
+    def publish(self, message: dict, relay: bool = True):
+        """Enfileira o evento para todos os clientes interessados (não bloqueia)"""
+        self.published += 1
+        payload = None
+        for client in list(self.clients.values()):
+            if not client.wants(message):
+                continue
+            if payload is None:
+                payload = json.dumps(message, ensure_ascii=False, default=json_default)
+            self._enqueue(client, payload)
+        if relay and self.relay is not None:
+            self.relay(message)
+    
+    def _enqueue(self, client: WSClient, payload: str):
+        try:
+            client.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.slow_disconnects += 1
+            self.disconnect(client)
+            asyncio.create_task(self._close(client.websocket))
+    
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)  # Try again later
+        except Exception:
+            pass
+    
+    async def _sender(self, client: WSClient):
+        try:
+            while True:
+                payload = await client.queue.get()
+                await asyncio.wait_for(client.websocket.send_text(payload), timeout=self.send_timeout)
+                client.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Envio falhou ou travou: trata como cliente morto
+            self.disconnect(client)
+            await self._close(client.websocket)
+    
+    def stats(self) -> dict:
+        return {
+            "clients": len(self.clients),
+            "published": self.published,
+            "slow_disconnects": self.slow_disconnects,
+            "queue_size": self.queue_size,
+            "queues": [
+                {"topics": sorted(c.topics), "pending": c.queue.qsize(), "sent": c.sent}
+                for c in self.clients.values()
+            ]
+        }
+
+ws_hub = BroadcastHub(WS_QUEUE_SIZE, WS_SEND_TIMEOUT)
+
+# ==================== ESTADO COMPARTILHADO (VÁRIOS WORKERS) ====================
+# SHARED_STATE_BACKEND=memory (padrão): um worker só, tudo no processo.
+# "sqlite" ou "redis": vários workers (uvicorn --workers N) dividem o mesmo
+# DB_FILE. Eventos do painel e status do WhatsApp circulam por um barramento,
+# e cada chat_id tem uma fila de senhas global: só o worker com a vez mexe na
+# conversa. Antes de passar a vez ele grava no banco, e o próximo recarrega a
+# conversa de lá se a vez anterior não foi dele.
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory")
+SHARED_STATE_DB = Path(os.getenv("SHARED_STATE_DB", str(DB_FILE)))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SHARED_STATE_PREFIX = os.getenv("SHARED_STATE_PREFIX", "sushiaki")
+SHARED_POLL_INTERVAL = float(os.getenv("SHARED_POLL_INTERVAL", 0.05))
+# Vez parada por mais que isso (worker morto no meio) é pulada
+SHARED_LOCK_TTL = float(os.getenv("SHARED_LOCK_TTL", 120))
+SHARED_EVENTS_RETENTION = float(os.getenv("SHARED_EVENTS_RETENTION", 300))
+
+# Eventos que cada worker já gera sozinho (o watcher do config.json roda em todos)
+LOCAL_ONLY_EVENTS = {"config_updated"}
+
+class SharedState:
+    """Estado compartilhado entre workers - implementação em processo (um worker só)"""
+    distributed = False
+    backend = "memory"
+    
+    def __init__(self):
+        self.worker_id = f"{os.getpid()}-{random.getrandbits(32):08x}"
+        self._kv: Dict[str, Any] = {}
+    
+    async def start(self):
+        pass
+    
+    async def close(self):
+        pass
+    
+    async def get(self, key: str):
+        return self._kv.get(key)
+    
+    async def set(self, key: str, value):
+        self._kv[key] = value
+    
+    def relay(self, message: dict):
+        pass
+    
+    @asynccontextmanager
+    async def chat_lock(self, chat_id: str):
+        """Vez exclusiva no chat entre workers (em processo não há outros workers)"""
+        yield
+    
+    def stats(self) -> dict:
+        return {"backend": self.backend, "worker_id": self.worker_id, "distributed": self.distributed}
+
+class DistributedState(SharedState):
+    """Base dos backends entre workers: barramento de eventos + fila de senhas por chat.
+    
+    Subclasses implementam _listen (chama _on_payload), _publish_batch,
+    _take_ticket, _read_turn, _advance, get e set.
+    """
+    distributed = True
+    
+    def __init__(self):
+        super().__init__()
+        self._held: Dict[str, int] = {}            # chat_id -> senha com a vez neste worker
+        self._outbox: Dict[str, List[str]] = {}    # eventos segurados até gravar no banco
+        self._last_local: Dict[str, int] = {}      # última senha atendida por este worker
+        self._reloading: set = set()
+        self._send_queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._lock_waits = deque(maxlen=1000)
+        self.events_sent = 0
+        self.events_received = 0
+        self.publish_errors = 0
+        self.reloads = 0
+        self.stale_skips = 0
+    
+    async def start(self):
+        self._send_queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._publisher()), asyncio.create_task(self._listen())]
+    
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._send_queue is not None and not self._send_queue.empty():
+            lote = []
+            while not self._send_queue.empty():
+                lote.append(self._send_queue.get_nowait())
+            try:
+                await self._publish_batch(lote)
+            except Exception as e:
+                print(f"Erro ao publicar eventos pendentes: {e}")
+    
+    # ---- barramento de eventos ----
+    
+    def relay(self, message: dict):
+        """Chamado pelo ws_hub a cada evento publicado neste worker"""
+        if self._send_queue is None or message.get("type") in LOCAL_ONLY_EVENTS:
+            return
+        payload = json.dumps({"w": self.worker_id, "e": message}, ensure_ascii=False, default=json_default)
+        chat_id = message.get("chat_id")
+        if chat_id in self._held:
+            # Os outros só veem a mudança depois que ela estiver no banco
+            self._outbox[chat_id].append(payload)
+        else:
+            self._send_queue.put_nowait(payload)
+    
+    async def _publisher(self):
+        while True:
+            lote = [await self._send_queue.get()]
+            while not self._send_queue.empty() and len(lote) < 100:
+                lote.append(self._send_queue.get_nowait())
+            try:
+                await self._publish_batch(lote)
+                self.events_sent += len(lote)
+            except Exception as e:
+                self.publish_errors += 1
+                errors_total.inc("shared_state")
+                print(f"Erro ao publicar eventos entre workers: {e}")
+    
+    def _on_payload(self, payload: str):
+        try:
+            envelope = json.loads(payload)
+        except ValueError:
+            return
+        if envelope.get("w") == self.worker_id:
+            return
+        self.events_received += 1
+        self._apply(envelope["e"])
+    
+    def _apply(self, evento: dict):
+        """Aplica no estado local um evento de outro worker e repassa aos clientes WS daqui"""
+        tipo = evento.get("type")
+        chat_id = evento.get("chat_id")
+        if tipo == "status_update":
+            whatsapp_status.update(evento.get("status") or {})
+            snapshots.status_changed()
+        elif tipo == "prompts_updated":
+            # Cardápio, prompts ou FAQ mudaram em outro worker: os arquivos já estão no disco
+            try:
+                recarregar_prompts()
+            except Exception as e:
+                print(f"Erro ao recarregar prompts: {e}")
+        elif tipo == "conversas_cleared":
+            conversas.clear()
+            snapshots.invalidate_all()
+            conversation_store.note_remote(None, exists=False)
+            memory_manager.forget()
+            evento = {**evento, "seq": change_log.record("clear")}
+        elif tipo == "conversa_removed":
+            conversas.pop(chat_id, None)
+            snapshots.invalidate(chat_id)
+            conversation_store.note_remote(chat_id, exists=False)
+            memory_manager.forget(chat_id)
+            evento = {**evento, "seq": change_log.record("delete", chat_id)}
+        elif tipo == "conversas_imported":
+            # Banco já tem o importado: só larga as cópias locais
+            for importado in evento.get("chat_ids") or []:
+                conversas.pop(importado, None)
+                snapshots.invalidate(importado)
+                conversation_store.note_remote(importado)
+                memory_manager.forget(importado)
+            evento = {**evento, "seq": change_log.record("clear")}
+            asyncio.create_task(preload_recent_conversas())
+        elif chat_id:
+            conversation_store.note_remote(chat_id)
+            if tipo == "conversa_updated":
+                evento = {**evento, "seq": change_log.record("state", chat_id)}
+                self._schedule_reload(chat_id)
+            elif evento.get("message"):
+                change_log.record("message", chat_id, evento["message"])
+        ws_hub.publish(evento, relay=False)
+    
+    def _schedule_reload(self, chat_id: str):
+        # Fora da memória daqui: será carregada do banco quando alguém pedir
+        if chat_id in conversas and chat_id not in self._held and chat_id not in self._reloading:
+            self._reloading.add(chat_id)
+            asyncio.create_task(self._reload_remote(chat_id))
+    
+    async def _reload_remote(self, chat_id: str):
+        try:
+            salva = await conversation_store.load_conversa(chat_id)
+            # Quem pegou a vez nesse meio tempo recarrega por conta própria
+            if salva is not None and chat_id in conversas and chat_id not in self._held:
+                self._install(chat_id, salva)
+        except Exception as e:
+            print(f"Erro ao recarregar conversa {chat_id}: {e}")
+        finally:
+            self._reloading.discard(chat_id)
+    
+    def _install(self, chat_id: str, salva: dict):
+        conversa = nova_conversa(chat_id)
+        conversa.update(salva)
+        conversas[chat_id] = conversa
+        snapshots.invalidate(chat_id)
+        self.reloads += 1
+    
+    # ---- fila de senhas por chat ----
+    
+    @asynccontextmanager
+    async def chat_lock(self, chat_id: str):
+        senha = await self._take_ticket(chat_id)
+        inicio = time.monotonic()
+        try:
+            await self._wait_turn(chat_id, senha)
+        except asyncio.CancelledError:
+            # Desistiu na fila: passa a vez quando ela chegar para não travar os seguintes
+            asyncio.create_task(self._pass_turn(chat_id, senha))
+            raise
+        self._lock_waits.append(time.monotonic() - inicio)
+        self._held[chat_id] = senha
+        self._outbox[chat_id] = []
+        try:
+            if self._last_local.get(chat_id) != senha - 1:
+                # A vez anterior foi de outro worker: a cópia daqui pode estar velha
+                conversation_store.note_remote(chat_id)
+                salva = await conversation_store.load_conversa(chat_id)
+                if salva is not None:
+                    self._install(chat_id, salva)
+            yield
+        finally:
+            self._held.pop(chat_id, None)
+            pendentes = self._outbox.pop(chat_id, [])
+            try:
+                await conversation_store.flush()
+            finally:
+                self._last_local[chat_id] = senha
+                try:
+                    await self._advance(chat_id, senha)
+                except Exception as e:
+                    errors_total.inc("shared_state")
+                    print(f"Erro ao passar a vez do chat {chat_id}: {e}")
+                for payload in pendentes:
+                    self._send_queue.put_nowait(payload)
+    
+    async def _wait_turn(self, chat_id: str, senha: int):
+        visto, desde = None, time.monotonic()
+        while True:
+            servida = await self._read_turn(chat_id)
+            if servida >= senha - 1:
+                return
+            if servida != visto:
+                visto, desde = servida, time.monotonic()
+            elif time.monotonic() - desde > SHARED_LOCK_TTL * (senha - 1 - servida):
+                # Ninguém avançou a fila nesse tempo (worker morto com a vez): pula
+                self.stale_skips += 1
+                return
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+    
+    async def _pass_turn(self, chat_id: str, senha: int):
+        try:
+            await self._wait_turn(chat_id, senha)
+            await self._advance(chat_id, senha)
+        except Exception as e:
+            print(f"Erro ao liberar a vez do chat {chat_id}: {e}")
+    
+    def forget_chats(self, manter):
+        """Descarta senhas locais de chats que saíram da memória"""
+        for chat_id in [c for c in self._last_local if c not in manter]:
+            del self._last_local[chat_id]
+    
+    def stats(self) -> dict:
+        waits = sorted(self._lock_waits)
+        def percentil(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1) if waits else 0.0
+        return {
+            **super().stats(),
+            "held_chats": len(self._held),
+            "send_queue": self._send_queue.qsize() if self._send_queue else 0,
+            "events_sent": self.events_sent,
+            "events_received": self.events_received,
+            "publish_errors": self.publish_errors,
+            "reloads": self.reloads,
+            "stale_skips": self.stale_skips,
+            "lock_wait_ms": {"p50": percentil(0.5), "p95": percentil(0.95), "max": percentil(1.0)}
+        }
+
+class SQLiteSharedState(DistributedState):
+    """Workers na mesma máquina: tabelas no SQLite e eventos lidos por polling"""
+    backend = "sqlite"
+    
+    def __init__(self, path: Path):
+        super().__init__()
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._db = None
+        self._last_event = 0
+    
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    def _open(self) -> int:
+        import sqlite3
+        # Autocommit: cada senha/evento fica visível para os outros workers na hora
+        self._db = sqlite3.connect(str(self.path), isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS shared_kv (
+                chave TEXT PRIMARY KEY,
+                valor TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shared_eventos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT NOT NULL,
+                criado_em REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_shared_eventos_criado ON shared_eventos (criado_em);
+            CREATE TABLE IF NOT EXISTS shared_senhas (
+                chat_id TEXT PRIMARY KEY,
+                proxima INTEGER NOT NULL,
+                servida INTEGER NOT NULL
+            );
+        """)
+        return self._db.execute("SELECT COALESCE(MAX(id), 0) FROM shared_eventos").fetchone()[0]
+    
+    async def start(self):
+        self._last_event = await self._run(self._open)
+        await super().start()
+    
+    async def close(self):
+        await super().close()
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
+    
+    def _sql_get(self, key: str):
+        row = self._db.execute("SELECT valor FROM shared_kv WHERE chave = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def _sql_set(self, key: str, valor: str):
+        self._db.execute("INSERT OR REPLACE INTO shared_kv (chave, valor) VALUES (?, ?)", (key, valor))
+    
+    async def get(self, key: str):
+        return await self._run(self._sql_get, key)
+    
+    async def set(self, key: str, value):
+        await self._run(self._sql_set, key, json.dumps(value, ensure_ascii=False))
+    
+    def _sql_publish(self, payloads: List[str]):
+        agora = time.time()
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT INTO shared_eventos (payload, criado_em) VALUES (?, ?)",
+                [(p, agora) for p in payloads]
+            )
+    
+    async def _publish_batch(self, payloads: List[str]):
+        await self._run(self._sql_publish, payloads)
+    
+    def _sql_poll(self, depois_de: int) -> list:
+        return self._db.execute(
+            "SELECT id, payload FROM shared_eventos WHERE id > ? ORDER BY id LIMIT 500", (depois_de,)
+        ).fetchall()
+    
+    def _sql_prune(self):
+        self._db.execute("DELETE FROM shared_eventos WHERE criado_em < ?", (time.time() - SHARED_EVENTS_RETENTION,))
+    
+    async def _listen(self):
+        proxima_limpeza = time.monotonic() + 30
+        while True:
+            try:
+                rows = await self._run(self._sql_poll, self._last_event)
+                for event_id, payload in rows:
+                    self._last_event = event_id
+                    self._on_payload(payload)
+                if time.monotonic() > proxima_limpeza:
+                    proxima_limpeza = time.monotonic() + 30
+                    await self._run(self._sql_prune)
+                    self.forget_chats(conversas)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                errors_total.inc("shared_state")
+                print(f"Erro ao ler eventos entre workers: {e}")
+                rows = []
+            if len(rows) < 500:
+                await asyncio.sleep(SHARED_POLL_INTERVAL)
+    
+    def _sql_take_ticket(self, chat_id: str) -> int:
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute(
+                "INSERT INTO shared_senhas (chat_id, proxima, servida) VALUES (?, 1, 0) "
+                "ON CONFLICT(chat_id) DO UPDATE SET proxima = proxima + 1",
+                (chat_id,)
+            )
+            return self._db.execute("SELECT proxima FROM shared_senhas WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+    
+    def _sql_read_turn(self, chat_id: str) -> int:
+        row = self._db.execute("SELECT servida FROM shared_senhas WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else 0
+    
+    def _sql_advance(self, chat_id: str, senha: int):
+        self._db.execute("UPDATE shared_senhas SET servida = MAX(servida, ?) WHERE chat_id = ?", (senha, chat_id))
+    
+    async def _take_ticket(self, chat_id: str) -> int:
+        return await self._run(self._sql_take_ticket, chat_id)
+    
+    async def _read_turn(self, chat_id: str) -> int:
+        return await self._run(self._sql_read_turn, chat_id)
+    
+    async def _advance(self, chat_id: str, senha: int):
+        await self._run(self._sql_advance, chat_id, senha)
+    
+    def stats(self) -> dict:
+        return {**super().stats(), "file": str(self.path), "last_event_id": self._last_event}
+
+# Sobe a senha servida só para frente (quem pulou a vez não pode voltá-la)
+_REDIS_ADVANCE = """
+local atual = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+if tonumber(ARGV[2]) > atual then redis.call('HSET', KEYS[1], ARGV[1], ARGV[2]) end
+return 1
+"""
+
+class RedisSharedState(DistributedState):
+    """Barramento via PUBLISH/SUBSCRIBE e senhas em hashes do Redis (pacote opcional redis>=5).
+    
+    As conversas continuam no DB_FILE, que precisa ser o mesmo para todos os workers.
+    """
+    backend = "redis"
+    
+    def __init__(self, url: str, prefix: str):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self._redis = None
+        self._pubsub = None
+    
+    async def start(self):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("SHARED_STATE_BACKEND=redis requer o pacote redis (pip install 'redis>=5.0.1')")
+        self._redis = aioredis.from_url(self.url, decode_responses=True)
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(f"{self.prefix}:eventos")
+        await super().start()
+    
+    async def close(self):
+        await super().close()
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        if self._redis is not None:
+            await self._redis.aclose()
+    
+    async def get(self, key: str):
+        valor = await self._redis.get(f"{self.prefix}:kv:{key}")
+        return json.loads(valor) if valor is not None else None
+    
+    async def set(self, key: str, value):
+        await self._redis.set(f"{self.prefix}:kv:{key}", json.dumps(value, ensure_ascii=False))
+    
+    async def _publish_batch(self, payloads: List[str]):
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for payload in payloads:
+                pipe.publish(f"{self.prefix}:eventos", payload)
+            await pipe.execute()
+    
+    async def _listen(self):
+        while True:
+            try:
+                async for msg in self._pubsub.listen():
+                    if msg.get("type") == "message":
+                        self._on_payload(msg["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                errors_total.inc("shared_state")
+                print(f"Erro na assinatura de eventos do Redis: {e}")
+                await asyncio.sleep(1)
+    
+    async def _take_ticket(self, chat_id: str) -> int:
+        return await self._redis.hincrby(f"{self.prefix}:senhas", chat_id, 1)
+    
+    async def _read_turn(self, chat_id: str) -> int:
+        return int(await self._redis.hget(f"{self.prefix}:servidas", chat_id) or 0)
+    
+    async def _advance(self, chat_id: str, senha: int):
+        await self._redis.eval(_REDIS_ADVANCE, 1, f"{self.prefix}:servidas", chat_id, senha)
+    
+    def stats(self) -> dict:
+        return {**super().stats(), "url": re.sub(r"//[^@/]*@", "//***@", self.url)}
+
+def create_shared_state() -> SharedState:
+    if SHARED_STATE_BACKEND in ("sqlite", "redis"):
+        if not conversation_store.persistent:
+            print(f"⚠️ SHARED_STATE_BACKEND={SHARED_STATE_BACKEND} requer STORAGE_BACKEND=sqlite; usando estado em processo")
+            return SharedState()
+        if SHARED_STATE_BACKEND == "redis":
+            return RedisSharedState(REDIS_URL, SHARED_STATE_PREFIX)
+        return SQLiteSharedState(SHARED_STATE_DB)
+    return SharedState()
+
+shared_state = create_shared_state()
+if shared_state.distributed:
+    ws_hub.relay = shared_state.relay
+
+# ==================== ANALYTICS DO FUNIL ====================
+# Agregados por hora mantidos enquanto as mensagens passam (registrar_mensagem):
+# etapas do funil (cada chat conta uma vez por etapa), tempo até a primeira
+# resposta, objeções, origem das respostas e resultado por modelo de IA. Cada
+# worker soma deltas em memória e grava a cada ANALYTICS_FLUSH_INTERVAL na tabela
+# analytics (hora, chave) com "valor = valor + delta", então vários workers somam
+# no mesmo lugar. Horas fechadas ficam em cache: /api/analytics só relê do banco
+# as duas últimas horas da janela, nunca o histórico de mensagens.
+ANALYTICS_FLUSH_INTERVAL = float(os.getenv("ANALYTICS_FLUSH_INTERVAL", 5))
+ANALYTICS_RETENTION_DAYS = float(os.getenv("ANALYTICS_RETENTION_DAYS", 400))
+ANALYTICS_MAX_DAYS = int(os.getenv("ANALYTICS_MAX_DAYS", 90))
+
+# Ordem do funil; objeção e atendimento humano são desvios, contados à parte
+ETAPAS_FUNIL = ("contato", "boas_vindas", "engajou", "link_site")
+ETAPAS_DESVIO = ("objecao", "pediu_humano", "atendimento_humano")
+# Limites (segundos) do histograma de tempo até a primeira resposta
+LIMITES_RESPOSTA = (1, 2, 5, 10, 30, 60, 120, 300, 900, 3600)
+
+def _inicio_hora(instante: float) -> int:
+    return int(instante // 3600) * 3600
+
+def dominio_site() -> str:
+    url = config.get("site_url", "https://sushiakicb.shop")
+    return url.split("//")[-1].split("/")[0].lower().removeprefix("www.")
+
+def funil_da_conversa(conversa: Dict) -> dict:
+    """Estado do funil da conversa (Conversa.funil: persiste com ela, mas não sai na API)"""
+    funil = conversa.funil
+    if funil is None:
+        funil = {"etapas": []}
+        if conversa["mensagens"]:
+            # Conversa anterior ao analytics: marca o que já aconteceu sem contar de novo
+            funil["etapas"] = ["contato"]
+            funil["respondido"] = any(m.autor != "cliente" for m in conversa["mensagens"])
+            if conversa["mensagem_inicial_enviada"]:
+                funil["etapas"].append("boas_vindas")
+            if "desconfianca" in conversa["objecoes_tratadas"]:
+                funil["etapas"].append("objecao")
+            if conversa["modo_humanizado"]:
+                funil["etapas"].append("pediu_humano")
+            if conversa["humano_ativo"]:
+                funil["etapas"].append("atendimento_humano")
+        conversa.funil = funil
+    return funil
+
+def _percentil(buckets: List[float], total: float, p: float) -> Optional[float]:
+    """Percentil aproximado do histograma (interpolação linear dentro do bucket)"""
+    if not total:
+        return None
+    alvo = total * p
+    acumulado = 0.0
+    anterior = 0.0
+    for limite, quantidade in zip(LIMITES_RESPOSTA + (None,), buckets):
+        if quantidade and acumulado + quantidade >= alvo:
+            if limite is None:
+                return float(anterior)
+            return round(anterior + (limite - anterior) * (alvo - acumulado) / quantidade, 2)
+        acumulado += quantidade
+        anterior = limite if limite is not None else anterior
+    return float(anterior)
+
+class FunnelAnalytics:
+    def __init__(self, path: Optional[Path]):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analytics")
+        self._db = None
+        self._pendente: Dict[int, Dict[str, float]] = {}
+        # Horas fechadas já lidas do banco (não mudam mais)
+        self._fechadas: Dict[int, Dict[str, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._consulta: Optional[tuple] = None   # (chave, corpo, etag)
+        self.revisao = 0
+        self.eventos = 0
+        self.flushes = 0
+        self.consultas = 0
+        self.leituras_banco = 0
+    
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    def _open(self):
+        import sqlite3
+        self._db = sqlite3.connect(str(self.path), timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS analytics (
+                hora INTEGER NOT NULL,
+                chave TEXT NOT NULL,
+                valor REAL NOT NULL,
+                PRIMARY KEY (hora, chave)
+            ) WITHOUT ROWID;
+        """)
+    
+    async def start(self):
+        if self.path is not None:
+            await self._run(self._open)
+            self._task = asyncio.create_task(self._flush_loop())
+    
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._db is not None:
+            await self.flush()
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
+    
+    # ---- coleta ----
+    
+    def somar(self, chave: str, valor: float = 1.0, instante: Optional[float] = None):
+        hora = _inicio_hora(instante or time.time())
+        bucket = self._pendente.get(hora)
+        if bucket is None:
+            bucket = self._pendente[hora] = {}
+        bucket[chave] = bucket.get(chave, 0.0) + valor
+        self.eventos += 1
+        self.revisao += 1
+    
+    def etapa(self, conversa: Dict, etapa: str):
+        """Conta a etapa uma vez por chat; as de resultado também vão para o modelo que atendia"""
+        funil = funil_da_conversa(conversa)
+        if etapa in funil["etapas"]:
+            return
+        funil["etapas"].append(etapa)
+        self.somar(f"etapa|{etapa}")
+        if funil.get("modelo") and etapa in ("link_site", "pediu_humano", "atendimento_humano"):
+            self.somar(f"modelo|{funil['modelo']}|{etapa}")
+    
+    def _tempo_resposta(self, tipo: str, segundos: float, modelo: Optional[str]):
+        indice = bisect_left(LIMITES_RESPOSTA, segundos)
+        limite = LIMITES_RESPOSTA[indice] if indice < len(LIMITES_RESPOSTA) else "inf"
+        self.somar(f"tempo_{tipo}|{limite}")
+        self.somar(f"tempo_{tipo}|soma", segundos)
+        if modelo:
+            self.somar(f"modelo|{modelo}|respostas")
+            self.somar(f"modelo|{modelo}|tempo_soma", segundos)
+    
+    def observar(self, conversa: Dict, msg: "Mensagem"):
+        """Chamado para toda mensagem registrada, antes de entrar na conversa"""
+        funil = funil_da_conversa(conversa)
+        autor = msg.autor
+        self.somar(f"mensagens|{autor}")
+        if autor == "cliente":
+            if "contato" not in funil["etapas"]:
+                self.etapa(conversa, "contato")
+            elif funil.get("respondido"):
+                self.etapa(conversa, "engajou")
+            # Só a primeira mensagem de uma rajada conta para o tempo de resposta
+            funil.setdefault("aguardando", msg.ts)
+            return
+        
+        funil["respondido"] = True
+        aguardando = funil.pop("aguardando", None)
+        if aguardando is not None:
+            segundos = max(0.0, (msg.ts - aguardando) / 1_000_000)
+            if autor == "bot":
+                self.somar(f"fontes|{funil.get('fonte', 'ia')}")
+                self._tempo_resposta("bot", segundos, funil.get("modelo") if funil.get("fonte") == "ia" else None)
+            else:
+                self._tempo_resposta("humano", segundos, None)
+        
+        if autor == "humano":
+            self.etapa(conversa, "atendimento_humano")
+        elif "boas_vindas" not in funil["etapas"] and conversa["mensagem_inicial_enviada"] and msg.texto == get_mensagem_inicial():
+            self.etapa(conversa, "boas_vindas")
+        if "desconfianca" in conversa["objecoes_tratadas"]:
+            self.etapa(conversa, "objecao")
+        if conversa["modo_humanizado"]:
+            self.etapa(conversa, "pediu_humano")
+        if "link_site" not in funil["etapas"] and dominio_site() in msg.texto.lower():
+            self.etapa(conversa, "link_site")
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": config.get("site_url", "https://sushiakicb.shop"),
-        "X-Title": config.get("business_name", "Sushi Aki Bot")
-    }
+    # ---- gravação ----
     
-    payload = {
-        "model": model,
-        "messages": messages,
-        "max_tokens": 500,
-        "temperature": 0.8
-    }
+    def _sql_somar(self, linhas: List[tuple]):
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO analytics (hora, chave, valor) VALUES (?, ?, ?) "
+                "ON CONFLICT(hora, chave) DO UPDATE SET valor = valor + excluded.valor",
+                linhas
+            )
+            self._db.execute(
+                "DELETE FROM analytics WHERE hora < ?",
+                (_inicio_hora(time.time() - ANALYTICS_RETENTION_DAYS * 86400),)
+            )
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=aiohttp.ClientTimeout(total=30)
-        ) as response:
-            if response.status != 200:
-                error_text = await response.text()
-                raise ValueError(f"Erro OpenRouter ({response.status}): {error_text}")
-            
-            data = await response.json()
-            return data["choices"][0]["message"]["content"]
-
-def call_gemini(messages: list, model: str, system_prompt: str) -> str:
-    """Chama a API do Google Gemini"""
-    import google.generativeai as genai
+    async def flush(self):
+        if self._db is None or not self._pendente:
+            return
+        pendente, self._pendente = self._pendente, {}
+        linhas = [(hora, chave, valor) for hora, bucket in pendente.items() for chave, valor in bucket.items()]
+        try:
+            await self._run(self._sql_somar, linhas)
+        except Exception as e:
+            print(f"Erro ao gravar analytics: {e}")
+            for hora, chave, valor in linhas:
+                bucket = self._pendente.setdefault(hora, {})
+                bucket[chave] = bucket.get(chave, 0.0) + valor
+            return
+        self.flushes += 1
     
-    api_key = config.get("gemini_api_key", "")
-    if not api_key:
-        raise ValueError("API Key do Gemini não configurada")
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Erro no flush de analytics: {e}")
     
-    genai.configure(api_key=api_key)
+    # ---- consulta ----
     
-    gemini_model = genai.GenerativeModel(
-        model_name=model,
-        system_instruction=system_prompt
-    )
+    def _sql_horas(self, desde: int, ate: int) -> list:
+        return self._db.execute(
+            "SELECT hora, chave, valor FROM analytics WHERE hora >= ? AND hora < ?", (desde, ate)
+        ).fetchall()
     
-    # Converter mensagens para formato Gemini
-    history = []
-    for msg in messages[:-1]:
-        role = "user" if msg["role"] == "user" else "model"
-        history.append({"role": role, "parts": [msg["content"]]})
+    async def horas(self, desde: int, ate: int) -> Dict[int, Dict[str, float]]:
+        """Agregados por hora em [desde, ate); sem banco, vem tudo da memória"""
+        if self._db is None:
+            corte = _inicio_hora(time.time() - ANALYTICS_RETENTION_DAYS * 86400)
+            for hora in [h for h in self._pendente if h < corte]:
+                del self._pendente[hora]
+            return {h: b for h, b in self._pendente.items() if desde <= h < ate}
+        
+        await self.flush()
+        # Até a hora anterior à atual, o que está no banco não muda mais (flush já passou)
+        abertas_desde = max(desde, _inicio_hora(time.time()) - 3600)
+        faltando = [h for h in range(desde, min(ate, abertas_desde), 3600) if h not in self._fechadas]
+        if faltando:
+            lidas: Dict[int, Dict[str, float]] = {h: {} for h in faltando}
+            for hora, chave, valor in await self._run(self._sql_horas, faltando[0], faltando[-1] + 3600):
+                if hora in lidas:
+                    lidas[hora][chave] = valor
+            self._fechadas.update(lidas)
+            self.leituras_banco += 1
+        resultado = {h: self._fechadas[h] for h in range(desde, min(ate, abertas_desde), 3600) if self._fechadas[h]}
+        if abertas_desde < ate:
+            for hora, chave, valor in await self._run(self._sql_horas, abertas_desde, ate):
+                resultado.setdefault(hora, {})[chave] = valor
+            self.leituras_banco += 1
+        corte = _inicio_hora(time.time() - ANALYTICS_MAX_DAYS * 86400)
+        for hora in [h for h in self._fechadas if h < corte]:
+            del self._fechadas[hora]
+        return resultado
     
-    chat = gemini_model.start_chat(history=history)
-    response = chat.send_message(messages[-1]["content"])
-    return response.text
+    async def resumo(self, desde: int, ate: int, agrupar: str) -> dict:
+        self.consultas += 1
+        horas = await self.horas(desde, ate)
+        total: Dict[str, float] = {}
+        serie: Dict[int, Dict[str, float]] = {}
+        for hora in sorted(horas):
+            if agrupar == "dia":
+                dia = datetime.fromtimestamp(hora).replace(hour=0, minute=0)
+                inicio = int(dia.timestamp())
+            else:
+                inicio = hora
+            ponto = serie.setdefault(inicio, {})
+            for chave, valor in horas[hora].items():
+                total[chave] = total.get(chave, 0.0) + valor
+                if chave.startswith(("etapa|", "mensagens|")):
+                    ponto[chave] = ponto.get(chave, 0.0) + valor
+        
+        contatos = total.get("etapa|contato", 0)
+        def taxa(valor: float) -> Optional[float]:
+            return round(valor / contatos, 4) if contatos else None
+        
+        def tempos(tipo: str) -> dict:
+            buckets = [total.get(f"tempo_{tipo}|{limite}", 0) for limite in LIMITES_RESPOSTA + ("inf",)]
+            quantidade = sum(buckets)
+            return {
+                "respostas": int(quantidade),
+                "media_s": round(total.get(f"tempo_{tipo}|soma", 0) / quantidade, 2) if quantidade else None,
+                "p50_s": _percentil(buckets, quantidade, 0.5),
+                "p90_s": _percentil(buckets, quantidade, 0.9),
+                "limites_s": list(LIMITES_RESPOSTA) + ["inf"],
+                "buckets": [int(b) for b in buckets]
+            }
+        
+        modelos: Dict[str, Dict[str, float]] = {}
+        for chave, valor in total.items():
+            if chave.startswith("modelo|"):
+                modelo, metrica = chave[len("modelo|"):].rsplit("|", 1)
+                modelos.setdefault(modelo, {})[metrica] = valor
+        
+        return {
+            "desde": datetime.fromtimestamp(desde).isoformat(),
+            "ate": datetime.fromtimestamp(ate).isoformat(),
+            "agrupar": agrupar,
+            "funil": [
+                {"etapa": etapa, "chats": int(total.get(f"etapa|{etapa}", 0)), "taxa": taxa(total.get(f"etapa|{etapa}", 0))}
+                for etapa in ETAPAS_FUNIL + ETAPAS_DESVIO
+            ],
+            "mensagens": {autor: int(total.get(f"mensagens|{autor}", 0)) for autor in PREFIXO_ID},
+            "tempo_resposta": {"bot": tempos("bot"), "humano": tempos("humano")},
+            "fontes": {
+                chave.split("|", 1)[1]: int(valor) for chave, valor in total.items() if chave.startswith("fontes|")
+            },
+            "modelos": [
+                {
+                    "modelo": modelo,
+                    "respostas": int(m.get("respostas", 0)),
+                    "tempo_medio_s": round(m.get("tempo_soma", 0) / m["respostas"], 2) if m.get("respostas") else None,
+                    **{etapa: int(m.get(etapa, 0)) for etapa in ("link_site", "pediu_humano", "atendimento_humano")}
+                }
+                for modelo, m in sorted(modelos.items(), key=lambda item: -item[1].get("respostas", 0))
+            ],
+            # Série compacta para gráfico: uma linha por hora/dia, colunas na ordem de "colunas"
+            "serie": {
+                "colunas": ["inicio"] + [f"etapa|{e}" for e in ETAPAS_FUNIL + ETAPAS_DESVIO] + [f"mensagens|{a}" for a in PREFIXO_ID],
+                "linhas": [
+                    [datetime.fromtimestamp(inicio).isoformat()] +
+                    [int(ponto.get(f"etapa|{e}", 0)) for e in ETAPAS_FUNIL + ETAPAS_DESVIO] +
+                    [int(ponto.get(f"mensagens|{a}", 0)) for a in PREFIXO_ID]
+                    for inicio, ponto in sorted(serie.items())
+                ]
+            }
+        }
+    
+    async def consulta(self, desde: int, ate: int, agrupar: str) -> tuple:
+        """(corpo, etag) do /api/analytics; a mesma janela sem eventos novos sai do cache"""
+        chave = (desde, ate, agrupar, self.revisao, _inicio_hora(time.time()))
+        # Com banco, outros workers também somam: o cache vale por um intervalo de flush
+        expirado = self._consulta is not None and self._db is not None and time.time() - self._consulta[3] > ANALYTICS_FLUSH_INTERVAL
+        if self._consulta is None or self._consulta[0] != chave or expirado:
+            corpo = _json_bytes(await self.resumo(desde, ate, agrupar))
+            etag = '"a' + hashlib.md5(corpo).hexdigest()[:16] + '"'
+            self._consulta = (chave, corpo, etag, time.time())
+        return self._consulta[1], self._consulta[2]
+    
+    def stats(self) -> dict:
+        return {
+            "persistent": self._db is not None,
+            "events": self.eventos,
+            "pending_hours": len(self._pendente),
+            "cached_hours": len(self._fechadas),
+            "flushes": self.flushes,
+            "queries": self.consultas,
+            "db_reads": self.leituras_banco
+        }
 
-async def generate_ai_response(mensagem: str, historico: list, modo_humano: bool = False) -> str:
-    """Gera resposta usando o provedor configurado"""
-    provider = config.get("provider", "openrouter")
-    model = config.get("selected_model", "deepseek/deepseek-r1:free")
+funnel_analytics = FunnelAnalytics(DB_FILE if conversation_store.persistent else None)
+
+# ==================== FUNÇÕES AUXILIARES ====================
+
+def _regex_trie(termos) -> str:
+    """Regex de alternação fatorada em trie ("golpe|gerente" -> "g(?:erente|olpe)")"""
+    trie: Dict = {}
+    for termo in termos:
+        no = trie
+        for ch in termo:
+            no = no.setdefault(ch, {})
+        no[""] = {}
     
-    # Escolher prompt baseado no modo
-    system_prompt = get_human_mode_prompt() if modo_humano else get_system_prompt()
+    def render(no: Dict) -> str:
+        ramos = [
+            (r"\W+" if ch == " " else re.escape(ch)) + render(filho)
+            for ch, filho in sorted(no.items()) if ch != ""
+        ]
+        if not ramos:
+            return ""
+        corpo = ramos[0] if len(ramos) == 1 else "(?:" + "|".join(ramos) + ")"
+        return f"(?:{corpo})?" if "" in no else corpo
     
-    # Construir mensagens
-    messages = [{"role": "system", "content": system_prompt}]
+    return render(trie)
+
+class IntentMatcher:
+    """Detecta todas as intenções de uma mensagem numa única passada de regex.
     
-    for msg in historico[-10:]:
-        role = "user" if msg["role"] == "user" else "assistant"
-        messages.append({"role": role, "content": msg["content"]})
+    Texto e palavras-chave são comparados sem acento e por palavra inteira
+    ("bot" não casa com "botão", "real" não casa com "realmente"); plural em
+    -s/-es é aceito. Um "*" no fim da palavra-chave casa qualquer sufixo.
+    """
     
-    messages.append({"role": "user", "content": mensagem})
+    def __init__(self, keywords: Dict[str, List[str]]):
+        self.keywords = {intent: list(palavras) for intent, palavras in keywords.items()}
+        self._intents_por_termo: Dict[str, set] = {}
+        inteiros, prefixos = set(), set()
+        for intent, palavras in self.keywords.items():
+            for palavra in palavras:
+                termo = normalizar_texto(palavra.rstrip("*"))
+                if not termo:
+                    continue
+                (prefixos if palavra.endswith("*") else inteiros).add(termo)
+                self._intents_por_termo.setdefault(termo, set()).add(intent)
+        
+        alternativas = []
+        if inteiros:
+            alternativas.append(f"({_regex_trie(inteiros)})(?:e?s)?")
+        if prefixos:
+            alternativas.append(f"({_regex_trie(prefixos)})\\w*")
+        self._regex = re.compile(r"\b(?:" + "|".join(alternativas) + r")\b", re.ASCII) if alternativas else None
     
-    try:
-        if provider == "openrouter":
-            return await call_openrouter(messages, model)
-        else:
-            return call_gemini(messages, model, system_prompt)
-    except Exception as e:
-        print(f"Erro na IA ({provider}/{model}): {e}")
-        return f"Desculpe, tive um probleminha técnico 😅 Mas você pode fazer seu pedido direto no site: {config.get('site_url', 'https://sushiakicb.shop')} 🍣"
+    def match(self, texto: str) -> set:
+        if self._regex is None:
+            return set()
+        intents = set()
+        for grupos in self._regex.findall(dobrar_acentos(texto)):
+            for termo in (grupos if isinstance(grupos, tuple) else (grupos,)):
+                if termo:
+                    encontrados = self._intents_por_termo.get(termo)
+                    if encontrados is None:
+                        # Separador diferente de um espaço simples ("nao-e-robo")
+                        encontrados = self._intents_por_termo.get(normalizar_texto(termo), ())
+                    intents.update(encontrados)
+        return intents
 
-# ==================== ESTADO GLOBAL ====================
-conversas: Dict[str, Dict] = {}
-websocket_clients: List[WebSocket] = []
-whatsapp_status = {
-    "connected": False,
-    "qr_code": None,
-    "phone_number": None,
-    "status_text": "Desconectado"
+DEFAULT_INTENT_KEYWORDS = {
+    "desconfianca": DESCONFIANCA,
+    "pedido_humano": PEDIDO_HUMANO
 }
 
-# ==================== FUNÇÕES AUXILIARES ====================
+def build_intent_matcher() -> IntentMatcher:
+    """Monta o matcher a partir do config (intent_keywords sobrescreve os padrões)"""
+    keywords = dict(DEFAULT_INTENT_KEYWORDS)
+    keywords.update(config.get("intent_keywords") or {})
+    return IntentMatcher(keywords)
+
+intent_matcher = build_intent_matcher()
+
+def reload_intent_matcher():
+    global intent_matcher
+    intent_matcher = build_intent_matcher()
+
+def detecta_intencoes(texto: str) -> set:
+    return intent_matcher.match(texto)
 
 def detecta_desconfianca(texto: str) -> bool:
-    texto_lower = texto.lower()
-    return any(palavra in texto_lower for palavra in DESCONFIANCA)
+    return "desconfianca" in detecta_intencoes(texto)
 
 def detecta_pedido_humano(texto: str) -> bool:
-    texto_lower = texto.lower()
-    return any(palavra in texto_lower for palavra in PEDIDO_HUMANO)
+    return "pedido_humano" in detecta_intencoes(texto)
+
+def nova_conversa(chat_id: str) -> Conversa:
+    return Conversa(chat_id)
 
 def get_conversa(chat_id: str) -> Dict:
     if chat_id not in conversas:
-        conversas[chat_id] = {
-            "chat_id": chat_id,
-            "mensagens": [],
-            "humano_ativo": False,
-            "modo_humanizado": False,  # Novo: modo 100% humanizado
-            "ultimo_humano": None,
-            "mensagem_inicial_enviada": False,
-            "objecoes_tratadas": [],
-            "historico_ia": [],
-            "nome_cliente": chat_id.split("@")[0] if "@" in chat_id else chat_id,
-            "criado_em": datetime.now().isoformat()
-        }
+        conversas[chat_id] = nova_conversa(chat_id)
+        conversa_alterada(chat_id)
+    memory_manager.touch(chat_id)
     return conversas[chat_id]
 
+def conversa_alterada(chat_id: str):
+    """Registra mudança de estado da conversa (persistência + sync do painel)"""
+    conversation_store.mark_dirty(chat_id)
+    snapshots.invalidate(chat_id)
+    seq = change_log.record("state", chat_id)
+    if chat_id in conversas:
+        ws_hub.publish({
+            "type": "conversa_updated",
+            "chat_id": chat_id,
+            "seq": seq,
+            "conversa": resumo_conversa(conversas[chat_id])
+        })
+
+def registrar_mensagem(chat_id: str, conversa: Dict, msg: dict):
+    """Adiciona mensagem à conversa, respeitando o limite em memória, e agenda a gravação"""
+    msg = Mensagem.from_dict(msg)
+    funnel_analytics.observar(conversa, msg)
+    conversa["mensagens"].append(msg)
+    memory_manager.trim_messages(conversa)
+    snapshots.invalidate(chat_id)
+    conversation_store.add_message(chat_id, msg)
+    change_log.record("message", chat_id, msg)
+
+async def obter_conversa(chat_id: str) -> Dict:
+    """Como get_conversa, mas recupera do banco conversas que ainda não estão em memória"""
+    if chat_id not in conversas and conversation_store.has_conversa(chat_id):
+        salva = await conversation_store.load_conversa(chat_id)
+        if salva is not None and chat_id not in conversas:
+            conversa = nova_conversa(chat_id)
+            conversa.update(salva)
+            conversas[chat_id] = conversa
+            snapshots.invalidate(chat_id)
+            memory_manager.reloaded += 1
+    return get_conversa(chat_id)
+
 async def broadcast_message(message: dict):
-    """Envia mensagem para todos os clientes WebSocket conectados"""
-    disconnected = []
-    for client in websocket_clients:
-        try:
-            await client.send_json(message)
-        except Exception:
-            disconnected.append(client)
-    
-    for client in disconnected:
-        try:
-            websocket_clients.remove(client)
-        except Exception:
-            pass
+    """Envia mensagem para todos os clientes WebSocket conectados (via filas do hub)"""
+    inicio = time.perf_counter()
+    ws_hub.publish(message)
+    broadcast_latency.observe(time.perf_counter() - inicio)
+
+async def responder_com_ia(mensagem: str, conversa: dict, modo_humano: bool, on_chunk=None) -> str:
+    """Resposta da IA inteira ou, com on_chunk, entregue bloco a bloco (streaming)"""
+    historico = conversa["historico_ia"]
+    resumo = conversa.get("resumo_ia", "")
+    # A origem (modelo, cache, fallback) fica no funil da conversa para o analytics
+    origem = funil_da_conversa(conversa)
+    if on_chunk is None:
+        return await generate_ai_response(mensagem, historico, modo_humano=modo_humano, resumo=resumo, origem=origem)
+    blocos = []
+    async for bloco in generate_ai_response_stream(mensagem, historico, modo_humano=modo_humano, resumo=resumo, origem=origem):
+        blocos.append(bloco)
+        await on_chunk(bloco)
+    return "\n\n".join(blocos)
 
-async def gerar_resposta(chat_id: str, mensagem: str) -> str:
-    """Gera resposta para o cliente"""
+async def gerar_resposta(chat_id: str, mensagem: str, intencoes: Optional[set] = None, on_chunk=None) -> str:
+    """Gera resposta para o cliente (com on_chunk, os blocos da IA são entregues conforme saem)"""
     conversa = get_conversa(chat_id)
+    if intencoes is None:
+        intencoes = detecta_intencoes(mensagem)
     
     # Verificar se cliente pediu atendente humano
-    if detecta_pedido_humano(mensagem):
+    if "pedido_humano" in intencoes:
         conversa["modo_humanizado"] = True
         # Gera resposta humanizada
-        resposta = await generate_ai_response(mensagem, conversa["historico_ia"], modo_humano=True)
+        resposta = await responder_com_ia(mensagem, conversa, True, on_chunk)
         # Atualizar histórico
-        conversa["historico_ia"].append({"role": "user", "content": mensagem})
-        conversa["historico_ia"].append({"role": "assistant", "content": resposta})
+        registrar_turno(conversa, mensagem, resposta)
+        conversa_alterada(chat_id)
         return resposta
     
     # Verificar desconfiança
-    if detecta_desconfianca(mensagem):
+    if "desconfianca" in intencoes:
         if "desconfianca" not in conversa["objecoes_tratadas"]:
             conversa["objecoes_tratadas"].append("desconfianca")
+            funil_da_conversa(conversa)["fonte"] = "desconfianca"
+            conversa_alterada(chat_id)
             return get_resposta_desconfianca()
     
+    # Pergunta frequente com resposta fixa: sai em milissegundos, sem IA
+    if not conversa.get("modo_humanizado", False) and config.get("faq_fast_path", FAQ_FAST_PATH_DEFAULT):
+        resposta = faq_index.responder(mensagem)
+        if resposta is not None:
+            funil_da_conversa(conversa)["fonte"] = "faq"
+            registrar_turno(conversa, mensagem, resposta)
+            conversa_alterada(chat_id)
+            return resposta
+    
     # Gerar resposta com IA (modo normal ou humanizado)
-    resposta = await generate_ai_response(
+    resposta = await responder_com_ia(
         mensagem, 
-        conversa["historico_ia"], 
-        modo_humano=conversa.get("modo_humanizado", False)
+        conversa, 
+        conversa.get("modo_humanizado", False),
+        on_chunk
     )
     
-    # Atualizar histórico
-    conversa["historico_ia"].append({"role": "user", "content": mensagem})
-    conversa["historico_ia"].append({"role": "assistant", "content": resposta})
-    
-    # Limitar histórico
-    if len(conversa["historico_ia"]) > 20:
-        conversa["historico_ia"] = conversa["historico_ia"][-20:]
+    # Atualizar histórico (limitado em tokens e turnos; o excesso vira resumo)
+    registrar_turno(conversa, mensagem, resposta)
+    conversa_alterada(chat_id)
     
     return resposta
 
@@ -500,6 +4782,8 @@ async def gerar_resposta(chat_id: str, mensagem: str) -> str:
 class MessageRequest(BaseModel):
     chat_id: str
     message: str
+    timestamp: Optional[float] = None  # horário da mensagem no WhatsApp (segundos)
+    seq: Optional[int] = None  # ordem em que o bot recebeu (desempata o mesmo segundo)
 
 class ConfigRequest(BaseModel):
     provider: Optional[str] = None
@@ -510,6 +4794,11 @@ class ConfigRequest(BaseModel):
     human_takeover_minutes: Optional[int] = None
     site_url: Optional[str] = None
     business_name: Optional[str] = None
+    intent_keywords: Optional[Dict[str, List[str]]] = None
+    router_failover: Optional[bool] = None
+    router_models: Optional[List[str]] = None
+    stream_replies: Optional[bool] = None
+    faq_fast_path: Optional[bool] = None
 
 class ManualMessageRequest(BaseModel):
     chat_id: str
@@ -517,10 +4806,173 @@ class ManualMessageRequest(BaseModel):
 
 # ==================== ROTAS API ====================
 
+# Lidos só na coleta (sem custo no caminho quente)
+Gauge("conversations_active", "Conversas em memória", func=lambda: len(conversas))
+Gauge("websocket_clients", "Clientes WebSocket conectados", func=lambda: len(ws_hub.clients))
+Gauge("pipeline_queue_depth", "Mensagens na fila do pipeline", func=lambda: message_pipeline.pending)
+Gauge("llm_in_flight", "Chamadas de IA em andamento", func=lambda: message_pipeline.llm_in_flight)
+Counter("faq_checks_total", "Mensagens checadas na base de perguntas frequentes", ("result",),
+        func=lambda: {("local",): faq_index.respondidas, ("llm",): faq_index.consultas - faq_index.respondidas})
+Gauge("outbox_pending", "Mensagens na fila de envio ao WhatsApp", func=lambda: outbound_queue.pending)
+Counter("outbox_deliveries_total", "Tentativas da fila de envio por resultado", ("result",),
+        func=lambda: {(k,): v for k, v in outbound_queue.counts.items()})
+Counter("response_cache_total", "Consultas ao cache de respostas", ("result",),
+        func=lambda: {("hit",): response_cache.hits, ("miss",): response_cache.misses})
+Counter("coalesced_messages_total", "Mensagens agrupadas (chamadas de IA economizadas)",
+        func=lambda: message_coalescer.coalesced)
+Counter("llm_queue_dropped_total", "Pedidos de IA descartados por prazo na fila", ("lane",),
+        func=lambda: {(nome,): llm_scheduler.dropped[p] for p, nome in NOMES_PRIORIDADE.items()})
+
+@app.get("/metrics")
+async def metrics():
+    """Métricas no formato de texto do Prometheus"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.get("/api/health")
 async def health_check():
     return {"status": "ok", "timestamp": datetime.now().isoformat()}
 
+@app.get("/api/http-pool")
+async def get_http_pool():
+    """Estatísticas do pool de conexões HTTP"""
+    return get_http_pool_stats()
+
+@app.get("/api/pipeline")
+async def get_pipeline():
+    """Profundidade da fila e tempos de espera do pipeline de mensagens"""
+    return message_pipeline.stats()
+
+@app.get("/api/context")
+async def get_context_usage():
+    """Tokens de prompt estimados por requisição e orçamento do modelo"""
+    return context_usage.stats()
+
+@app.get("/api/coalescer")
+async def get_coalescer():
+    """Rajadas agrupadas e chamadas de IA economizadas"""
+    return message_coalescer.stats()
+
+@app.get("/api/storage")
+async def get_storage():
+    """Estado da persistência de conversas"""
+    return conversation_store.stats()
+
+@app.get("/api/memory")
+async def get_memory():
+    """Uso de memória: conversas e mensagens em RAM, despejos e RSS do processo"""
+    return memory_manager.stats()
+
+@app.get("/api/snapshots")
+async def get_snapshots():
+    return snapshots.stats()
+
+@app.get("/api/analytics")
+async def get_analytics(request: Request, dias: float = 7, desde: Optional[str] = None,
+                        ate: Optional[str] = None, agrupar: Optional[str] = None):
+    """Funil, tempo de resposta, objeções e resultado por modelo numa janela de tempo.
+    
+    Sem desde/ate: os últimos `dias`. agrupar = hora | dia (padrão: hora até 2 dias).
+    """
+    try:
+        fim = iso_para_ts(ate) / 1_000_000 if ate else time.time()
+        inicio = iso_para_ts(desde) / 1_000_000 if desde else fim - dias * 86400
+    except ValueError:
+        raise HTTPException(status_code=400, detail="desde/ate devem ser datas ISO")
+    inicio = max(inicio, fim - ANALYTICS_MAX_DAYS * 86400)
+    if inicio >= fim:
+        raise HTTPException(status_code=400, detail="janela vazia")
+    agrupar = agrupar or ("hora" if fim - inicio <= 2 * 86400 else "dia")
+    if agrupar not in ("hora", "dia"):
+        raise HTTPException(status_code=400, detail="agrupar deve ser hora ou dia")
+    # Horas inteiras: a hora corrente entra inteira
+    corpo, etag = await funnel_analytics.consulta(_inicio_hora(inicio), _inicio_hora(fim) + 3600, agrupar)
+    return snapshots.respond(request, corpo, etag)
+
+@app.get("/api/analytics/stats")
+async def get_analytics_stats():
+    return funnel_analytics.stats()
+
+@app.get("/api/ws-hub")
+async def get_ws_hub():
+    """Clientes WebSocket conectados e profundidade das filas de envio"""
+    return ws_hub.stats()
+
+@app.get("/api/shared-state")
+async def get_shared_state():
+    return shared_state.stats()
+
+@app.get("/api/outbox")
+async def get_outbox():
+    return outbound_queue.stats()
+
+@app.get("/api/response-cache")
+async def get_response_cache():
+    """Tamanho e taxa de acerto do cache de respostas"""
+    return response_cache.stats()
+
+@app.delete("/api/response-cache")
+async def clear_response_cache():
+    response_cache.clear()
+    return {"success": True}
+
+@app.get("/api/prompts")
+async def get_prompts():
+    """Versão e hash dos prompts renderizados"""
+    return prompt_templates.stats()
+
+@app.post("/api/prompts/reload")
+async def reload_prompts():
+    """Relê prompts/*.txt, menu.json e faq.json do disco"""
+    try:
+        recarregar_prompts()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Erro ao carregar prompts: {e}")
+    # Os outros workers releem os mesmos arquivos
+    ws_hub.publish({"type": "prompts_updated", "files_version": prompt_templates.files_version})
+    return {"success": True, **prompt_templates.stats()}
+
+@app.get("/api/faq")
+async def get_faq():
+    """Mensagens respondidas pela base de perguntas frequentes, sem IA"""
+    return faq_index.stats()
+
+@app.get("/api/menu")
+async def get_menu():
+    return prompt_templates.menu
+
+@app.put("/api/menu")
+async def update_menu(request: Request):
+    """Substitui o cardápio (menu.json) usado nos prompts"""
+    try:
+        menu = await request.json()
+        for categoria in menu["categorias"]:
+            for item in categoria["itens"]:
+                item["preco"] = float(item["preco"])
+                if not item["nome"]:
+                    raise ValueError("item sem nome")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Cardápio inválido: {e}")
+    try:
+        await prompt_templates.save_menu(menu)
+    except OSError as e:
+        errors_total.inc("menu_save")
+        raise HTTPException(status_code=500, detail=f"Erro ao salvar cardápio: {e}")
+    response_cache.clear()
+    await broadcast_message({"type": "config_updated"})
+    # config_updated é local: os outros workers releem o menu.json pelo prompts_updated
+    ws_hub.publish({"type": "prompts_updated", "files_version": prompt_templates.files_version})
+    return {"success": True, **prompt_templates.stats()}
+
+@app.get("/api/router")
+async def get_router():
+    """Saúde, latência e circuit breaker de cada provedor/modelo candidato"""
+    return provider_router.stats()
+
+@app.get("/api/scheduler")
+async def get_scheduler():
+    """Cota por provedor/modelo, filas por prioridade, esperas e descartes"""
+    return llm_scheduler.stats()
+
 @app.get("/api/models")
 async def get_available_models():
     """Retorna lista de modelos disponíveis"""
@@ -531,7 +4983,11 @@ async def get_available_models():
     }
 
 @app.get("/api/status")
-async def get_status():
+async def get_status(request: Request):
+    corpo, etag = snapshots.status(montar_status)
+    return snapshots.respond(request, corpo, etag)
+
+def montar_status() -> dict:
     provider = config.get("provider", "openrouter")
     if provider == "openrouter":
         has_api_key = bool(config.get("openrouter_api_key"))
@@ -563,9 +5019,27 @@ async def get_config():
         "auto_reply": config.get("auto_reply", True),
         "human_takeover_minutes": config.get("human_takeover_minutes", 60),
         "site_url": config.get("site_url", "https://sushiakicb.shop"),
-        "business_name": config.get("business_name", "Sushi Aki")
+        "business_name": config.get("business_name", "Sushi Aki"),
+        "intent_keywords": intent_matcher.keywords,
+        "router_failover": config.get("router_failover", True),
+        "router_models": config.get("router_models"),
+        "stream_replies": config.get("stream_replies", STREAM_REPLIES_DEFAULT),
+        "faq_fast_path": config.get("faq_fast_path", FAQ_FAST_PATH_DEFAULT),
+        "version": config_manager.version
     }
 
+@app.get("/api/config/status")
+async def get_config_status():
+    """Versão da config, gravações (com debounce) e recargas de arquivo"""
+    return config_manager.stats()
+
+@app.post("/api/config/reload")
+async def reload_config():
+    """Relê config.json e .env agora (sem esperar o observador)"""
+    load_env_file()
+    aplicada = await config_manager.reload("api")
+    return {"success": config_manager.last_error is None, "reloaded": aplicada, **config_manager.stats()}
+
 @app.post("/api/config")
 async def update_config(request: ConfigRequest):
     """Atualiza configuração"""
@@ -605,115 +5079,628 @@ async def update_config(request: ConfigRequest):
         config["business_name"] = request.business_name
         updated = True
     
+    if request.intent_keywords is not None:
+        if any(not isinstance(palavras, list) or not all(p.strip() for p in palavras)
+               for palavras in request.intent_keywords.values()):
+            raise HTTPException(status_code=400, detail="intent_keywords: listas de palavras não podem ter itens vazios")
+        config["intent_keywords"] = request.intent_keywords
+        reload_intent_matcher()
+        updated = True
+    
+    if request.router_failover is not None:
+        config["router_failover"] = request.router_failover
+        updated = True
+    
+    if request.router_models is not None:
+        if any(":" not in item for item in request.router_models):
+            raise HTTPException(status_code=400, detail="router_models: use o formato provider:modelo")
+        config["router_models"] = request.router_models
+        updated = True
+    
+    if request.stream_replies is not None:
+        config["stream_replies"] = request.stream_replies
+        updated = True
+    
+    if request.faq_fast_path is not None:
+        config["faq_fast_path"] = request.faq_fast_path
+        updated = True
+    
     if updated:
-        save_config(config)
-        await broadcast_message({"type": "config_updated"})
+        config_manager.schedule_save()
+        await broadcast_message({"type": "config_updated", "version": config_manager.version})
     
     return {"success": True, "config": await get_config()}
 
 @app.get("/api/conversas")
-async def get_conversas():
-    return {"conversas": list(conversas.values())}
+async def get_conversas(request: Request):
+    corpo, etag = snapshots.lista()
+    return snapshots.respond(request, corpo, etag)
+
+@app.get("/api/conversas/resumo")
+async def get_conversas_resumo(limit: int = 50, offset: int = 0):
+    """Lista paginada de resumos (sem histórico), mais recentes primeiro"""
+    limit = max(1, min(limit, 200))
+    offset = max(0, offset)
+    ordenadas = sorted(conversas.values(), key=ultima_atividade, reverse=True)
+    pagina = ordenadas[offset:offset + limit]
+    cabecalho = _json_bytes({
+        "total": len(ordenadas),
+        "next_offset": offset + limit if offset + limit < len(ordenadas) else None,
+        "epoch": change_log.epoch,
+        "seq": change_log.seq
+    })
+    corpo = b'{"conversas":[' + b",".join(snapshots.resumo(c["chat_id"]) for c in pagina) + b"]," + cabecalho[1:]
+    return Response(content=corpo, media_type="application/json")
+
+@app.get("/api/sync")
+async def sync_changes(since: int = 0, epoch: Optional[str] = None, limit: int = SYNC_MAX_EVENTS):
+    """Mensagens novas e mudanças de estado desde o seq informado"""
+    limit = max(1, min(limit, SYNC_MAX_EVENTS))
+    eventos = change_log.since(since, limit) if epoch == change_log.epoch else None
+    if eventos is None:
+        return {"reset": True, "epoch": change_log.epoch, "seq": change_log.seq}
+    
+    mensagens = []
+    alteradas = []
+    removidas = []
+    for seq, tipo, chat_id, message in eventos:
+        if tipo == "message":
+            mensagens.append({"seq": seq, "chat_id": chat_id, "message": message})
+        elif tipo == "state" and chat_id not in alteradas:
+            alteradas.append(chat_id)
+        elif tipo == "delete":
+            removidas.append(chat_id)
+    
+    ultimo_seq = eventos[-1][0] if eventos else since
+    return {
+        "reset": False,
+        "epoch": change_log.epoch,
+        "seq": ultimo_seq,
+        "has_more": ultimo_seq < change_log.seq,
+        "mensagens": mensagens,
+        "conversas": [resumo_conversa(conversas[c]) for c in alteradas if c in conversas],
+        "removidas": [c for c in removidas if c not in conversas]
+    }
+
+@app.get("/api/conversa/{chat_id}/mensagens")
+async def get_mensagens_paginadas(chat_id: str, before: Optional[str] = None, limit: int = 50):
+    """Histórico de uma conversa em páginas, do mais novo para o mais antigo (before = timestamp)"""
+    if chat_id not in conversas and not conversation_store.has_conversa(chat_id):
+        raise HTTPException(status_code=404, detail="Conversa não encontrada")
+    limit = max(1, min(limit, 200))
+    conversa = await obter_conversa(chat_id)
+    
+    try:
+        limite = iso_para_ts(before) if before else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="before deve ser um timestamp ISO")
+    em_memoria = [m for m in conversa["mensagens"] if limite is None or m.ts < limite]
+    pagina = em_memoria[-limit:]
+    if len(pagina) < limit:
+        # O resto está só no banco (mensagens antigas cortadas da memória)
+        mais_antiga = pagina[0]["timestamp"] if pagina else before
+        anteriores = await conversation_store.load_messages(chat_id, mais_antiga, limit - len(pagina))
+        pagina = anteriores + pagina
+    
+    return Response(content=_json_bytes({
+        "chat_id": chat_id,
+        "mensagens": pagina,
+        "before": pagina[0]["timestamp"] if len(pagina) == limit else None
+    }), media_type="application/json")
+
+@app.post("/api/conversa/{chat_id}/lida")
+async def mark_conversa_lida(chat_id: str):
+    """Zera o contador de não lidas"""
+    async with shared_state.chat_lock(chat_id):
+        conversa = await obter_conversa(chat_id)
+        if conversa.get("nao_lidas"):
+            conversa["nao_lidas"] = 0
+            conversa_alterada(chat_id)
+    return {"success": True}
 
 @app.get("/api/conversa/{chat_id}")
-async def get_conversa_by_id(chat_id: str):
-    if chat_id not in conversas:
+async def get_conversa_by_id(chat_id: str, request: Request):
+    if chat_id not in conversas and not conversation_store.has_conversa(chat_id):
         raise HTTPException(status_code=404, detail="Conversa não encontrada")
-    return conversas[chat_id]
+    await obter_conversa(chat_id)
+    return snapshots.respond(request, snapshots.completa(chat_id), snapshots.etag_chat(chat_id))
 
 @app.post("/api/takeover/{chat_id}")
 async def human_takeover(chat_id: str):
-    conversa = get_conversa(chat_id)
-    conversa["humano_ativo"] = True
-    conversa["ultimo_humano"] = datetime.now().isoformat()
-    await broadcast_message({"type": "human_takeover", "chat_id": chat_id})
+    async with shared_state.chat_lock(chat_id):
+        conversa = await obter_conversa(chat_id)
+        conversa["humano_ativo"] = True
+        conversa["ultimo_humano"] = datetime.now().isoformat()
+        funnel_analytics.etapa(conversa, "atendimento_humano")
+        conversa_alterada(chat_id)
+        await broadcast_message({"type": "human_takeover", "chat_id": chat_id})
     return {"success": True}
 
 @app.post("/api/release/{chat_id}")
 async def release_to_bot(chat_id: str):
-    conversa = get_conversa(chat_id)
-    conversa["humano_ativo"] = False
-    conversa["modo_humanizado"] = False  # Reset modo humanizado
-    await broadcast_message({"type": "bot_resumed", "chat_id": chat_id})
+    async with shared_state.chat_lock(chat_id):
+        conversa = await obter_conversa(chat_id)
+        conversa["humano_ativo"] = False
+        conversa["modo_humanizado"] = False  # Reset modo humanizado
+        conversa_alterada(chat_id)
+        await broadcast_message({"type": "bot_resumed", "chat_id": chat_id})
     return {"success": True}
 
 # URL do bot WhatsApp (Node.js)
 WHATSAPP_BOT_URL = os.getenv("WHATSAPP_BOT_URL", "http://localhost:3001")
 
-async def send_to_whatsapp(chat_id: str, message: str) -> dict:
-    """Envia mensagem para o WhatsApp através do bot Node.js"""
+async def send_to_whatsapp(chat_id: str, message: str, streaming: bool = False) -> dict:
+    """Envia mensagem para o WhatsApp através do bot Node.js.
+    
+    Com streaming=True o bot não simula digitação (o tempo de geração já é
+    real) e mantém o "digitando..." ligado para o próximo bloco.
+    """
+    payload = {"chat_id": chat_id, "message": message}
+    if streaming:
+        payload["simulate_typing"] = False
+        payload["keep_typing"] = True
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{WHATSAPP_BOT_URL}/send-message",
-                json={"chat_id": chat_id, "message": message},
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result
-                else:
-                    error_text = await response.text()
-                    return {"success": False, "error": f"Erro {response.status}: {error_text}"}
+        session = get_http_session()
+        async with session.post(
+            f"{WHATSAPP_BOT_URL}/send-message",
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=WHATSAPP_BOT_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        ) as response:
+            if response.status == 200:
+                result = await response.json()
+                return result
+            else:
+                error_text = await response.text()
+                errors_total.inc("whatsapp_send")
+                return {"success": False, "error": f"Erro {response.status}: {error_text}", "status": response.status}
     except aiohttp.ClientError as e:
+        errors_total.inc("whatsapp_send")
         return {"success": False, "error": f"Erro de conexão: {str(e)}"}
     except Exception as e:
+        errors_total.inc("whatsapp_send")
         return {"success": False, "error": str(e)}
 
-@app.post("/api/send-message")
-async def send_manual_message(request: ManualMessageRequest):
-    """Envia mensagem manual do painel para o WhatsApp"""
-    conversa = get_conversa(request.chat_id)
+# ==================== FILA DE ENVIO (WHATSAPP) ====================
+# Mensagens do painel entram numa fila gravada em disco e o operador recebe a
+# confirmação na hora. Até OUTBOX_CONCURRENCY envios em paralelo, sempre um por
+# chat e em ordem. Falha temporária tenta de novo com backoff exponencial e
+# segura as seguintes do mesmo chat. Cada mudança de estado vai para o painel
+# pelo WebSocket ("delivery_status").
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", 4))
+OUTBOX_MAX_PENDING = int(os.getenv("OUTBOX_MAX_PENDING", 1000))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 6))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", 1.0))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", 60))
+OUTBOX_KEEP_HOURS = float(os.getenv("OUTBOX_KEEP_HOURS", 24))
+# Envio pendente sem sinal do worker dono por esse tempo é assumido por outro
+OUTBOX_CLAIM_AFTER = float(os.getenv("OUTBOX_CLAIM_AFTER", 90))
+
+ENVIO_PENDENTE = ("queued", "sending", "retrying")
+
+class OutboxFull(Exception):
+    """Fila de envio cheia (backpressure)"""
+
+class OutboundQueue:
+    def __init__(self, path: Optional[Path], concurrency: int, max_pending: int,
+                 max_attempts: int, retry_base: float, retry_max: float):
+        self.path = path
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+        self._db = None
+        self._chats: Dict[str, deque] = {}   # envios pendentes por chat, em ordem
+        self._ready: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._ids = count(1)
+        self.pending = 0
+        self.reserved = 0
+        self.sending = 0
+        self.counts: Dict[str, int] = {"sent": 0, "failed": 0, "retried": 0}
     
-    # Enviar para o WhatsApp de verdade!
-    whatsapp_result = await send_to_whatsapp(request.chat_id, request.message)
+    async def _run(self, fn, *args):
+        if self._db is None:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
     
-    if not whatsapp_result.get("success"):
-        return {
-            "success": False, 
-            "error": whatsapp_result.get("error", "Falha ao enviar para WhatsApp")
+    def _open(self):
+        import sqlite3
+        self._db = sqlite3.connect(str(self.path), timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS envios (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE NOT NULL,
+                chat_id TEXT NOT NULL,
+                message_id TEXT,
+                texto TEXT NOT NULL,
+                status TEXT NOT NULL,
+                tentativas INTEGER NOT NULL DEFAULT 0,
+                erro TEXT,
+                whatsapp_id TEXT,
+                dono TEXT,
+                criado_em REAL NOT NULL,
+                atualizado_em REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_envios_status ON envios (status, atualizado_em);
+        """)
+    
+    def _sql_insert(self, job: dict):
+        with self._db:
+            self._db.execute(
+                "INSERT INTO envios (id, chat_id, message_id, texto, status, tentativas, dono, criado_em, atualizado_em) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                (job["id"], job["chat_id"], job["message_id"], job["texto"], job["status"],
+                 shared_state.worker_id, job["criado_em"], time.time())
+            )
+    
+    def _sql_update(self, job: dict):
+        with self._db:
+            self._db.execute(
+                "UPDATE envios SET status = ?, tentativas = ?, erro = ?, whatsapp_id = ?, atualizado_em = ? WHERE id = ?",
+                (job["status"], job["tentativas"], job["erro"], job["whatsapp_id"], time.time(), job["id"])
+            )
+    
+    def _sql_claim(self, limite: Optional[float]) -> list:
+        """Assume envios pendentes de um processo anterior (ou de worker que parou de dar sinal)"""
+        dono = shared_state.worker_id
+        with self._db:
+            if limite is None:
+                self._db.execute("UPDATE envios SET dono = ? WHERE status IN (?, ?, ?)", (dono, *ENVIO_PENDENTE))
+            else:
+                self._db.execute(
+                    "UPDATE envios SET dono = ? WHERE status IN (?, ?, ?) AND dono != ? AND atualizado_em < ?",
+                    (dono, *ENVIO_PENDENTE, dono, limite)
+                )
+        return self._db.execute(
+            "SELECT id, chat_id, message_id, texto, tentativas, criado_em FROM envios "
+            "WHERE dono = ? AND status IN (?, ?, ?) ORDER BY seq",
+            (dono, *ENVIO_PENDENTE)
+        ).fetchall()
+    
+    def _sql_heartbeat(self):
+        """Mantém vivos os envios deste worker e apaga concluídos antigos"""
+        agora = time.time()
+        with self._db:
+            self._db.execute(
+                "UPDATE envios SET atualizado_em = ? WHERE dono = ? AND status IN (?, ?, ?)",
+                (agora, shared_state.worker_id, *ENVIO_PENDENTE)
+            )
+            self._db.execute(
+                "DELETE FROM envios WHERE status IN ('sent', 'failed') AND atualizado_em < ?",
+                (agora - OUTBOX_KEEP_HOURS * 3600,)
+            )
+    
+    async def start(self):
+        self._ready = asyncio.Queue()
+        if self.path is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._open)
+            # Um worker só: tudo que ficou pendente é deste processo, que reiniciou
+            await self._resume(None if not shared_state.distributed else time.time() - OUTBOX_CLAIM_AFTER)
+            self._tasks.append(asyncio.create_task(self._maintenance_loop()))
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+    
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
+    
+    async def _resume(self, limite: Optional[float]):
+        known = {job["id"] for fila in self._chats.values() for job in fila}
+        for job_id, chat_id, message_id, texto, tentativas, criado_em in await self._run(self._sql_claim, limite):
+            if job_id in known:
+                continue
+            self._push({
+                "id": job_id, "chat_id": chat_id, "message_id": message_id, "texto": texto,
+                "status": "queued", "tentativas": tentativas, "erro": None, "whatsapp_id": None,
+                "criado_em": criado_em
+            })
+    
+    async def _maintenance_loop(self):
+        while True:
+            await asyncio.sleep(OUTBOX_CLAIM_AFTER / 3)
+            try:
+                await self._run(self._sql_heartbeat)
+                if shared_state.distributed:
+                    await self._resume(time.time() - OUTBOX_CLAIM_AFTER)
+            except Exception as e:
+                print(f"Erro na manutenção da fila de envio: {e}")
+    
+    def _push(self, job: dict):
+        self.pending += 1
+        fila = self._chats.get(job["chat_id"])
+        if fila is None:
+            # Chat sem envio em andamento: entra na fila de prontos
+            self._chats[job["chat_id"]] = deque([job])
+            self._ready.put_nowait(job["chat_id"])
+        else:
+            fila.append(job)
+    
+    def new_id(self) -> str:
+        return f"out_{int(time.time() * 1000):x}_{next(self._ids)}"
+    
+    def reserve(self):
+        """Vaga na fila antes de registrar a mensagem; OutboxFull se cheia"""
+        if self.pending + self.reserved >= self.max_pending:
+            raise OutboxFull()
+        self.reserved += 1
+    
+    def release(self):
+        """Devolve a vaga de reserve() que não virou envio"""
+        self.reserved -= 1
+    
+    async def enqueue(self, chat_id: str, texto: str, message_id: Optional[str] = None,
+                      job_id: Optional[str] = None, reserved: bool = False) -> dict:
+        """Grava o envio e devolve na hora; a entrega segue em segundo plano.
+        
+        reserved=True: a vaga já foi tomada com reserve().
+        """
+        if reserved:
+            self.release()
+        elif self.pending + self.reserved >= self.max_pending:
+            raise OutboxFull()
+        job = {
+            "id": job_id or self.new_id(),
+            "chat_id": chat_id, "message_id": message_id, "texto": texto,
+            "status": "queued", "tentativas": 0, "erro": None, "whatsapp_id": None,
+            "criado_em": time.time()
         }
+        try:
+            await self._run(self._sql_insert, job)
+        except Exception as e:
+            # A mensagem já está na conversa: não pode ficar "na fila" para sempre
+            job["status"], job["erro"] = "failed", str(e)
+            self.counts["failed"] += 1
+            self._notify(job)
+            raise
+        self._push(job)
+        self._notify(job)
+        return job
     
-    # Salvar mensagem no histórico
-    msg = {
-        "id": f"manual_{datetime.now().timestamp()}",
-        "from": "humano",
-        "text": request.message,
-        "timestamp": datetime.now().isoformat(),
-        "whatsapp_id": whatsapp_result.get("messageId")
-    }
-    conversa["mensagens"].append(msg)
-    conversa["humano_ativo"] = True
-    conversa["ultimo_humano"] = datetime.now().isoformat()
+    def _notify(self, job: dict):
+        """Atualiza a mensagem na conversa e avisa o painel (/api/sync e WebSocket)"""
+        evento = {
+            "type": "delivery_status",
+            "chat_id": job["chat_id"],
+            "message_id": job["message_id"],
+            "outbox_id": job["id"],
+            "status": job["status"],
+            "attempts": job["tentativas"],
+            "error": job["erro"],
+            "whatsapp_id": job["whatsapp_id"]
+        }
+        if job["message_id"] and job["status"] in ("sent", "failed"):
+            # Grava o estado final com a mensagem (mesmo se a conversa saiu da memória)
+            conversation_store.update_message_status(job["chat_id"], job["message_id"], job["status"], job["whatsapp_id"])
+        conversa = conversas.get(job["chat_id"])
+        if conversa is not None and job["message_id"]:
+            for msg in reversed(conversa["mensagens"]):
+                if msg.get("id") == job["message_id"]:
+                    msg["status"] = job["status"]
+                    if job["whatsapp_id"]:
+                        msg["whatsapp_id"] = job["whatsapp_id"]
+                    snapshots.invalidate(job["chat_id"])
+                    # Mesmo id: o painel troca a mensagem que já tem pela atualizada
+                    change_log.record("message", job["chat_id"], msg)
+                    evento["message"] = msg
+                    break
+        ws_hub.publish(evento)
     
-    await broadcast_message({
-        "type": "message_sent",
-        "chat_id": request.chat_id,
-        "message": msg
-    })
+    def backoff(self, tentativas: int) -> float:
+        atraso = min(self.retry_max, self.retry_base * (2 ** (tentativas - 1)))
+        return atraso * random.uniform(0.8, 1.2)
+    
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            fila = self._chats.get(chat_id)
+            if not fila:
+                self._chats.pop(chat_id, None)
+                continue
+            job = fila[0]
+            try:
+                atraso = await self._deliver(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Erro no envio {job['id']}: {e}")
+                # Mesmo caminho de uma falha comum: contadores, tabela de envios e painel
+                atraso = await self._settle(job, {"success": False, "error": str(e)})
+            if atraso is not None:
+                # Segura o chat: as próximas mensagens dele esperam esta
+                asyncio.get_running_loop().call_later(atraso, self._ready.put_nowait, chat_id)
+                continue
+            fila.popleft()
+            self.pending -= 1
+            if fila:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+    
+    async def _deliver(self, job: dict) -> Optional[float]:
+        """Uma tentativa de envio; devolve o atraso até a próxima ou None se terminou"""
+        job["tentativas"] += 1
+        job["status"] = "sending"
+        self._notify(job)
+        self.sending += 1
+        try:
+            resultado = await send_to_whatsapp(job["chat_id"], job["texto"])
+        finally:
+            self.sending -= 1
+        return await self._settle(job, resultado)
     
-    return {"success": True, "message": msg}
+    async def _settle(self, job: dict, resultado: dict) -> Optional[float]:
+        """Aplica o resultado de uma tentativa; devolve o atraso até a próxima ou None se terminou"""
+        atraso = None
+        if resultado.get("success"):
+            job["status"], job["erro"] = "sent", None
+            job["whatsapp_id"] = resultado.get("messageId")
+            self.counts["sent"] += 1
+        else:
+            job["erro"] = resultado.get("error")
+            # 4xx = pedido inválido, não adianta repetir
+            definitivo = 400 <= (resultado.get("status") or 0) < 500
+            if definitivo or job["tentativas"] >= self.max_attempts:
+                job["status"] = "failed"
+                self.counts["failed"] += 1
+            else:
+                job["status"] = "retrying"
+                atraso = self.backoff(job["tentativas"])
+                self.counts["retried"] += 1
+        try:
+            await self._run(self._sql_update, job)
+        except Exception as e:
+            print(f"Erro ao gravar estado do envio {job['id']}: {e}")
+        self._notify(job)
+        return atraso
+    
+    def stats(self) -> dict:
+        return {
+            "persistent": self.path is not None,
+            "pending": self.pending,
+            "reserved": self.reserved,
+            "sending": self.sending,
+            "chats": len(self._chats),
+            "max_pending": self.max_pending,
+            "concurrency": self.concurrency,
+            "max_attempts": self.max_attempts,
+            **self.counts
+        }
+
+outbound_queue = OutboundQueue(
+    DB_FILE if conversation_store.persistent else None,
+    OUTBOX_CONCURRENCY, OUTBOX_MAX_PENDING, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX
+)
+
+@app.post("/api/send-message")
+async def send_manual_message(request: ManualMessageRequest):
+    """Envia mensagem manual do painel para o WhatsApp (confirma na hora; entrega pela fila)"""
+    try:
+        outbound_queue.reserve()
+    except OutboxFull:
+        raise HTTPException(status_code=503, detail="Fila de envio cheia, tente novamente", headers={"Retry-After": "1"})
+    
+    msg = Mensagem("humano", request.message)
+    # Antes de registrar: a cópia gravada no banco já sai com o estado de entrega
+    msg["status"] = "queued"
+    msg["outbox_id"] = outbound_queue.new_id()
+    try:
+        # Mensagem e takeover primeiro; só depois a fila, para o worker de envio
+        # já encontrar a mensagem na conversa ao atualizar o estado
+        async with shared_state.chat_lock(request.chat_id):
+            conversa = await obter_conversa(request.chat_id)
+            conversa["humano_ativo"] = True
+            conversa["ultimo_humano"] = datetime.now().isoformat()
+            conversa["nao_lidas"] = 0
+            registrar_mensagem(request.chat_id, conversa, msg)
+            conversa_alterada(request.chat_id)
+            
+            await broadcast_message({
+                "type": "message_sent",
+                "chat_id": request.chat_id,
+                "message": msg
+            })
+    except BaseException:
+        outbound_queue.release()
+        raise
+    
+    await outbound_queue.enqueue(request.chat_id, request.message, msg["id"], msg["outbox_id"], reserved=True)
+    return {"success": True, "queued": True, "message": msg}
 
 @app.post("/api/webhook/message")
 async def receive_message(request: MessageRequest):
-    chat_id = request.chat_id
-    mensagem = request.message
-    
-    conversa = get_conversa(chat_id)
+    inicio = time.perf_counter()
+    resultado = None
+    admitida = False
+    try:
+        # Sobrecarga recusa antes de registrar: o bot reenvia após o Retry-After sem duplicar.
+        # O lugar na fila conta desde já, inclusive durante a janela de agrupamento.
+        message_pipeline.admit()
+        admitida = True
+        # A mensagem aparece no painel na hora; a resposta espera a janela de agrupamento
+        ordem = None
+        if request.timestamp is not None or request.seq is not None:
+            ordem = (request.timestamp or 0, request.seq or 0)
+        async with shared_state.chat_lock(request.chat_id):
+            await registrar_mensagem_cliente(request.chat_id, request.message, ordem)
+        mensagem = await message_coalescer.submit(request.chat_id, request.message, ordem)
+        if mensagem is None:
+            resultado = {"response": None, "reason": "coalesced"}
+            return resultado
+        async with message_pipeline.chat_slot(request.chat_id, admitted=True):
+            async with shared_state.chat_lock(request.chat_id):
+                resultado = await processar_mensagem(request.chat_id, mensagem)
+            return resultado
+    except PipelineFull:
+        resultado = {"reason": "overloaded"}
+        return JSONResponse(
+            status_code=503,
+            content={"response": None, "reason": "overloaded"},
+            headers={"Retry-After": "1"}
+        )
+    except Exception:
+        errors_total.inc("webhook")
+        resultado = {"reason": "error"}
+        raise
+    finally:
+        if admitida:
+            message_pipeline.release()
+        outcome = (resultado or {}).get("reason") or ("replied" if resultado else "cancelled")
+        webhook_latency.observe(time.perf_counter() - inicio, outcome)
+
+# Ordem do WhatsApp das últimas mensagens registradas por chat (neste processo):
+# as requisições do bot saem em paralelo, e a que chegar atrasada entra antes
+# das posteriores em vez de no fim da conversa
+_ordens_recentes: Dict[str, deque] = {}
+
+def _posteriores_na_ordem(chat_id: str, ordem: Optional[tuple]) -> List[Mensagem]:
+    if ordem is None:
+        return []
+    recentes = _ordens_recentes.get(chat_id)
+    if recentes is None:
+        if len(_ordens_recentes) >= 4096:
+            _ordens_recentes.clear()
+        recentes = _ordens_recentes[chat_id] = deque(maxlen=COALESCE_MAX_MESSAGES)
+    return [msg for outra, msg in recentes if outra > ordem]
+
+async def registrar_mensagem_cliente(chat_id: str, mensagem: str, ordem: Optional[tuple] = None):
+    conversa = await obter_conversa(chat_id)
     
-    msg_recebida = {
-        "id": f"recv_{datetime.now().timestamp()}",
-        "from": "cliente",
-        "text": mensagem,
-        "timestamp": datetime.now().isoformat()
-    }
-    conversa["mensagens"].append(msg_recebida)
+    msg_recebida = Mensagem("cliente", mensagem)
+    posteriores = _posteriores_na_ordem(chat_id, ordem)
+    if posteriores:
+        # Logo antes da primeira posterior: o banco ordena por timestamp
+        msg_recebida.ts = min(msg.ts for msg in posteriores) - 1
+    conversa["nao_lidas"] = conversa.get("nao_lidas", 0) + 1
+    registrar_mensagem(chat_id, conversa, msg_recebida)
+    if ordem is not None:
+        _ordens_recentes[chat_id].append((ordem, msg_recebida))
+    if posteriores:
+        mensagens = conversa["mensagens"]
+        if mensagens and mensagens[-1] is msg_recebida:
+            mensagens.pop()
+            pos = len(mensagens)
+            while pos > 0 and mensagens[pos - 1].ts > msg_recebida.ts:
+                pos -= 1
+            mensagens.insert(pos, msg_recebida)
+    conversa_alterada(chat_id)
     
     await broadcast_message({
         "type": "message_received",
         "chat_id": chat_id,
         "message": msg_recebida
     })
+
+async def processar_mensagem(chat_id: str, mensagem: str) -> dict:
+    """Responde a uma mensagem (ou rajada agrupada) já registrada; roda com o lock do chat"""
+    conversa = await obter_conversa(chat_id)
     
     # Verificar se bot pode responder
     if conversa["humano_ativo"]:
@@ -722,40 +5709,63 @@ async def receive_message(request: MessageRequest):
             diff_minutes = (datetime.now() - ultimo).total_seconds() / 60
             if diff_minutes > config.get("human_takeover_minutes", 60):
                 conversa["humano_ativo"] = False
+                conversa_alterada(chat_id)
             else:
                 return {"response": None, "reason": "human_active"}
     
     if not config.get("auto_reply", True):
         return {"response": None, "reason": "auto_reply_disabled"}
     
+    intencoes = detecta_intencoes(mensagem)
+    
+    # Streaming: cada bloco da IA vai direto para o WhatsApp; se o bot não
+    # aceitar um envio, o restante volta na resposta do webhook como antes
+    entregues = 0
+    sobras: List[str] = []
+    
+    async def entregar_bloco(bloco: str):
+        nonlocal entregues
+        if not sobras:
+            resultado = await send_to_whatsapp(chat_id, bloco, streaming=True)
+            if resultado.get("success"):
+                entregues += 1
+                await registrar_resposta_bot(chat_id, conversa, bloco)
+                return
+        sobras.append(bloco)
+    
+    on_chunk = entregar_bloco if config.get("stream_replies", STREAM_REPLIES_DEFAULT) else None
+    
     # PRIMEIRO: Verificar se cliente pediu atendente humano
-    if detecta_pedido_humano(mensagem):
+    if "pedido_humano" in intencoes:
         conversa["modo_humanizado"] = True
         conversa["mensagem_inicial_enviada"] = True  # Pula mensagem inicial
-        resposta = await gerar_resposta(chat_id, mensagem)
+        resposta = await gerar_resposta(chat_id, mensagem, intencoes, on_chunk)
     # SEGUNDO: Mensagem inicial para novos clientes
     elif not conversa["mensagem_inicial_enviada"]:
         resposta = get_mensagem_inicial()
         conversa["mensagem_inicial_enviada"] = True
+        funil_da_conversa(conversa)["fonte"] = "inicial"
     # TERCEIRO: Resposta normal
     else:
-        resposta = await gerar_resposta(chat_id, mensagem)
+        resposta = await gerar_resposta(chat_id, mensagem, intencoes, on_chunk)
     
-    msg_enviada = {
-        "id": f"sent_{datetime.now().timestamp()}",
-        "from": "bot",
-        "text": resposta,
-        "timestamp": datetime.now().isoformat()
-    }
-    conversa["mensagens"].append(msg_enviada)
+    if entregues:
+        if not sobras:
+            return {"response": None, "reason": "streamed", "chunks": entregues}
+        resposta = "\n\n".join(sobras)
+    
+    await registrar_resposta_bot(chat_id, conversa, resposta)
+    return {"response": resposta}
+
+async def registrar_resposta_bot(chat_id: str, conversa: dict, resposta: str):
+    msg_enviada = Mensagem("bot", resposta)
+    registrar_mensagem(chat_id, conversa, msg_enviada)
     
     await broadcast_message({
         "type": "message_sent",
         "chat_id": chat_id,
         "message": msg_enviada
     })
-    
-    return {"response": resposta}
 
 @app.post("/api/webhook/status")
 async def update_whatsapp_status(request: Request):
@@ -774,7 +5784,10 @@ async def update_whatsapp_status(request: Request):
         whatsapp_status["phone_number"] = status["phone_number"]
     if "status_text" in status:
         whatsapp_status["status_text"] = status["status_text"]
+    snapshots.status_changed()
     
+    # Worker que subir depois lê daqui; os que estão no ar recebem o evento
+    await shared_state.set("whatsapp_status", whatsapp_status)
     await broadcast_message({"type": "status_update", "status": whatsapp_status})
     
     return {"success": True}
@@ -794,11 +5807,15 @@ async def test_ai():
         if provider == "openrouter":
             if not config.get("openrouter_api_key"):
                 return {"success": False, "error": "API Key da OpenRouter não configurada"}
-            response = await call_openrouter(messages, model)
+            await llm_scheduler.acquire(provider, model, PRIORIDADE_FUNDO)
+            async with message_pipeline.llm_slot():
+                response = await call_openrouter(messages, model)
         else:
             if not config.get("gemini_api_key"):
                 return {"success": False, "error": "API Key do Gemini não configurada"}
-            response = call_gemini(messages, model, "Responda apenas: OK, funcionando!")
+            await llm_scheduler.acquire(provider, model, PRIORIDADE_FUNDO)
+            async with message_pipeline.llm_slot():
+                response = await call_gemini(messages, model, "Responda apenas: OK, funcionando!")
         
         return {
             "success": True, 
@@ -811,58 +5828,149 @@ async def test_ai():
 
 @app.delete("/api/conversas")
 async def clear_conversas():
-    global conversas
-    conversas = {}
+    conversas.clear()
+    snapshots.invalidate_all()
+    conversation_store.clear()
+    memory_manager.forget()
+    seq = change_log.record("clear")
+    ws_hub.publish({"type": "conversas_cleared", "seq": seq})
     return {"success": True}
 
 @app.delete("/api/conversa/{chat_id}")
 async def delete_conversa(chat_id: str):
-    if chat_id in conversas:
-        del conversas[chat_id]
+    if chat_id in conversas or conversation_store.has_conversa(chat_id):
+        conversas.pop(chat_id, None)
+        snapshots.invalidate(chat_id)
+        conversation_store.delete_conversa(chat_id)
+        memory_manager.forget(chat_id)
+        seq = change_log.record("delete", chat_id)
+        ws_hub.publish({"type": "conversa_removed", "chat_id": chat_id, "seq": seq})
         return {"success": True}
     raise HTTPException(status_code=404, detail="Conversa não encontrada")
 
+@app.get("/api/export")
+async def export_conversas(formato: str = "jsonl.gz", chat_id: Optional[str] = None,
+                          desde: Optional[str] = None, ate: Optional[str] = None):
+    """Baixa conversas e mensagens em streaming (chat_id aceita vários, separados por vírgula)"""
+    try:
+        periodo = normalizar_periodo(desde, ate)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="desde/ate devem ser datas ISO")
+    chat_ids = [c.strip() for c in chat_id.split(",") if c.strip()] if chat_id else None
+    filtros = {"chat_ids": chat_ids, "desde": desde, "ate": ate}
+    try:
+        writer = criar_export_writer(formato, filtros)
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    nome = f"conversas-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{writer.extensao}"
+    return StreamingResponse(
+        exportar_conversas(writer, chat_ids, *periodo),
+        media_type=writer.media_type,
+        headers={"Content-Disposition": f'attachment; filename="{nome}"'}
+    )
+
+@app.post("/api/import")
+async def import_conversas(request: Request, mesclar: bool = False, limpar: bool = False):
+    """Importa um arquivo de /api/export (JSONL, gzip ou Parquet) enviado como corpo da requisição.
+    
+    Sem mesclar, cada conversa do arquivo substitui a existente; limpar=true
+    apaga todas as conversas antes (restauração completa).
+    """
+    if limpar:
+        await clear_conversas()
+        await conversation_store.flush()
+    importador = ConversationImporter(mesclar=mesclar)
+    partes = request.stream()
+    try:
+        # Parquet precisa de seek: vai para um arquivo temporário antes de ler
+        primeira = b""
+        async for primeira in partes:
+            if primeira:
+                break
+        if primeira[:4] == b"PAR1":
+            with tempfile.SpooledTemporaryFile(max_size=8 << 20) as arquivo:
+                arquivo.write(primeira)
+                async for parte in partes:
+                    arquivo.write(parte)
+                arquivo.seek(0)
+                await importador.add_all(ler_parquet(arquivo))
+        else:
+            async def corpo():
+                yield primeira
+                async for parte in partes:
+                    yield parte
+            await importador.add_all(ler_jsonl(corpo()))
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        # O que já foi gravado fica; o painel recarrega de qualquer jeito
+        if importador.vistos:
+            conversas_importadas(sorted(importador.vistos))
+    return {"success": True, **importador.stats()}
+
+@app.get("/api/export/formatos")
+async def get_export_formatos():
+    formatos = ["jsonl.gz", "jsonl"] + (["parquet"] if parquet_disponivel() else [])
+    return {"formatos": formatos, "chunk_rows": EXPORT_CHUNK_ROWS, "import_batch_rows": IMPORT_BATCH_ROWS}
+
 # ==================== WEBSOCKET ====================
 
 @app.websocket("/api/ws")
 async def websocket_endpoint(websocket: WebSocket):
+    """Eventos em tempo real. Comandos: ping, subscribe {topics: [...], chat_id}"""
     await websocket.accept()
-    websocket_clients.append(websocket)
     
-    try:
-        await websocket.send_json({
-            "type": "init",
-            "status": whatsapp_status,
-            "config": {
-                "auto_reply": config.get("auto_reply", True),
-                "human_takeover_minutes": config.get("human_takeover_minutes", 60)
-            },
-            "conversas": list(conversas.values())
-        })
-    except Exception:
-        pass
+    # O init leva só resumos (já codificados); o histórico vem de /api/conversa/{id}/mensagens
+    cabecalho = json.dumps({
+        "type": "init",
+        "status": whatsapp_status,
+        "config": {
+            "auto_reply": config.get("auto_reply", True),
+            "human_takeover_minutes": config.get("human_takeover_minutes", 60)
+        },
+        "epoch": change_log.epoch,
+        "seq": change_log.seq
+    }, ensure_ascii=False)
+    client = ws_hub.connect(websocket, cabecalho[:-1] + ',"conversas":' + snapshots.resumos_json() + "}")
     
     try:
         while True:
             data = await websocket.receive_text()
             try:
                 cmd = json.loads(data)
-                if cmd.get("type") == "ping":
-                    await websocket.send_json({"type": "pong"})
             except Exception:
-                pass
+                continue
+            if cmd.get("type") == "ping":
+                ws_hub.send(client, {"type": "pong"})
+            elif cmd.get("type") == "subscribe":
+                topics = set(cmd.get("topics") or [])
+                if cmd.get("chat_id"):
+                    topics.add(f"chat:{cmd['chat_id']}")
+                client.topics = topics or {"*"}
+                ws_hub.send(client, {"type": "subscribed", "topics": sorted(client.topics)})
     except WebSocketDisconnect:
         pass
+    except Exception:
+        pass
     finally:
-        try:
-            websocket_clients.remove(websocket)
-        except Exception:
-            pass
+        ws_hub.disconnect(client)
 
 # ==================== STARTUP ====================
 
 @app.on_event("startup")
 async def startup_event():
+    get_http_session()
+    await conversation_store.start()
+    await shared_state.start()
+    await outbound_queue.start()
+    await funnel_analytics.start()
+    whatsapp_status.update(await shared_state.get("whatsapp_status") or {})
+    if IMPORT_ON_STARTUP:
+        await importar_na_subida(Path(IMPORT_ON_STARTUP))
+    asyncio.create_task(preload_recent_conversas())
+    memory_manager.start()
+    config_manager.start()
+    
     provider = config.get("provider", "openrouter")
     model = config.get("selected_model", "deepseek/deepseek-r1:free")
     if provider == "openrouter":
@@ -873,6 +5981,7 @@ async def startup_event():
     print("=" * 60)
     print("🍣 Sushi Aki Bot - Backend iniciado")
     print(f"📝 Config file: {CONFIG_FILE}")
+    print(f"🔀 Estado compartilhado: {shared_state.backend} (worker {shared_state.worker_id})")
     print(f"🤖 Provedor: {provider.upper()}")
     print(f"🧠 Modelo: {model}")
     print(f"🔑 API Key configurada: {'Sim' if has_key else 'Não'}")
@@ -880,7 +5989,27 @@ async def startup_event():
     print(f"🐺 Modo Lobo de Wall Street: ATIVADO")
     print("=" * 60)
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    memory_manager.stop()
+    await config_manager.close()
+    await outbound_queue.close()
+    await funnel_analytics.close()
+    await shared_state.close()
+    await conversation_store.close()
+    await close_http_session()
+    gemini_executor.shutdown(wait=False)
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ("export", "import"):
+        sys.exit(cli_conversas(sys.argv[1:]))
     import uvicorn
     port = int(os.getenv("PORT", 8001))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WORKERS", 1))
+    if workers > 1 and SHARED_STATE_BACKEND not in ("sqlite", "redis"):
+        print("⚠️ WORKERS > 1 sem SHARED_STATE_BACKEND=sqlite|redis: subindo um worker só")
+        workers = 1
+    if workers > 1:
+        uvicorn.run("server:app", host="0.0.0.0", port=port, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
@@ -15,6 +15,13 @@ const axios = require('axios');
 // Configuração
 const BACKEND_URL = process.env.BACKEND_URL || 'http://localhost:8001';
 const PORT = process.env.PORT || 3001;
+// O webhook de mensagem só responde depois do agrupamento (COALESCE_MAX_WAIT) e
+// da IA (fila LLM_QUEUE_MAX_WAIT + ROUTER_MAX_ATTEMPTS x ROUTER_ATTEMPT_TIMEOUT):
+// com os padrões do backend, 6 + 30 + 3 x 30 = 126s. Se mudar um, ajuste o outro.
+const MESSAGE_WEBHOOK_TIMEOUT = parseInt(process.env.MESSAGE_WEBHOOK_TIMEOUT_MS || '150000', 10);
+const STATUS_WEBHOOK_TIMEOUT = 5000;
+// 503 = backend sobrecarregado: tenta de novo após o Retry-After
+const WEBHOOK_MAX_RETRIES = parseInt(process.env.WEBHOOK_MAX_RETRIES || '5', 10);
 
 // Estado global
 let sock = null;
@@ -24,23 +31,33 @@ let connectionStatus = 'Aguardando conexão...';
 let isConnected = false;
 let phoneNumber = null;
 const mensagensProcessadas = new Set();
+// Ordem de recebimento: as requisições ao backend saem em paralelo e podem
+// chegar trocadas, então cada mensagem leva seu horário do WhatsApp e este número
+let sequenciaMensagens = 0;
 
 // Funções auxiliares
 function delay(ms) {
     return new Promise(resolve => setTimeout(resolve, ms));
 }
 
-async function notifyBackend(endpoint, data) {
-    try {
-        const response = await axios.post(`${BACKEND_URL}/api/webhook/${endpoint}`, data, {
-            timeout: 5000
-        });
-        return response.data;
-    } catch (error) {
-        if (error.code !== 'ECONNREFUSED') {
-            console.error(`Erro ao notificar backend: ${error.message}`);
+async function notifyBackend(endpoint, data, timeout = STATUS_WEBHOOK_TIMEOUT) {
+    for (let tentativa = 0; ; tentativa++) {
+        try {
+            const response = await axios.post(`${BACKEND_URL}/api/webhook/${endpoint}`, data, { timeout });
+            return response.data;
+        } catch (error) {
+            const status = error.response && error.response.status;
+            if (status === 503 && tentativa < WEBHOOK_MAX_RETRIES) {
+                const retryAfter = parseFloat(error.response.headers['retry-after']) || 1;
+                // Jitter: rajadas rejeitadas juntas não voltam todas no mesmo instante
+                await delay(retryAfter * 1000 * (1 + Math.random() * 0.5) * (tentativa + 1));
+                continue;
+            }
+            if (error.code !== 'ECONNREFUSED') {
+                console.error(`Erro ao notificar backend: ${error.message}`);
+            }
+            return null;
         }
-        return null;
     }
 }
 
@@ -58,7 +75,11 @@ async function syncStatusWithBackend() {
 setInterval(syncStatusWithBackend, 5000);
 
 // ==================== ENVIAR MENSAGEM PARA WHATSAPP ====================
-async function enviarMensagemWhatsApp(chatId, mensagem) {
+// opcoes.simularDigitacao=false: o backend está enviando em streaming e o tempo
+// de geração já é real; opcoes.continuarDigitando mantém o "digitando..." até o próximo bloco
+async function enviarMensagemWhatsApp(chatId, mensagem, opcoes = {}) {
+    const { simularDigitacao = true, continuarDigitando = false } = opcoes;
+    
     if (!sock || !isConnected) {
         return { success: false, error: 'WhatsApp não conectado' };
     }
@@ -71,15 +92,23 @@ async function enviarMensagemWhatsApp(chatId, mensagem) {
         }
         
         // Simular digitação
-        try {
-            await sock.sendPresenceUpdate('composing', jid);
-            await delay(500 + Math.random() * 1000);
-            await sock.sendPresenceUpdate('paused', jid);
-        } catch (e) {}
+        if (simularDigitacao) {
+            try {
+                await sock.sendPresenceUpdate('composing', jid);
+                await delay(500 + Math.random() * 1000);
+                await sock.sendPresenceUpdate('paused', jid);
+            } catch (e) {}
+        }
         
         // Enviar mensagem
         const result = await sock.sendMessage(jid, { text: mensagem });
         
+        if (continuarDigitando) {
+            try {
+                await sock.sendPresenceUpdate('composing', jid);
+            } catch (e) {}
+        }
+        
         console.log(`\x1b[35m[PAINEL -> ${jid.split('@')[0]}] ${mensagem.substring(0, 50)}${mensagem.length > 50 ? '...' : ''}\x1b[0m`);
         
         return { 
@@ -93,8 +122,15 @@ async function enviarMensagemWhatsApp(chatId, mensagem) {
     }
 }
 
+// messageTimestamp vem em segundos, às vezes como Long
+function timestampDaMensagem(msg) {
+    const ts = msg.messageTimestamp;
+    if (ts === undefined || ts === null) return null;
+    return typeof ts === 'object' && typeof ts.toNumber === 'function' ? ts.toNumber() : Number(ts);
+}
+
 // Processamento de mensagens recebidas
-async function processarMensagem(msg) {
+async function processarMensagem(msg, seq) {
     try {
         if (!msg.key.remoteJid || msg.key.remoteJid.endsWith('@g.us') || msg.key.remoteJid === 'status@broadcast') {
             return;
@@ -129,27 +165,36 @@ async function processarMensagem(msg) {
         const chatId = msg.key.remoteJid;
         console.log(`\n\x1b[34m[CLIENTE ${chatId.split('@')[0]}] ${texto.substring(0, 100)}${texto.length > 100 ? '...' : ''}\x1b[0m`);
         
+        // "Digitando..." enquanto o backend gera a resposta: o tempo de geração
+        // conta como tempo de digitação, em vez de somar um atraso artificial depois
+        const inicio = Date.now();
+        try {
+            await sock.sendPresenceUpdate('composing', chatId);
+        } catch (e) {}
+        
         const result = await notifyBackend('message', {
             chat_id: chatId,
-            message: texto
-        });
+            message: texto,
+            timestamp: timestampDaMensagem(msg),
+            seq
+        }, MESSAGE_WEBHOOK_TIMEOUT);
         
         if (result && result.response) {
-            try {
-                await sock.sendPresenceUpdate('composing', chatId);
-            } catch (e) {}
-            
-            const delayMs = 1500 + Math.random() * 1500;
-            await delay(delayMs);
-            
-            try {
-                await sock.sendPresenceUpdate('paused', chatId);
-            } catch (e) {}
+            const delayMs = 1500 + Math.random() * 1500 - (Date.now() - inicio);
+            if (delayMs > 0) {
+                await delay(delayMs);
+            }
             
             await sock.sendMessage(chatId, { text: result.response });
             console.log(`\x1b[32m[BOT] Resposta enviada para ${chatId.split('@')[0]}\x1b[0m`);
+        } else if (result && result.reason === 'streamed') {
+            console.log(`\x1b[32m[BOT] Resposta enviada em ${result.chunks} bloco(s) para ${chatId.split('@')[0]}\x1b[0m`);
         }
         
+        try {
+            await sock.sendPresenceUpdate('paused', chatId);
+        } catch (e) {}
+        
     } catch (error) {
         console.error(`\x1b[31mErro ao processar mensagem: ${error.message}\x1b[0m`);
     }
@@ -174,7 +219,7 @@ const server = http.createServer(async (req, res) => {
         req.on('data', chunk => { body += chunk.toString(); });
         req.on('end', async () => {
             try {
-                const { chat_id, message } = JSON.parse(body);
+                const { chat_id, message, simulate_typing, keep_typing } = JSON.parse(body);
                 
                 if (!chat_id || !message) {
                     res.writeHead(400, { 'Content-Type': 'application/json' });
@@ -182,7 +227,10 @@ const server = http.createServer(async (req, res) => {
                     return;
                 }
                 
-                const result = await enviarMensagemWhatsApp(chat_id, message);
+                const result = await enviarMensagemWhatsApp(chat_id, message, {
+                    simularDigitacao: simulate_typing !== false,
+                    continuarDigitando: keep_typing === true
+                });
                 
                 res.writeHead(result.success ? 200 : 500, { 'Content-Type': 'application/json' });
                 res.end(JSON.stringify(result));
@@ -433,9 +481,10 @@ async function conectarWhatsApp() {
     sock.ev.on('messages.upsert', async ({ messages, type }) => {
         if (type !== 'notify') return;
         
-        for (const msg of messages) {
-            await processarMensagem(msg);
-        }
+        // Em paralelo: o backend agrupa rajadas do mesmo chat numa única resposta
+        // e reordena registro e agrupamento por (timestamp, seq)
+        const ordenadas = [...messages].sort((a, b) => (timestampDaMensagem(a) || 0) - (timestampDaMensagem(b) || 0));
+        await Promise.all(ordenadas.map(msg => processarMensagem(msg, ++sequenciaMensagens)));
     });
 }
 
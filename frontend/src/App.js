@@ -177,6 +177,46 @@ const formatTime = (timestamp) => {
   return new Date(timestamp).toLocaleTimeString('pt-BR', { hour: '2-digit', minute: '2-digit' });
 };
 
+// Aplica um delta de /api/sync sobre a lista local (mesma referência se nada mudou)
+const mesclarDelta = (lista, delta) => {
+  const { conversas = [], mensagens = [], removidas = [] } = delta;
+  if (!conversas.length && !mensagens.length && !removidas.length) return lista;
+
+  const porId = new Map(lista.map(c => [c.chat_id, c]));
+  removidas.forEach(chatId => porId.delete(chatId));
+  conversas.forEach(({ ultima_mensagem, ...estado }) => {
+    const atual = porId.get(estado.chat_id) || { mensagens: [] };
+    porId.set(estado.chat_id, { ...atual, ...estado });
+  });
+  mensagens.forEach(({ chat_id, message }) => {
+    const atual = porId.get(chat_id) || { chat_id, nome_cliente: chat_id.split('@')[0], mensagens: [] };
+    const msgs = [...(atual.mensagens || [])];
+    // Já conhecida (ex.: status de entrega mudou): substitui no lugar
+    const existente = msgs.findIndex(m => m.id === message.id);
+    if (existente >= 0) {
+      msgs[existente] = message;
+      porId.set(chat_id, { ...atual, mensagens: msgs });
+      return;
+    }
+    // Mensagem que chegou atrasada ao backend entra na posição do seu horário
+    let pos = msgs.length;
+    while (pos > 0 && msgs[pos - 1].timestamp > message.timestamp) pos--;
+    msgs.splice(pos, 0, message);
+    porId.set(chat_id, { ...atual, mensagens: msgs });
+  });
+  return Array.from(porId.values());
+};
+
+const ETAPAS_FUNIL = {
+  contato: 'Primeiro contato',
+  boas_vindas: 'Boas-vindas',
+  engajou: 'Respondeu',
+  link_site: 'Recebeu o link',
+  objecao: 'Desconfiança',
+  pediu_humano: 'Pediu humano',
+  atendimento_humano: 'Atendimento humano'
+};
+
 // ==================== APP PRINCIPAL ====================
 
 function App() {
@@ -214,6 +254,7 @@ function App() {
   const [isInstalled, setIsInstalled] = useState(false);
   const [notificationsEnabled, setNotificationsEnabled] = useState(false);
   const [showInstallBanner, setShowInstallBanner] = useState(false);
+  const [analytics, setAnalytics] = useState(null);
   
   // Estados para configuração - SEPARADOS para evitar re-render
   const [newGeminiKey, setNewGeminiKey] = useState('');
@@ -228,6 +269,8 @@ function App() {
   const messagesContainerRef = useRef(null);
   const lastMessageCountRef = useRef(0);
   const userScrolledUpRef = useRef(false);
+  const syncCursorRef = useRef(null);
+  const conversasRef = useRef([]);
 
   // Detectar PWA
   useEffect(() => {
@@ -311,6 +354,25 @@ function App() {
     }
   }, []);
 
+  // Funil dos últimos 7 dias - o backend devolve ETag, então repetir a busca é barato (304)
+  const fetchAnalytics = useCallback(async () => {
+    try {
+      const response = await fetch(`${BACKEND_URL}/api/analytics?dias=7`);
+      if (response.ok) {
+        setAnalytics(await response.json());
+      }
+    } catch (err) {
+      console.error('Erro analytics:', err);
+    }
+  }, []);
+
+  useEffect(() => {
+    if (activeTab !== 'dashboard') return;
+    fetchAnalytics();
+    const interval = setInterval(fetchAnalytics, 60000);
+    return () => clearInterval(interval);
+  }, [activeTab, fetchAnalytics]);
+
   // Buscar status do bot WhatsApp
   const fetchWhatsAppBotStatus = useCallback(async () => {
     if (!WHATSAPP_BOT_URL) return;
@@ -359,24 +421,52 @@ function App() {
     }
   }, []);
 
-  // Buscar conversas
+  const aplicarConversas = useCallback((newConversas) => {
+    conversasRef.current = newConversas;
+    setConversas(newConversas);
+    
+    if (selectedChat) {
+      const updated = newConversas.find(c => c.chat_id === selectedChat.chat_id);
+      if (updated) setSelectedChat(updated);
+    }
+  }, [selectedChat]);
+
+  // Buscar conversas - carga completa só na primeira vez (ou após reset), depois só o delta
   const fetchConversas = useCallback(async () => {
     try {
+      if (syncCursorRef.current) {
+        let { epoch, seq } = syncCursorRef.current;
+        let lista = conversasRef.current;
+        let hasMore = true;
+        while (hasMore) {
+          const response = await fetch(`${BACKEND_URL}/api/sync?since=${seq}&epoch=${epoch}`);
+          if (!response.ok) return;
+          const data = await response.json();
+          if (data.reset) {
+            syncCursorRef.current = null;
+            break;
+          }
+          lista = mesclarDelta(lista, data);
+          seq = data.seq;
+          hasMore = data.has_more;
+        }
+        if (syncCursorRef.current) {
+          syncCursorRef.current = { epoch, seq };
+          if (lista !== conversasRef.current) aplicarConversas(lista);
+          return;
+        }
+      }
+      
       const response = await fetch(`${BACKEND_URL}/api/conversas`);
       if (response.ok) {
         const data = await response.json();
-        const newConversas = data.conversas || [];
-        setConversas(newConversas);
-        
-        if (selectedChat) {
-          const updated = newConversas.find(c => c.chat_id === selectedChat.chat_id);
-          if (updated) setSelectedChat(updated);
-        }
+        syncCursorRef.current = data.epoch ? { epoch: data.epoch, seq: data.seq } : null;
+        aplicarConversas(data.conversas || []);
       }
     } catch (err) {
       console.error('Erro conversas:', err);
     }
-  }, [selectedChat]);
+  }, [aplicarConversas]);
 
   useEffect(() => {
     fetchStatus();
@@ -688,6 +778,36 @@ function App() {
         </div>
       </div>
       
+      {/* Funil de vendas (7 dias) */}
+      {analytics && analytics.funil[0].chats > 0 && (
+        <div className="bg-gray-800 rounded-2xl p-4 lg:p-6 border border-gray-700 mb-6">
+          <div className="flex items-center justify-between mb-4">
+            <h3 className="text-white font-bold">Funil - últimos 7 dias</h3>
+            {analytics.tempo_resposta.bot.p50_s !== null && (
+              <span className="text-gray-400 text-xs">
+                Resposta do bot: mediana {analytics.tempo_resposta.bot.p50_s}s · p90 {analytics.tempo_resposta.bot.p90_s}s
+              </span>
+            )}
+          </div>
+          <div className="space-y-2">
+            {analytics.funil.map((etapa) => (
+              <div key={etapa.etapa} className="flex items-center gap-3 text-xs lg:text-sm">
+                <span className="w-36 text-gray-400 flex-shrink-0">{ETAPAS_FUNIL[etapa.etapa] || etapa.etapa}</span>
+                <div className="flex-1 bg-gray-700 rounded-full h-3 overflow-hidden">
+                  <div
+                    className="bg-red-500 h-3 rounded-full"
+                    style={{ width: `${Math.round((etapa.taxa || 0) * 100)}%` }}
+                  />
+                </div>
+                <span className="w-20 text-right text-white">
+                  {etapa.chats} <span className="text-gray-500">({Math.round((etapa.taxa || 0) * 100)}%)</span>
+                </span>
+              </div>
+            ))}
+          </div>
+        </div>
+      )}
+      
       {/* QR Code Section */}
       {!isWhatsAppConnected ? (
         <div className="bg-gray-800 rounded-2xl p-6 lg:p-8 border border-gray-700">
@@ -857,7 +977,13 @@ function App() {
                     }`}>
                       <Clock size={10} />
                       {formatTime(msg.timestamp)}
-                      {msg.from !== 'cliente' && <CheckCheck size={12} className="ml-1" />}
+                      {msg.from !== 'cliente' && (
+                        msg.status === 'failed'
+                          ? <AlertCircle size={12} className="ml-1" />
+                          : ['queued', 'sending', 'retrying'].includes(msg.status)
+                            ? <Check size={12} className="ml-1" />
+                            : <CheckCheck size={12} className="ml-1" />
+                      )}
                     </div>
                   </div>
                 </div>